@@ -0,0 +1,289 @@
+import os
+import time
+import bisect
+import asyncio
+import itertools
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import List, Optional
+
+# Request header naming the tenant, for deployments behind a gateway that sets one
+TENANT_HEADER = os.getenv("ADMISSION_TENANT_HEADER", "")
+
+# Model calls admitted per second across the process, and the burst allowed above that
+DEFAULT_RATE = float(os.getenv("ADMISSION_RATE", "20"))
+DEFAULT_BURST = float(os.getenv("ADMISSION_BURST", "40"))
+# The same per tenant (each session, unless ADMISSION_TENANT_HEADER names a tenant);
+# 0 turns a limit off. A single turn can make several calls at once (a fan-out
+# turn asks up to three agents), so without a tenant header it is off by default
+DEFAULT_TENANT_RATE = float(os.getenv("ADMISSION_TENANT_RATE", "1" if TENANT_HEADER else "0"))
+DEFAULT_TENANT_BURST = float(os.getenv("ADMISSION_TENANT_BURST", "6"))
+# Model calls in flight at once; by default as many as the client has connections
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", os.getenv("OPENAI_POOL_SIZE", "20")))
+# Calls that may wait for admission, and for how long, before they are turned away
+DEFAULT_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "100"))
+DEFAULT_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+
+# Idle tenants' buckets are forgotten beyond this many
+MAX_TENANTS = 10000
+
+# The tenant the model calls of the current request are charged to
+current_tenant: contextvars.ContextVar = contextvars.ContextVar('admission_tenant', default=None)
+
+
+class Overloaded(Exception):
+    """A model call wasn't admitted: the wait queue is full or the wait ran out"""
+
+
+class TokenBucket:
+    """Allows `rate` calls per second on average, in bursts of up to `burst`"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float, now: Optional[float] = None):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic() if now is None else now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available, 0 if one is now"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class AdmissionController:
+    """Decides when a model call may go upstream
+
+    A call needs a token from its tenant's bucket, then a token from the global
+    bucket and a free slot under the concurrency limit. A call that can't have
+    them at once waits in a bounded queue, where calls are admitted strictly in
+    the order they became ready: a newcomer never takes a freed slot or token from
+    a call already waiting. A call that is still waiting on its tenant's bucket
+    doesn't hold up the calls of other tenants. A call arriving to a full queue,
+    or one that can't be admitted before its wait runs out, raises Overloaded
+    straight away. Callers answer those turns without the model, so under
+    overload throughput levels off at the upstream limit instead of every request
+    timing out.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: float = DEFAULT_BURST,
+                 tenant_rate: float = DEFAULT_TENANT_RATE, tenant_burst: float = DEFAULT_TENANT_BURST,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY, max_queue: int = DEFAULT_MAX_QUEUE,
+                 queue_timeout: float = DEFAULT_QUEUE_TIMEOUT):
+        self.tenant_rate = tenant_rate
+        self.tenant_burst = tenant_burst
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self._tenants: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        # (ready at, arrival number, tenant bucket) of each waiting call, in the
+        # order they are to be admitted
+        self._queue: List[tuple] = []
+        self._arrivals = itertools.count()
+        # (loop, future) of each coroutine waiting for admission
+        self._async_waiters = {}
+        self.in_flight = 0
+        self.stats = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timed_out': 0}
+
+    @property
+    def waiting(self) -> int:
+        """Calls waiting for admission"""
+        return len(self._queue)
+
+    @property
+    def saturated(self) -> bool:
+        """True when the wait queue is full, so a new call would be turned away"""
+        return self.waiting >= self.max_queue
+
+    def _tenant_bucket(self, tenant, now):
+        if tenant is None or self.tenant_rate <= 0:
+            return None
+        bucket = self._tenants.get(tenant)
+        if bucket is None:
+            bucket = self._tenants[tenant] = TokenBucket(self.tenant_rate, self.tenant_burst, now)
+            if len(self._tenants) > MAX_TENANTS:
+                self._tenants.popitem(last=False)
+        else:
+            self._tenants.move_to_end(tenant)
+        return bucket
+
+    def _capacity(self, now):
+        """0 if a ready call may be admitted now, else how long until the global
+        bucket has a token, None meaning until a call finishes"""
+        if self.in_flight >= self.max_concurrency:
+            return None
+        return self._bucket.wait_time(now) if self._bucket is not None else 0.0
+
+    def _admit(self):
+        if self._bucket is not None:
+            self._bucket.take()
+        self.in_flight += 1
+        self.stats['admitted'] += 1
+
+    def _enqueue(self, tenant, timeout):
+        """Admit the call at once (returns None) or queue it (returns its queue entry
+        and when its wait runs out); called with the lock held"""
+        now = time.monotonic()
+        expires_at = now + min(timeout or self.queue_timeout, self.queue_timeout)
+        bucket = self._tenant_bucket(tenant, now)
+        tenant_wait = bucket.wait_time(now) if bucket is not None else 0.0
+        # Only when no call that is ready to go is waiting already
+        if tenant_wait == 0 and not (self._queue and self._queue[0][0] <= now) and self._capacity(now) == 0:
+            if bucket is not None:
+                bucket.take()
+            self._admit()
+            return None
+        if len(self._queue) >= self.max_queue:
+            self.stats['rejected'] += 1
+            raise Overloaded("Too many model calls are waiting to be admitted")
+        if now + tenant_wait > expires_at:
+            self.stats['timed_out'] += 1
+            raise Overloaded("A model call wasn't admitted in time")
+        # The tenant's token is taken now, so its later calls line up behind this one
+        if bucket is not None:
+            bucket.take()
+        entry = (now + tenant_wait, next(self._arrivals), bucket)
+        bisect.insort(self._queue, entry)
+        self.stats['queued'] += 1
+        return entry, expires_at
+
+    def _poll(self, entry, expires_at):
+        """Admit a queued call (returns 0) or return how long to wait before trying
+        again; raises Overloaded once it can't be admitted in time"""
+        now = time.monotonic()
+        if self._queue[0] is not entry:
+            wait = None  # until the calls ahead of it are admitted or give up
+        elif entry[0] > now:
+            wait = entry[0] - now
+        else:
+            wait = self._capacity(now)
+            if wait == 0:
+                self._queue.pop(0)
+                self._admit()
+                # The next call in line may be admitted too
+                self._notify()
+                return 0.0
+        remaining = expires_at - now
+        if remaining <= 0 or (wait is not None and wait > remaining):
+            self.stats['timed_out'] += 1
+            raise Overloaded("A model call wasn't admitted in time")
+        return remaining if wait is None else wait
+
+    def _leave(self, entry):
+        """Take a call that gave up out of the queue; called with the lock held"""
+        if entry not in self._queue:
+            return
+        head = self._queue[0] is entry
+        self._queue.remove(entry)
+        if entry[2] is not None:
+            # The call wasn't made, so its tenant gets the token back
+            entry[2].tokens += 1
+        if head:
+            self._notify()
+
+    def _notify(self):
+        """Let the waiting calls check whether it is their turn; called with the lock held"""
+        self._changed.notify_all()
+        for loop, future in self._async_waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def acquire(self, tenant: Optional[str] = None, timeout: Optional[float] = None):
+        """Block until the call is admitted; release() must follow"""
+        with self._lock:
+            queued = self._enqueue(tenant, timeout)
+            if queued is None:
+                return
+            entry, expires_at = queued
+            try:
+                while True:
+                    wait = self._poll(entry, expires_at)
+                    if wait == 0:
+                        return
+                    self._changed.wait(wait)
+            finally:
+                self._leave(entry)
+
+    async def aacquire(self, tenant: Optional[str] = None, timeout: Optional[float] = None):
+        """acquire() for coroutines: waits without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            queued = self._enqueue(tenant, timeout)
+        if queued is None:
+            return
+        entry, expires_at = queued
+        try:
+            while True:
+                future = loop.create_future()
+                with self._lock:
+                    wait = self._poll(entry, expires_at)
+                    if wait == 0:
+                        return
+                    self._async_waiters[(loop, future)] = None
+                try:
+                    await asyncio.wait((future,), timeout=wait)
+                finally:
+                    with self._lock:
+                        self._async_waiters.pop((loop, future), None)
+        finally:
+            with self._lock:
+                self._leave(entry)
+
+    def release(self):
+        """Free the slot of a finished call and let the waiting calls try again"""
+        with self._lock:
+            self.in_flight -= 1
+            self._notify()
+
+    @contextmanager
+    def admit(self, tenant: Optional[str] = None, timeout: Optional[float] = None):
+        self.acquire(tenant, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aadmit(self, tenant: Optional[str] = None, timeout: Optional[float] = None):
+        await self.aacquire(tenant, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def tenant_for(headers, session_id: str) -> str:
+    """The tenant a request's model calls are charged to"""
+    return (TENANT_HEADER and headers.get(TENANT_HEADER)) or session_id
+
+
+@contextmanager
+def tenant_scope(tenant: Optional[str]):
+    """Charge the model calls made inside the block to a tenant"""
+    token = current_tenant.set(tenant)
+    try:
+        yield
+    finally:
+        current_tenant.reset(token)
+
+
+def create_admission_controller() -> Optional[AdmissionController]:
+    """The admission controller configured by the environment; ADMISSION_CONTROL=off disables it"""
+    if os.getenv("ADMISSION_CONTROL", "on") == "off":
+        return None
+    return AdmissionController()
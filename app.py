@@ -1,17 +1,44 @@
 import os
+import asyncio
 import openai
 import json
 import requests
-import uuid
+import time
+import secrets
+import logging
+import contextvars
 from datetime import datetime
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, render_template, session
+from flask import Flask, Request, Response, g, request, jsonify, render_template, session, stream_with_context
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from llm_client import MODEL_UNAVAILABLE, default_client
+from conversation_store import create_store, register_metrics as register_store_metrics
+from conversation_state import Conversation, snapshot
+from history_manager import create_history_manager
+from keywords import scan_message, detect_urgency
+from coverage_rules import default_rules
+from facilities import default_index
+from insurance_ingest import IngestionJobs
+from policy_index import load_policy_index, relevant_clauses
+from emergency import default_detector
+from intent_classifier import DEFAULT_CONFIDENCE_THRESHOLD, default_classifier
+from turn_coordinator import TurnCoordinator, new_idempotency_key, register_metrics as register_turn_metrics
+from admission import tenant_for, tenant_scope
+from token_accounting import session_scope
+from rules_responder import RulesResponder
+from upload_store import UploadStore
+from upload_janitor import QuotaExceeded, create_upload_janitor
+from structured_logging import configure_logging
+import metrics
 
 # Load environment variables from .env file
 load_dotenv()
 
+configure_logging()
+logger = logging.getLogger(__name__)
+
 # Initialize OpenAI API with key from environment variables
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
@@ -30,126 +57,197 @@ if not os.path.exists(UPLOAD_FOLDER):
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
 
+# Uploads are stored once per content and shared by the sessions that uploaded them
+upload_store = UploadStore(UPLOAD_FOLDER)
+
+class UploadRequest(Request):
+    """Streams uploaded files straight into the upload store, hashing them on the way"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return upload_store.temp_file()
+
+app.request_class = UploadRequest
+
+# Insurance coverage and provider rules, loaded once at startup
+coverage_rules = default_rules()
+
+# After the instant emergency reply, "stream" adds first-aid detail from the symptom
+# agent to streamed replies; "off" sends the emergency reply alone
+EMERGENCY_ELABORATION = os.getenv("EMERGENCY_ELABORATION", "stream")
+EMERGENCY_ELABORATION_PROMPT = ("The user has already been shown this emergency advice: \"{response}\" "
+                                "Add two or three short, practical steps to take while waiting for help, specific "
+                                "to what they described. Never suggest waiting or delaying the call.")
+
+# Facility types suited to each urgency level, most appropriate first
+FACILITY_TYPES_BY_URGENCY = {
+    'emergency': ['Emergency Room'],
+    'urgent': ['Urgent Care', 'Emergency Room'],
+    'routine': ['Primary Care', 'Urgent Care', 'Pharmacy']
+}
+
+# A message that asks several specialists something at once ("I have a fever, am I
+# covered by Aetna and where is the nearest clinic") is answered by all of them
+# concurrently and their answers are merged; "off" sends every message to one agent
+AGENT_FANOUT = os.getenv("AGENT_FANOUT", "on")
+AGENT_FANOUT_WORKERS = int(os.getenv("AGENT_FANOUT_WORKERS", "8"))
+# Seconds an agent gets in a fan-out before the reply goes out without its part;
+# can be set per agent with AGENT_DEADLINE_<AGENT_NAME>, e.g. AGENT_DEADLINE_FACILITY_RECOMMENDATION=10
+AGENT_DEADLINE = float(os.getenv("AGENT_DEADLINE", "20"))
+
+# Specialists in the order their parts appear in a merged reply; symptoms come first
+# so the urgency they record is known when facilities are chosen
+SPECIALISTS = ('symptom_assessment', 'insurance_verification', 'facility_recommendation')
+FANOUT_PROMPT = ("Other Nurse Ally specialists are answering the rest of this message in the same reply. "
+                 "Answer only the part about {focus}, in a few sentences, without greeting the user.")
+FANOUT_FOCUS = {
+    'symptom_assessment': "the user's symptoms and how urgent they are",
+    'insurance_verification': "their insurance coverage",
+    'facility_recommendation': "where to get care"
+}
+# Said in place of an agent's part when it misses its deadline or fails
+FANOUT_UNAVAILABLE = {
+    'symptom_assessment': "I couldn't finish assessing your symptoms just now. Could you tell me a bit more about them?",
+    'insurance_verification': "I couldn't check your insurance coverage just now; ask me about it again in a moment.",
+    'facility_recommendation': "I couldn't put together facility recommendations just now; ask me again in a moment."
+}
+
+# Triage urgency used by the rules-only replies for each urgency level the agents record
+RULES_URGENCY = {'emergency': 'severe', 'urgent': 'moderate', 'routine': 'mild'}
+
 # ===== MODULAR AGENT SYSTEM =====
 # Each agent is implemented as a separate class with a consistent interface
 
 class Agent:
     """Base agent class that defines the interface for all specialized agents"""
     
-    def __init__(self, system_prompt):
+    def __init__(self, system_prompt, name=None, llm=None):
         self.system_prompt = system_prompt
+        self.name = name
+        self.llm = llm or default_client
+        self.history = create_history_manager(self.llm)
     
     def process(self, user_message, conversation_history):
         """Process a user message and return a response"""
         raise NotImplementedError("Subclasses must implement this method")
+    
+    def _complete(self, user_message, response, conversation_history):
+        """Update the conversation state once the full response is known"""
+        return response, conversation_history
+    
+    def _prepare_messages(self, conversation_history, user_message):
+        """Build the prompt: recent turns verbatim, older turns summarized, state as facts"""
+        with metrics.stage('prompt'):
+            return self.history.build_messages(self.system_prompt, conversation_history['messages'],
+                                               conversation_history, user_message,
+                                               facts=self._conversation_facts(conversation_history, user_message))
+    
+    def _conversation_facts(self, conversation_history, user_message=None):
+        """Summarize the structured conversation state as short facts for the prompt"""
+        facts = []
+        if conversation_history.get('symptom_data'):
+            facts.append(f"Reported symptoms: {', '.join(conversation_history['symptom_data'])}")
+        if conversation_history.get('urgency_level'):
+            facts.append(f"Symptom urgency level: {conversation_history['urgency_level']}")
+        insurance_data = conversation_history.get('insurance_data') or {}
+        if insurance_data.get('provider'):
+            facts.append(f"Insurance provider: {insurance_data['provider']}")
+        if conversation_history.get('insurance_file'):
+            document = insurance_data.get('document') or {}
+            if document.get('status') == 'done' and (document.get('insurer') or document.get('plan_type')):
+                details = ', '.join(filter(None, [document.get('insurer'), document.get('plan_type') and f"{document['plan_type']} plan", document.get('plan_name')]))
+                kind = 'card' if document.get('document_type') == 'card' else 'document'
+                facts.append(f"The user has uploaded an insurance {kind}: {details}")
+            elif document.get('status') in ('queued', 'processing'):
+                facts.append("The user has uploaded an insurance document that is still being processed")
+            else:
+                facts.append("The user has uploaded an insurance document")
+        location_data = conversation_history.get('location_data') or {}
+        if location_data.get('detected'):
+            facts.append(f"User's location: Latitude {location_data.get('latitude')}, Longitude {location_data.get('longitude')}")
+        return facts
+    
+    def _call_openai_api(self, messages, **options):
+        """Get the full response from the shared LLM client"""
+        return self.llm.chat(messages, agent=self.name, **options)
+    
+    def _stream_openai_api(self, messages, **options):
+        """Yield response tokens from the shared LLM client as they arrive"""
+        return self.llm.stream(messages, agent=self.name, **options)
+    
+    async def aprocess(self, user_message, conversation_history):
+        """Process a user message without blocking the event loop
+        
+        Returns the same values as process(). The prompt is built on a worker thread
+        because an LLM-written history summary makes a blocking model call.
+        """
+        messages = await asyncio.to_thread(self._prepare_messages, conversation_history, user_message)
+        response = await self._acall_openai_api(messages)
+        return self._complete(user_message, response, conversation_history)
+    
+    async def _acall_openai_api(self, messages, **options):
+        """Get the full response from the shared LLM client without blocking the event loop"""
+        return await self.llm.achat(messages, agent=self.name, **options)
+    
+    def _astream_openai_api(self, messages, **options):
+        """Yield response tokens as they arrive without blocking the event loop"""
+        return self.llm.astream(messages, agent=self.name, **options)
 
 
 class CoordinatorAgent(Agent):
     """Manages conversation flow and delegates to specialized agents"""
     
-    def __init__(self):
+    def __init__(self, llm=None):
         super().__init__("You are Nurse Ally, a kind and professional AI nurse coordinator. "
                          "Your role is to manage the conversation flow, determine which specialized agent to call, "
                          "and synthesize their responses. You ask questions about symptoms, location, insurance "
                          "and make the final suggestions. You do NOT give medical advice, only logistics and "
-                         "urgency-based recommendations.")
+                         "urgency-based recommendations.",
+                         name="coordinator", llm=llm)
     
     def process(self, user_message, conversation_history):
         # Call OpenAI API with coordinator prompt
         messages = self._prepare_messages(conversation_history, user_message)
         response = self._call_openai_api(messages)
         return response, conversation_history
-    
-    def _prepare_messages(self, conversation_history, user_message):
-        messages = [{"role": "system", "content": self.system_prompt}]
-        
-        # Add conversation history
-        for msg in conversation_history['messages']:
-            messages.append(msg)
-        
-        # Add current user message if not in history
-        if user_message and (not conversation_history['messages'] or 
-                            conversation_history['messages'][-1]['role'] != 'user' or 
-                            conversation_history['messages'][-1]['content'] != user_message):
-            messages.append({"role": "user", "content": user_message})
-        
-        return messages
-    
-    def _call_openai_api(self, messages):
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7
-        )
-        return response.choices[0].message.content
 
 
 class SymptomAssessmentAgent(Agent):
     """Assesses symptoms and determines urgency level"""
     
-    def __init__(self):
+    def __init__(self, llm=None):
         super().__init__("You are the Symptom Assessment Agent for Nurse Ally. "
                          "Your role is to ask detailed questions about the user's symptoms, assess their urgency level, "
                          "and determine if immediate medical attention is needed. You should classify urgency as: "
                          "'Emergency' (needs immediate medical attention), 'Urgent' (should be seen within 24 hours), "
                          "or 'Routine' (can wait for regular appointment). You do NOT provide medical advice or diagnoses, "
-                         "only assess urgency based on reported symptoms.")
+                         "only assess urgency based on reported symptoms.",
+                         name="symptom_assessment", llm=llm)
     
     def process(self, user_message, conversation_history):
         # Call OpenAI API with symptom assessment prompt
         messages = self._prepare_messages(conversation_history, user_message)
         response = self._call_openai_api(messages)
-        
+        return self._complete(user_message, response, conversation_history)
+    
+    def _complete(self, user_message, response, conversation_history):
         # Extract symptom data and urgency level
         updated_history = self._extract_symptom_data(user_message, response, conversation_history)
         
         return response, updated_history
     
-    def _prepare_messages(self, conversation_history, user_message):
-        messages = [{"role": "system", "content": self.system_prompt}]
-        
-        # Add conversation history
-        for msg in conversation_history['messages']:
-            messages.append(msg)
-        
-        # Add current user message if not in history
-        if user_message and (not conversation_history['messages'] or 
-                            conversation_history['messages'][-1]['role'] != 'user' or 
-                            conversation_history['messages'][-1]['content'] != user_message):
-            messages.append({"role": "user", "content": user_message})
-        
-        return messages
-    
-    def _call_openai_api(self, messages):
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7
-        )
-        return response.choices[0].message.content
-    
     def _extract_symptom_data(self, user_message, assistant_message, conversation_history):
         # Initialize symptom data if not already present
         if 'symptom_data' not in conversation_history:
             conversation_history['symptom_data'] = {}
         
         # Extract symptoms from user message
-        symptom_keywords = ['pain', 'hurt', 'sick', 'fever', 'cough', 'headache', 'injury', 'nausea', 'vomiting', 'dizziness']
-        for keyword in symptom_keywords:
-            if keyword in user_message.lower():
-                conversation_history['symptom_data'][keyword] = True
+        for keyword in scan_message(user_message).get('symptom', ()):
+            conversation_history['symptom_data'][keyword] = True
         
         # Extract urgency level from assistant message
-        urgency_indicators = {
-            'emergency': ['emergency', 'immediate', 'severe', 'critical', '911', 'ambulance'],
-            'urgent': ['urgent', 'soon', 'concerning', '24 hours', 'today'],
-            'routine': ['routine', 'mild', 'regular', 'appointment']
-        }
-        
-        for level, indicators in urgency_indicators.items():
-            if any(indicator in assistant_message.lower() for indicator in indicators):
-                conversation_history['urgency_level'] = level
-                break
+        urgency_level = detect_urgency(assistant_message)
+        if urgency_level:
+            conversation_history['urgency_level'] = urgency_level
         
         return conversation_history
 
@@ -157,59 +255,71 @@ class SymptomAssessmentAgent(Agent):
 class InsuranceVerificationAgent(Agent):
     """Verifies insurance coverage and provides information about covered facilities"""
     
-    def __init__(self):
+    def __init__(self, llm=None):
         super().__init__("You are the Insurance Verification Agent for Nurse Ally. "
                          "Your role is to ask about the user's insurance provider, plan details, and verify coverage options. "
                          "You should help users understand what types of care facilities their insurance covers "
                          "(emergency rooms, urgent care, primary care, etc.) and any network restrictions. "
-                         "You should be knowledgeable about major insurance providers and their typical coverage policies.")
+                         "You should be knowledgeable about major insurance providers and their typical coverage policies.",
+                         name="insurance_verification", llm=llm)
     
     def process(self, user_message, conversation_history):
         # Call OpenAI API with insurance verification prompt
         messages = self._prepare_messages(conversation_history, user_message)
         response = self._call_openai_api(messages)
+        return self._complete(user_message, response, conversation_history)
+    
+    def _conversation_facts(self, conversation_history, user_message=None):
+        facts = super()._conversation_facts(conversation_history, user_message)
+        insurance_data = conversation_history.get('insurance_data') or {}
+        if insurance_data.get('policy_number'):
+            facts.append(f"Policy or member number: {insurance_data['policy_number']}")
+        if insurance_data.get('valid_until'):
+            expired = insurance_data['valid_until'] < datetime.now().date().isoformat()
+            facts.append(f"Insurance valid until {insurance_data['valid_until']}"
+                         + (" (expired, so the cover may have lapsed)" if expired else ""))
+        clauses = self._policy_clauses(conversation_history, user_message)
+        if clauses:
+            facts.append("Relevant clauses from the user's uploaded policy (base coverage answers on these):\n"
+                         + "\n".join(f"  {clause}" for clause in clauses))
+        return facts
+    
+    def _policy_clauses(self, conversation_history, user_message):
+        """Retrieve the policy chunks most relevant to the question and symptoms"""
+        document = (conversation_history.get('insurance_data') or {}).get('document') or {}
+        if document.get('status') != 'done':
+            return []
+        
+        try:
+            index = load_policy_index(document.get('index_path'), document.get('text_path'))
+        except (OSError, ValueError) as e:
+            logger.warning("Error loading policy index: %s", e)
+            return []
+        if index is None:
+            return []
         
+        query = ' '.join(filter(None, [user_message, ' '.join(conversation_history.get('symptom_data') or {}),
+                                       conversation_history.get('urgency_level'), 'medical expenses coverage']))
+        return relevant_clauses(index, query)
+    
+    def _complete(self, user_message, response, conversation_history):
         # Extract insurance data
         updated_history = self._extract_insurance_data(user_message, response, conversation_history)
         
         return response, updated_history
     
-    def _prepare_messages(self, conversation_history, user_message):
-        messages = [{"role": "system", "content": self.system_prompt}]
-        
-        # Add conversation history
-        for msg in conversation_history['messages']:
-            messages.append(msg)
-        
-        # Add current user message if not in history
-        if user_message and (not conversation_history['messages'] or 
-                            conversation_history['messages'][-1]['role'] != 'user' or 
-                            conversation_history['messages'][-1]['content'] != user_message):
-            messages.append({"role": "user", "content": user_message})
-        
-        return messages
-    
-    def _call_openai_api(self, messages):
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7
-        )
-        return response.choices[0].message.content
-    
     def _extract_insurance_data(self, user_message, assistant_message, conversation_history):
         # Initialize insurance data if not already present
         if 'insurance_data' not in conversation_history:
             conversation_history['insurance_data'] = {}
         
         # Extract insurance provider from user message
-        insurance_providers = ['aetna', 'blue cross', 'blue shield', 'cigna', 'humana', 'kaiser', 'medicare', 'medicaid', 'united healthcare', 'anthem']
-        for provider in insurance_providers:
-            if provider in user_message.lower():
-                conversation_history['insurance_data']['provider'] = provider
+        providers = scan_message(user_message).get('insurance_provider')
+        if providers:
+            conversation_history['insurance_data']['provider'] = providers[-1]
         
         # Check if insurance file was uploaded
-        if 'insurance_file' in conversation_history:
+        if conversation_history.get('insurance_file'):
             conversation_history['insurance_data']['file_uploaded'] = True
         
         return conversation_history
@@ -218,97 +328,64 @@ class InsuranceVerificationAgent(Agent):
 class FacilityRecommendationAgent(Agent):
     """Recommends healthcare facilities based on location, symptoms, and insurance"""
     
-    def __init__(self):
+    def __init__(self, llm=None, facilities=None):
         super().__init__("You are the Facility Recommendation Agent for Nurse Ally. "
                          "Your role is to recommend appropriate healthcare facilities based on the user's location, "
                          "symptom urgency, and insurance coverage. You should consider factors like proximity, "
                          "wait times, facility type (ER, urgent care, primary care), and insurance network status. "
-                         "When possible, provide specific facility names, addresses, and contact information.")
+                         "When possible, provide specific facility names, addresses, and contact information.",
+                         name="facility_recommendation", llm=llm)
+        self.facilities = facilities or default_index()
     
     def process(self, user_message, conversation_history):
         # Call OpenAI API with facility recommendation prompt
         messages = self._prepare_messages(conversation_history, user_message)
         response = self._call_openai_api(messages)
-        
+        return self._complete(user_message, response, conversation_history)
+    
+    def _complete(self, user_message, response, conversation_history):
         # Search for nearby facilities based on conversation data
-        facilities = self._search_nearby_facilities(conversation_history)
+        with metrics.stage('postprocess'):
+            facilities = self._search_nearby_facilities(conversation_history)
         
         return response, conversation_history, facilities
     
-    def _prepare_messages(self, conversation_history, user_message):
-        messages = [{"role": "system", "content": self.system_prompt}]
-        
-        # Add conversation history
-        for msg in conversation_history['messages']:
-            messages.append(msg)
-        
-        # Add current user message if not in history
-        if user_message and (not conversation_history['messages'] or 
-                            conversation_history['messages'][-1]['role'] != 'user' or 
-                            conversation_history['messages'][-1]['content'] != user_message):
-            messages.append({"role": "user", "content": user_message})
-        
-        # Add location data if available
-        if 'location_data' in conversation_history and conversation_history['location_data'].get('detected'):
-            location_info = f"User's location: Latitude {conversation_history['location_data'].get('latitude')}, Longitude {conversation_history['location_data'].get('longitude')}"
-            messages.append({"role": "system", "content": location_info})
-        
-        # Add symptom data if available
-        if 'symptom_data' in conversation_history and conversation_history.get('urgency_level'):
-            symptom_info = f"Symptom urgency level: {conversation_history.get('urgency_level')}"
-            messages.append({"role": "system", "content": symptom_info})
-        
-        # Add insurance data if available
-        if 'insurance_data' in conversation_history and 'provider' in conversation_history['insurance_data']:
-            insurance_info = f"Insurance provider: {conversation_history['insurance_data']['provider']}"
-            messages.append({"role": "system", "content": insurance_info})
-        
-        return messages
-    
-    def _call_openai_api(self, messages):
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7
-        )
-        return response.choices[0].message.content
+    def _conversation_facts(self, conversation_history, user_message=None):
+        facts = super()._conversation_facts(conversation_history, user_message)
+        facilities = self._search_nearby_facilities(conversation_history)
+        if facilities:
+            nearby = '; '.join(f"{f['name']} ({f['type']}, {f['distance']}, {f['address']})" for f in facilities)
+            facts.append(f"Nearest suitable facilities: {nearby}")
+        return facts
     
     def _search_nearby_facilities(self, conversation_history):
-        # This would typically call an external API to find nearby healthcare facilities
-        # For now, we'll return mock data based on the conversation history
-        facilities = []
-        
+        """Find the nearest facilities suited to the urgency level in the facility index"""
         # Only proceed if we have location data
-        if 'location_data' not in conversation_history or not conversation_history['location_data'].get('detected'):
-            return facilities
+        location_data = conversation_history.get('location_data') or {}
+        if not location_data.get('detected'):
+            return []
+        
+        try:
+            latitude = float(location_data['latitude'])
+            longitude = float(location_data['longitude'])
+        except (KeyError, TypeError, ValueError):
+            return []
         
         # Determine facility type based on urgency level
         urgency_level = conversation_history.get('urgency_level', 'routine')
-        facility_types = []
-        
-        if urgency_level == 'emergency':
-            facility_types = ['Emergency Room']
-        elif urgency_level == 'urgent':
-            facility_types = ['Urgent Care', 'Emergency Room']
-        else:  # routine
-            facility_types = ['Primary Care', 'Urgent Care']
-        
-        # Mock facilities based on urgency
-        for i, facility_type in enumerate(facility_types):
-            facilities.append({
-                "name": f"{facility_type} Center {i+1}",
-                "address": f"{100+i} Medical Parkway, Healthcare City",
-                "distance": f"{i+1} miles",
-                "type": facility_type,
-                "rating": 4.5 - (i * 0.2),
-                "wait_time": f"{(i+1) * 15} minutes",
-                "insurance_accepted": True if 'insurance_data' in conversation_history else "Unknown",
-                "services": ["General Care", "X-ray", "Lab Services"],
-                "phone": f"555-{100+i}",
-                "website": f"https://example.com/facility{i+1}",
-                "google_maps_url": f"https://maps.google.com/?q={100+i}+Medical+Parkway+Healthcare+City"
-            })
+        facility_types = FACILITY_TYPES_BY_URGENCY.get(urgency_level, FACILITY_TYPES_BY_URGENCY['routine'])
+        
+        nearest = self.facilities.nearest(latitude, longitude, facility_types)
+        if not nearest and urgency_level != 'emergency':
+            # Nothing of the preferred types nearby: a hospital can still treat it
+            nearest = self.facilities.nearest(latitude, longitude, FACILITY_TYPES_BY_URGENCY['emergency'])
         
+        insurance_accepted = True if conversation_history.get('insurance_data') else "Unknown"
+        facilities = []
+        for distance, facility in nearest:
+            facility_data = facility.to_dict(distance)
+            facility_data['insurance_accepted'] = insurance_accepted
+            facilities.append(facility_data)
         return facilities
 
 # ===== AGENT MANAGER =====
@@ -317,18 +394,47 @@ class FacilityRecommendationAgent(Agent):
 class AgentManager:
     """Manages agent instances and handles agent selection and handoff"""
     
-    def __init__(self):
-        # Initialize agent instances
+    def __init__(self, llm=None):
+        # Initialize agent instances; they all share one LLM client and its connection pool
+        self.llm = llm or default_client
         self.agents = {
-            "coordinator": CoordinatorAgent(),
-            "symptom_assessment": SymptomAssessmentAgent(),
-            "insurance_verification": InsuranceVerificationAgent(),
-            "facility_recommendation": FacilityRecommendationAgent()
+            "coordinator": CoordinatorAgent(llm),
+            "symptom_assessment": SymptomAssessmentAgent(llm),
+            "insurance_verification": InsuranceVerificationAgent(llm),
+            "facility_recommendation": FacilityRecommendationAgent(llm)
         }
         self.current_agent = "coordinator"  # Default agent
+        self.emergency = default_detector()
+        # Local intent model; INTENT_CLASSIFIER=off routes on the keyword rules alone
+        self.intents = default_classifier() if os.getenv("INTENT_CLASSIFIER", "on") != "off" else None
+        self.intent_threshold = DEFAULT_CONFIDENCE_THRESHOLD
+        # Runs the model calls of the agents answering one message together
+        self.fanout_pool = ThreadPoolExecutor(max_workers=AGENT_FANOUT_WORKERS, thread_name_prefix='agent')
+        self.deadlines = {agent_type: float(os.getenv(f"AGENT_DEADLINE_{agent_type.upper()}", AGENT_DEADLINE))
+                          for agent_type in SPECIALISTS}
+        # Answers turns from the local rules when model calls aren't being admitted
+        self.rules = RulesResponder(coverage_rules, self.agents['facility_recommendation'].facilities)
     
     def process_message(self, user_message, conversation_history):
         """Process a user message using the appropriate agent"""
+        # Emergencies are answered locally, never waiting on the model
+        emergency = self._emergency_reply(user_message, conversation_history)
+        if emergency:
+            return emergency
+        
+        # With the admission queue full or the circuit open, a model call would only be turned away
+        if self._model_unavailable():
+            return self._rules_reply(user_message, conversation_history, "model unavailable")
+        
+        # Several specialists asked for at once answer concurrently
+        agent_types = self._fanout_agents(user_message)
+        if agent_types:
+            started = time.monotonic()
+            prompts = self._fanout_prompts(user_message, conversation_history, agent_types)
+            calls = {agent_type: self._submit(agent_type, messages, started) for agent_type, messages in prompts}
+            responses = {agent_type: self._collect(agent_type, *call) for agent_type, call in calls.items()}
+            return self._merge(user_message, conversation_history, responses)
+        
         # Determine which agent to use based on the message and conversation state
         agent_type = self._determine_agent(user_message, conversation_history)
         
@@ -336,30 +442,443 @@ class AgentManager:
         agent = self.agents[agent_type]
         
         # Process the message with the selected agent
+        try:
+            result = agent.process(user_message, conversation_history)
+        except MODEL_UNAVAILABLE as e:
+            return self._rules_reply(user_message, conversation_history, e)
         if agent_type == "facility_recommendation":
-            response, updated_history, facilities = agent.process(user_message, conversation_history)
+            response, updated_history, facilities = result
             return response, updated_history, agent_type, facilities
         else:
-            response, updated_history = agent.process(user_message, conversation_history)
+            response, updated_history = result
             return response, updated_history, agent_type, None
     
+    def stream_message(self, user_message, conversation_history):
+        """Process a user message, yielding events as the response is generated
+        
+        Yields ('agent', agent_type) once routing is done, ('token', text) for each
+        piece of the response, and finally ('done', (response, updated_history,
+        agent_type, facilities)) with the same values as process_message.
+        """
+        emergency = self._emergency_reply(user_message, conversation_history)
+        if emergency:
+            yield from self._stream_emergency(user_message, emergency)
+            return
+        
+        if self._model_unavailable():
+            yield from self._stream_rules_reply(user_message, conversation_history, "model unavailable")
+            return
+        
+        agent_types = self._fanout_agents(user_message)
+        if agent_types:
+            yield from self._stream_fanout(user_message, conversation_history, agent_types)
+            return
+        
+        agent_type = self._determine_agent(user_message, conversation_history)
+        agent = self.agents[agent_type]
+        yield 'agent', agent_type
+        
+        tokens = []
+        try:
+            messages = agent._prepare_messages(conversation_history, user_message)
+            for token in agent._stream_openai_api(messages):
+                tokens.append(token)
+                yield 'token', token
+        except MODEL_UNAVAILABLE as e:
+            if tokens:
+                raise
+            yield from self._stream_rules_reply(user_message, conversation_history, e)
+            return
+        
+        result = agent._complete(user_message, ''.join(tokens), conversation_history)
+        if agent_type == "facility_recommendation":
+            response, updated_history, facilities = result
+        else:
+            (response, updated_history), facilities = result, None
+        yield 'done', (response, updated_history, agent_type, facilities)
+    
+    async def aprocess_message(self, user_message, conversation_history):
+        """process_message for the async server: model calls are awaited, not blocked on"""
+        emergency = self._emergency_reply(user_message, conversation_history)
+        if emergency:
+            return emergency
+        
+        if self._model_unavailable():
+            return self._rules_reply(user_message, conversation_history, "model unavailable")
+        
+        agent_types = self._fanout_agents(user_message)
+        if agent_types:
+            prompts = await asyncio.to_thread(self._fanout_prompts, user_message, conversation_history, agent_types)
+            responses = await asyncio.gather(*(self._acollect(agent_type, messages) for agent_type, messages in prompts))
+            return self._merge(user_message, conversation_history, dict(zip(agent_types, responses)))
+        
+        agent_type = self._determine_agent(user_message, conversation_history)
+        try:
+            result = await self.agents[agent_type].aprocess(user_message, conversation_history)
+        except MODEL_UNAVAILABLE as e:
+            return self._rules_reply(user_message, conversation_history, e)
+        if agent_type == "facility_recommendation":
+            response, updated_history, facilities = result
+            return response, updated_history, agent_type, facilities
+        response, updated_history = result
+        return response, updated_history, agent_type, None
+    
+    async def astream_message(self, user_message, conversation_history):
+        """stream_message for the async server, yielding the same events"""
+        emergency = self._emergency_reply(user_message, conversation_history)
+        if emergency:
+            async for event in self._astream_emergency(user_message, emergency):
+                yield event
+            return
+        
+        if self._model_unavailable():
+            for event in self._stream_rules_reply(user_message, conversation_history, "model unavailable"):
+                yield event
+            return
+        
+        agent_types = self._fanout_agents(user_message)
+        if agent_types:
+            async for event in self._astream_fanout(user_message, conversation_history, agent_types):
+                yield event
+            return
+        
+        agent_type = self._determine_agent(user_message, conversation_history)
+        agent = self.agents[agent_type]
+        yield 'agent', agent_type
+        
+        tokens = []
+        try:
+            messages = await asyncio.to_thread(agent._prepare_messages, conversation_history, user_message)
+            async for token in agent._astream_openai_api(messages):
+                tokens.append(token)
+                yield 'token', token
+        except MODEL_UNAVAILABLE as e:
+            if tokens:
+                raise
+            for event in self._stream_rules_reply(user_message, conversation_history, e):
+                yield event
+            return
+        
+        result = agent._complete(user_message, ''.join(tokens), conversation_history)
+        if agent_type == "facility_recommendation":
+            response, updated_history, facilities = result
+        else:
+            (response, updated_history), facilities = result, None
+        yield 'done', (response, updated_history, agent_type, facilities)
+    
+    def _fanout_agents(self, user_message):
+        """The specialists a message asks for, in reply order, when it asks for more than one"""
+        if AGENT_FANOUT == 'off':
+            return []
+        with metrics.stage('routing'):
+            wanted = set(self._keyword_agents(user_message))
+            intent = self.intents.classify(user_message) if self.intents else None
+        if intent and intent.confidence >= self.intent_threshold and intent.label != "coordinator":
+            wanted.add(intent.label)
+        return [agent_type for agent_type in SPECIALISTS if agent_type in wanted] if len(wanted) > 1 else []
+    
+    def _fanout_prompts(self, user_message, conversation_history, agent_types):
+        """Build each agent's prompt, asking it to answer only its own part
+        
+        Prompts are built one after another on the calling thread because building
+        them reads and updates the shared conversation state; only the model calls
+        run concurrently.
+        """
+        prompts = []
+        for agent_type in agent_types:
+            messages = self.agents[agent_type]._prepare_messages(conversation_history, user_message)
+            messages.append({"role": "system", "content": FANOUT_PROMPT.format(focus=FANOUT_FOCUS[agent_type])})
+            prompts.append((agent_type, messages))
+        return prompts
+    
+    def _submit(self, agent_type, messages, started):
+        """Start an agent's model call in the fan-out pool
+        
+        Returns the future and the time its answer is due. The LLM client gets the
+        same deadline, so a late call gives up instead of holding a worker.
+        """
+        deadline = self.deadlines[agent_type]
+        # Run in a copy of the request's context so the call is charged to its tenant
+        future = self.fanout_pool.submit(contextvars.copy_context().run, self.agents[agent_type]._call_openai_api,
+                                         messages, deadline=deadline)
+        return future, started + deadline
+    
+    def _collect(self, agent_type, future, due):
+        """Wait for an agent's answer until it is due; None if it is late or failed"""
+        try:
+            return future.result(timeout=max(0.0, due - time.monotonic()))
+        except FutureTimeout:
+            future.cancel()
+            logger.warning("Agent missed its deadline", extra={'agent': agent_type, 'deadline': self.deadlines[agent_type]})
+        except Exception as e:
+            logger.error("Error in agent %s: %s", agent_type, e, extra={'agent': agent_type})
+        return None
+    
+    def _stream_fanout(self, user_message, conversation_history, agent_types):
+        """Stream the first agent's answer while the others run, then send the rest
+        
+        Yields the same events as stream_message. Each later part is sent as one
+        token as soon as it is ready, so the reply takes about as long as the slowest
+        agent rather than the sum of all of them.
+        """
+        started = time.monotonic()
+        prompts = self._fanout_prompts(user_message, conversation_history, agent_types)
+        calls = {agent_type: self._submit(agent_type, messages, started) for agent_type, messages in prompts[1:]}
+        yield 'agent', "coordinator"
+        
+        first, messages = prompts[0]
+        due = started + self.deadlines[first]
+        tokens = []
+        try:
+            for token in self.agents[first]._stream_openai_api(messages, deadline=self.deadlines[first]):
+                tokens.append(token)
+                yield 'token', token
+                if time.monotonic() > due:
+                    logger.warning("Agent missed its deadline", extra={'agent': first, 'deadline': self.deadlines[first]})
+                    break
+        except Exception as e:
+            logger.error("Error in agent %s: %s", first, e, extra={'agent': first})
+        responses = {first: ''.join(tokens) or None}
+        if not tokens:
+            yield 'token', FANOUT_UNAVAILABLE[first]
+        
+        for agent_type, call in calls.items():
+            responses[agent_type] = self._collect(agent_type, *call)
+            yield 'token', "\n\n" + (responses[agent_type] or FANOUT_UNAVAILABLE[agent_type]).strip()
+        
+        yield 'done', self._merge(user_message, conversation_history, responses)
+    
+    async def _acollect(self, agent_type, messages):
+        """Await an agent's answer until its deadline; None if it is late or failed"""
+        deadline = self.deadlines[agent_type]
+        try:
+            return await asyncio.wait_for(self.agents[agent_type]._acall_openai_api(messages, deadline=deadline),
+                                          deadline)
+        except asyncio.TimeoutError:
+            logger.warning("Agent missed its deadline", extra={'agent': agent_type, 'deadline': deadline})
+        except Exception as e:
+            logger.error("Error in agent %s: %s", agent_type, e, extra={'agent': agent_type})
+        return None
+    
+    async def _astream_fanout(self, user_message, conversation_history, agent_types):
+        """_stream_fanout for the async server: the other agents run as tasks"""
+        started = time.monotonic()
+        prompts = await asyncio.to_thread(self._fanout_prompts, user_message, conversation_history, agent_types)
+        tasks = {agent_type: asyncio.create_task(self._acollect(agent_type, messages))
+                 for agent_type, messages in prompts[1:]}
+        yield 'agent', "coordinator"
+        
+        first, messages = prompts[0]
+        due = started + self.deadlines[first]
+        tokens = []
+        stream = self.agents[first]._astream_openai_api(messages, deadline=self.deadlines[first])
+        try:
+            async for token in stream:
+                tokens.append(token)
+                yield 'token', token
+                if time.monotonic() > due:
+                    logger.warning("Agent missed its deadline", extra={'agent': first, 'deadline': self.deadlines[first]})
+                    break
+        except Exception as e:
+            logger.error("Error in agent %s: %s", first, e, extra={'agent': first})
+        finally:
+            await stream.aclose()
+        responses = {first: ''.join(tokens) or None}
+        if not tokens:
+            yield 'token', FANOUT_UNAVAILABLE[first]
+        
+        for agent_type, task in tasks.items():
+            responses[agent_type] = await task
+            yield 'token', "\n\n" + (responses[agent_type] or FANOUT_UNAVAILABLE[agent_type]).strip()
+        
+        yield 'done', self._merge(user_message, conversation_history, responses)
+    
+    def _merge(self, user_message, conversation_history, responses):
+        """Apply each agent's state updates in reply order and join their answers
+        
+        `responses` maps agent type to its answer, or None where the agent missed its
+        deadline; those still record what the message itself says (symptoms, insurer,
+        nearby facilities) and are replaced by a short note in the reply.
+        """
+        if not any(responses.values()):
+            raise RuntimeError("None of the agents answered in time")
+        
+        parts = []
+        facilities = None
+        for agent_type in SPECIALISTS:
+            if agent_type not in responses:
+                continue
+            response = responses[agent_type]
+            result = self.agents[agent_type]._complete(user_message, response or '', conversation_history)
+            if agent_type == "facility_recommendation":
+                _, conversation_history, facilities = result
+            else:
+                _, conversation_history = result
+            parts.append((response or FANOUT_UNAVAILABLE[agent_type]).strip())
+        return "\n\n".join(parts), conversation_history, "coordinator", facilities or None
+    
+    def _model_unavailable(self):
+        """True when model calls would be refused: the admission queue is full or the circuit is open"""
+        return ((self.llm.admission is not None and self.llm.admission.saturated)
+                or (self.llm.breaker is not None and self.llm.breaker.is_open))
+    
+    def _rules_reply(self, user_message, conversation_history, reason):
+        """Return the process_message result answered from the local rules alone
+        
+        Used when the model can't be: calls aren't being admitted, the upstream
+        failed, or its circuit is open. What the message says is still recorded
+        (symptoms, insurer), and the nearest suitable facilities come from the
+        facility index when the location is known.
+        """
+        logger.info("Answering from the rules", extra={'reason': str(reason) or type(reason).__name__})
+        _, conversation_history = self.agents['symptom_assessment']._complete(user_message, '', conversation_history)
+        _, conversation_history = self.agents['insurance_verification']._complete(user_message, '', conversation_history)
+        
+        document = (conversation_history.get('insurance_data') or {}).get('document') or {}
+        location_data = conversation_history.get('location_data') or {}
+        latitude = longitude = None
+        if location_data.get('detected'):
+            try:
+                latitude, longitude = float(location_data['latitude']), float(location_data['longitude'])
+            except (KeyError, TypeError, ValueError):
+                pass
+        reply = self.rules.respond(user_message, urgency=RULES_URGENCY.get(conversation_history.get('urgency_level')),
+                                   insurance_type=document.get('plan_type'),
+                                   country=self._user_country(conversation_history),
+                                   latitude=latitude, longitude=longitude)
+        return reply.text, conversation_history, "rules", reply.facilities or None
+    
+    def _stream_rules_reply(self, user_message, conversation_history, reason):
+        """Yield the stream_message events of a rules-only reply"""
+        result = self._rules_reply(user_message, conversation_history, reason)
+        yield 'agent', result[2]
+        yield 'token', result[0]
+        yield 'done', result
+    
+    def _emergency_reply(self, user_message, conversation_history):
+        """Return the process_message result for an emergency, or None
+        
+        The reply is precomputed for the user's country; symptoms and urgency are
+        recorded as the symptom assessment agent would, and the nearest emergency
+        rooms are attached when the location is known.
+        """
+        with metrics.stage('routing'):
+            assessment = self.emergency.assess(user_message)
+        if not assessment.is_emergency:
+            return None
+        
+        logger.info("Emergency detected", extra={'score': assessment.score, 'signals': list(assessment.signals)})
+        response = self.emergency.response_for(self._user_country(conversation_history))
+        response, updated_history = self.agents['symptom_assessment']._complete(user_message, response, conversation_history)
+        updated_history['urgency_level'] = 'emergency'
+        facilities = self.agents['facility_recommendation']._search_nearby_facilities(updated_history) or None
+        return response, updated_history, "emergency", facilities
+    
+    def _stream_emergency(self, user_message, emergency):
+        """Yield the emergency reply at once, then optionally stream the symptom
+        agent's first-aid elaboration after it"""
+        response, updated_history, agent_type, facilities = emergency
+        yield 'agent', agent_type
+        yield 'token', response
+        
+        if EMERGENCY_ELABORATION == 'stream':
+            agent = self.agents['symptom_assessment']
+            messages = agent._prepare_messages(updated_history, user_message)
+            messages.append({"role": "system", "content": EMERGENCY_ELABORATION_PROMPT.format(response=response)})
+            tokens = ["\n\n"]
+            try:
+                for token in agent._stream_openai_api(messages):
+                    if len(tokens) == 1:
+                        yield 'token', tokens[0]
+                    tokens.append(token)
+                    yield 'token', token
+            except Exception as e:
+                # The emergency advice has already been sent; the extra detail is optional
+                logger.warning("Error streaming emergency elaboration: %s", e)
+            if len(tokens) > 1:
+                response += ''.join(tokens)
+        
+        yield 'done', (response, updated_history, agent_type, facilities)
+    
+    async def _astream_emergency(self, user_message, emergency):
+        """_stream_emergency for the async server"""
+        response, updated_history, agent_type, facilities = emergency
+        yield 'agent', agent_type
+        yield 'token', response
+        
+        if EMERGENCY_ELABORATION == 'stream':
+            agent = self.agents['symptom_assessment']
+            messages = await asyncio.to_thread(agent._prepare_messages, updated_history, user_message)
+            messages.append({"role": "system", "content": EMERGENCY_ELABORATION_PROMPT.format(response=response)})
+            tokens = ["\n\n"]
+            try:
+                async for token in agent._astream_openai_api(messages):
+                    if len(tokens) == 1:
+                        yield 'token', tokens[0]
+                    tokens.append(token)
+                    yield 'token', token
+            except Exception as e:
+                logger.warning("Error streaming emergency elaboration: %s", e)
+            if len(tokens) > 1:
+                response += ''.join(tokens)
+        
+        yield 'done', (response, updated_history, agent_type, facilities)
+    
+    def _user_country(self, conversation_history):
+        """The user's country from the location data, or from the nearest known facility"""
+        location_data = conversation_history.get('location_data') or {}
+        if location_data.get('country'):
+            return location_data['country']
+        if location_data.get('detected'):
+            try:
+                nearest = self.agents['facility_recommendation'].facilities.nearest(
+                    float(location_data['latitude']), float(location_data['longitude']), limit=1, radius_km=100)
+            except (KeyError, TypeError, ValueError):
+                return None
+            if nearest:
+                return nearest[0][1].country
+        return None
+    
     def _determine_agent(self, user_message, conversation_history):
         """Determine which agent should handle the current message"""
-        # Check for explicit handoff keywords in the user message
-        symptom_keywords = ['pain', 'hurt', 'sick', 'fever', 'cough', 'headache', 'injury', 'nausea', 'vomiting', 'dizziness', 'symptoms']
-        insurance_keywords = ['insurance', 'coverage', 'plan', 'provider', 'aetna', 'blue cross', 'blue shield', 'cigna', 'humana', 'kaiser', 'medicare', 'medicaid']
-        location_keywords = ['location', 'near me', 'nearby', 'closest', 'address', 'where']
-        facility_keywords = ['hospital', 'clinic', 'doctor', 'emergency room', 'er', 'urgent care', 'facility', 'recommendation']
-        
-        # Check if the message contains keywords for a specific agent
-        if any(keyword in user_message.lower() for keyword in symptom_keywords):
-            return "symptom_assessment"
-        elif any(keyword in user_message.lower() for keyword in insurance_keywords):
-            return "insurance_verification"
-        elif any(keyword in user_message.lower() for keyword in facility_keywords) or \
-             any(keyword in user_message.lower() for keyword in location_keywords):
-            return "facility_recommendation"
+        with metrics.stage('routing'):
+            # A confident intent prediction picks the specialist; a confident
+            # "coordinator" means no specific request, so the conversation state decides
+            intent = self.intents.classify(user_message) if self.intents else None
+            if intent and intent.confidence >= self.intent_threshold:
+                if intent.label != "coordinator":
+                    return intent.label
+            else:
+                agent_type = self._keyword_agent(user_message)
+                if agent_type:
+                    return agent_type
+            
+            return self._next_agent_for_state(conversation_history)
+    
+    @staticmethod
+    def _keyword_agent(user_message):
+        """The agent named by handoff keywords in the message, if any"""
+        agent_types = AgentManager._keyword_agents(user_message)
+        return agent_types[0] if agent_types else None
+    
+    @staticmethod
+    def _keyword_agents(user_message):
+        """Every agent named by handoff keywords in the message, in order of precedence"""
+        # Check for explicit handoff keywords in the user message (one scan for all categories)
+        hits = scan_message(user_message)
         
+        # Check which specific agents the message contains keywords for
+        agent_types = []
+        if 'symptom' in hits or 'symptom_mention' in hits:
+            agent_types.append("symptom_assessment")
+        if 'insurance' in hits:
+            agent_types.append("insurance_verification")
+        if 'facility' in hits or 'location' in hits:
+            agent_types.append("facility_recommendation")
+        return agent_types
+    
+    def _next_agent_for_state(self, conversation_history):
+        """The agent for the next step when the message doesn't ask for one"""
         # If no specific keywords, check the conversation state to determine next steps
         has_symptoms = bool(conversation_history.get('symptom_data', {}))
         has_insurance = bool(conversation_history.get('insurance_data', {}))
@@ -387,26 +906,111 @@ agent_manager = AgentManager()
 def index():
     return render_template('index.html')
 
-# Initialize or get conversation history from session
+# Conversation state lives server-side; the session cookie only carries an opaque id
+conversation_store = create_store()
+register_store_metrics(conversation_store)
+
+# Deletes uploads no conversation needs any more and keeps them within their quotas
+upload_janitor = create_upload_janitor(upload_store, lambda session_id: conversation_store.get(session_id) is not None)
+
+def get_session_id():
+    if 'sid' not in session:
+        session['sid'] = secrets.token_urlsafe(32)
+    return session['sid']
+
+def load_conversation():
+    """Return the stored conversation for this session, or None if there is none"""
+    if 'conversation' not in g:
+        with metrics.stage('session_load'):
+            conversation = conversation_store.get(get_session_id())
+        # Kept to merge against if someone else saves while this request runs
+        g.conversation_base = snapshot(conversation)
+        if conversation is not None:
+            apply_pending_ingestion(conversation)
+        g.conversation = conversation
+    return g.conversation
+
+def save_conversation(conversation):
+    """Write the conversation back to the server-side store
+    
+    Changes saved by other requests since it was loaded are merged in rather than
+    overwritten.
+    """
+    with metrics.stage('session_save'):
+        g.conversation = conversation_store.save(get_session_id(), conversation, base=g.get('conversation_base'))
+        g.conversation_base = snapshot(g.conversation)
+
+def new_conversation():
+    """The state of a conversation that hasn't started yet"""
+    return Conversation.new()
+
+# Initialize or get conversation history from the conversation store
 def get_conversation_history():
-    if 'conversation' not in session:
-        session['conversation'] = {
-            'messages': [],
-            'current_agent': 'coordinator',
-            'symptom_data': {},
-            'insurance_data': {},
-            'location_data': {},
-            'urgency_level': None,
-            'insurance_file': None,
-            'treatment_available': None,
-            'insurance_covers': None
-        }
-    return session['conversation']
+    conversation = load_conversation()
+    if conversation is None:
+        conversation = new_conversation()
+        save_conversation(conversation)
+    return conversation
 
 # Helper function to check if file extension is allowed
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def apply_ingestion_result(conversation, job):
+    """Write a finished ingestion job into the conversation's insurance data
+
+    Returns True if the conversation changed.
+    """
+    insurance_file = conversation.get('insurance_file') or {}
+    insurance_data = conversation.setdefault('insurance_data', {})
+    document = insurance_data.get('document') or {}
+    if (insurance_file.get('job_id') != job['job_id'] or job['status'] not in ('done', 'failed')
+            or document.get('status') in ('done', 'failed')):
+        return False
+    
+    document = {'job_id': job['job_id'], 'status': job['status'], 'error': job['error']}
+    if job['status'] == 'done':
+        document.update(job['result'])
+        # Details found in the document fill in anything the user hasn't told us
+        if document.get('insurer') and not insurance_data.get('provider'):
+            insurance_data['provider'] = document['insurer']
+        if document.get('plan_type') and not insurance_data.get('plan_type'):
+            insurance_data['plan_type'] = document['plan_type']
+        # A card photo also gives the member number and how long the cover lasts
+        policy_number = document.get('policy_number') or document.get('card_number')
+        if policy_number and not insurance_data.get('policy_number'):
+            insurance_data['policy_number'] = policy_number
+        if document.get('valid_until'):
+            insurance_data['valid_until'] = document['valid_until']
+    insurance_data['document'] = document
+    return True
+
+def apply_pending_ingestion(conversation):
+    """Pick up the result of the conversation's ingestion job if it has finished
+    
+    A turn saved while the document was being parsed may have missed the result,
+    so conversations check for it whenever they are loaded.
+    """
+    job_id = (conversation.get('insurance_file') or {}).get('job_id')
+    job = ingestion_jobs.get(job_id) if job_id else None
+    if job is not None:
+        apply_ingestion_result(conversation, job)
+
+def store_ingestion_result(job):
+    """Called from the ingestion pool when a job finishes"""
+    if conversation_store.modify(job['session_id'], lambda conversation: apply_ingestion_result(conversation, job)):
+        logger.info("Insurance document processed", extra={'job_id': job['job_id'], 'status': job['status']})
+
+# Uploaded insurance documents are parsed in a worker pool, off the request thread
+ingestion_jobs = IngestionJobs(on_complete=store_ingestion_result)
+
+# Serializes each session's chat turns and answers duplicate requests once
+turn_coordinator = TurnCoordinator()
+register_turn_metrics(turn_coordinator)
+
+# Tokens of every model call by session, agent and prompt section; None with TOKEN_ACCOUNTING=off
+token_ledger = default_client.ledger
+
 
 def get_analysis(conversation):
     """Generate an analysis of the user's symptoms, urgency, and insurance coverage"""
@@ -456,8 +1060,9 @@ def analyze_treatment_and_coverage(symptoms, urgency_level, insurance_provider):
     insurance_covers = False
     coverage_message = "Your insurance may not cover this treatment. Please verify with your provider."
     
-    # Simple logic for demonstration purposes
-    if insurance_provider and insurance_provider.lower() in ['blue cross blue shield', 'aetna', 'medicare', 'blue cross', 'bluecross']:
+    # Providers known to cover treatment at the recommended facilities
+    provider = coverage_rules.provider(insurance_provider)
+    if provider and provider.covers_recommended_treatment:
         insurance_covers = True
         coverage_message = "Your insurance covers this treatment at the recommended facilities."
     
@@ -473,34 +1078,14 @@ def analyze_treatment_and_coverage(symptoms, urgency_level, insurance_provider):
         "coverage_message": coverage_message
     }
 
-@app.route('/api/chat', methods=['POST'])
-def chat():
-    try:
-        # Get user message from request
-        user_message = request.json.get('message', '')
-        
-        if not user_message:
-            return jsonify({'error': 'No message provided'}), 400
-        
-        # Get conversation history from session
-        conversation_history = get_conversation_history()
-        
-        # Process the message using the agent manager
-        print(f"Processing message with agent manager: {user_message}")
-        
-        # The agent manager will determine which agent to use and process the message
-        response, updated_history, agent_type, facilities = agent_manager.process_message(user_message, conversation_history)
-        
-        # Update session with the updated conversation history
-        session['conversation'] = updated_history
-        
-        # Log the current state for debugging
-        print(f"Current agent: {agent_type}")
-        print(f"Urgency level: {updated_history.get('urgency_level')}")
-        print(f"Has symptom data: {bool(updated_history.get('symptom_data'))}")
-        print(f"Has insurance data: {bool(updated_history.get('insurance_data') or updated_history.get('insurance_file'))}")
-        print(f"Has location data: {bool(updated_history.get('location_data'))}")
-        
+def complete_turn(user_message, response, updated_history, agent_type, facilities):
+    """Record the exchange and run the post-processing shared by JSON and streamed replies
+    
+    Returns the analysis message to append to the reply (empty if there is none),
+    the recommended facilities and the treatment/coverage analysis. The caller
+    saves the updated conversation.
+    """
+    with metrics.stage('postprocess'):
         # Add the exchange to the conversation history if not already there
         if user_message and (not updated_history['messages'] or 
                             updated_history['messages'][-1]['role'] != 'user' or 
@@ -509,68 +1094,189 @@ def chat():
         
         # Add the assistant's response to the conversation history
         updated_history['messages'].append({"role": "assistant", "content": response})
-        session['conversation'] = updated_history
         
         # If we have facilities (from facility recommendation agent) or all necessary data, include facility suggestions
-        if facilities or (agent_type == 'facility_recommendation' or 
+        if not (facilities or (agent_type == 'facility_recommendation' or 
             (updated_history.get('symptom_data') and 
              (updated_history.get('insurance_data') or updated_history.get('insurance_file')) and 
-             updated_history.get('location_data'))):
-            
-            # If we don't have facilities yet but have all the necessary data, search for them
-            if not facilities:
-                # Get relevant data for facility search
-                location = updated_history.get('location_data', {})
-                urgency_level = updated_history.get('urgency_level')
-                insurance_provider = updated_history.get('insurance_data', {}).get('provider')
+             updated_history.get('location_data')))):
+            return '', facilities, None
+        
+        # If we don't have facilities yet but have all the necessary data, search for them
+        if not facilities:
+            facility_agent = agent_manager.agents['facility_recommendation']
+            facilities = facility_agent._search_nearby_facilities(updated_history)
+        
+        # Analyze if symptoms can be treated and covered by insurance
+        symptoms = updated_history.get('symptom_data', {})
+        urgency_level = updated_history.get('urgency_level')
+        insurance_provider = updated_history.get('insurance_data', {}).get('provider')
+        analysis = analyze_treatment_and_coverage(symptoms, urgency_level, insurance_provider)
+        
+        # Store analysis results in conversation history
+        updated_history['treatment_available'] = analysis['treatment_available']
+        updated_history['insurance_covers'] = analysis['insurance_covers']
+        
+        # Add a message about the analysis to the assistant's response
+        analysis_message = f"\n\nBased on your symptoms and information, I've analyzed your situation:\n"
+        analysis_message += f"- {analysis['treatment_message']}\n"
+        analysis_message += f"- {analysis['coverage_message']}\n"
+        
+        if facilities:
+            analysis_message += f"\nHere are some recommended facilities that can help you."
+        
+        return analysis_message, facilities, analysis
+
+def sse_event(event, data):
+    """Format a Server-Sent Event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def turn_result(response, agent_type, analysis_message, facilities, analysis):
+    """Everything needed to answer a chat request, kept to answer its duplicates too"""
+    return {
+        'response': response,
+        'agent': agent_type,
+        'analysis_message': analysis_message,
+        'facilities': facilities,
+        'analysis': analysis
+    }
+
+def chat_payload(turn):
+    """The JSON body and headers of a /api/chat reply for a finished turn"""
+    result = turn.result
+    payload = {'reply': result['response'] + result['analysis_message'], 'agent': result['agent']}
+    if result['analysis_message']:
+        payload['facilities'] = result['facilities']
+        payload['analysis'] = result['analysis']
+    payload['idempotency_key'] = turn.key
+    headers = {'Idempotency-Key': turn.key}
+    if turn.shared:
+        headers['Idempotent-Replayed'] = 'true'
+    return payload, headers
+
+def shared_turn_events(result):
+    """Replay a finished turn as the events a streamed reply would have sent"""
+    yield sse_event('agent', {'agent': result['agent']})
+    yield sse_event('token', {'text': result['response']})
+    if result['analysis_message']:
+        yield sse_event('analysis', {'text': result['analysis_message'], 'analysis': result['analysis']})
+    if result['facilities']:
+        yield sse_event('facilities', {'facilities': result['facilities']})
+    yield sse_event('done', {'agent': result['agent']})
+
+def idempotency_key_for(headers, request_data):
+    """The client's idempotency key for a chat request, or a new one to hand back"""
+    key = headers.get('Idempotency-Key') or request_data.get('idempotency_key')
+    return str(key)[:128] if key else new_idempotency_key()
+
+def stream_chat(user_message, session_id, idempotency_key):
+    """Stream the reply as Server-Sent Events
+    
+    Emits an 'agent' event once routing is done, 'token' events as the model
+    generates text, then 'analysis' and 'facilities' events for the post-processing
+    blocks and a final 'done' (or 'error') event. A duplicate of a request in
+    flight or already answered gets the same reply in one go.
+    """
+    def generate():
+        try:
+            with turn_coordinator.turn(session_id, user_message, idempotency_key) as turn:
+                if turn.shared:
+                    yield from shared_turn_events(turn.result)
+                    return
                 
-                # Use the facility recommendation agent to search for facilities
-                facility_agent = agent_manager.agents['facility_recommendation']
-                _, _, facilities = facility_agent._search_nearby_facilities(updated_history)
-            
-            # Analyze if symptoms can be treated and covered by insurance
-            symptoms = updated_history.get('symptom_data', {})
-            urgency_level = updated_history.get('urgency_level')
-            insurance_provider = updated_history.get('insurance_data', {}).get('provider')
-            analysis = analyze_treatment_and_coverage(symptoms, urgency_level, insurance_provider)
-            
-            # Store analysis results in conversation history
-            updated_history['treatment_available'] = analysis['treatment_available']
-            updated_history['insurance_covers'] = analysis['insurance_covers']
-            session['conversation'] = updated_history
-            
-            # Add a message about the analysis to the assistant's response
-            analysis_message = f"\n\nBased on your symptoms and information, I've analyzed your situation:\n"
-            analysis_message += f"- {analysis['treatment_message']}\n"
-            analysis_message += f"- {analysis['coverage_message']}\n"
-            
-            if facilities:
-                analysis_message += f"\nHere are some recommended facilities that can help you."
-            
-            # Combine the original message with the analysis message
-            combined_message = response + analysis_message
-            
-            return jsonify({
-                'reply': combined_message,
-                'facilities': facilities,
-                'analysis': analysis
-            })
+                with metrics.turn(stream=True) as timings:
+                    # Loaded once the session's previous turn has been saved
+                    conversation_history = get_conversation_history()
+                    with tenant_scope(tenant_for(request.headers, session_id)), session_scope(session_id):
+                        for kind, value in agent_manager.stream_message(user_message, conversation_history):
+                            if kind == 'agent':
+                                yield sse_event('agent', {'agent': value})
+                            elif kind == 'token':
+                                yield sse_event('token', {'text': value})
+                            else:
+                                response, updated_history, agent_type, facilities = value
+                    timings.agent = agent_type
+                    
+                    analysis_message, facilities, analysis = complete_turn(
+                        user_message, response, updated_history, agent_type, facilities)
+                    save_conversation(updated_history)
+                turn.result = turn_result(response, agent_type, analysis_message, facilities, analysis)
+                
+                if analysis_message:
+                    yield sse_event('analysis', {'text': analysis_message, 'analysis': analysis})
+                if facilities:
+                    yield sse_event('facilities', {'facilities': facilities})
+                yield sse_event('done', {'agent': agent_type})
         
-        return jsonify({
-            'reply': response
-        })
+        except Exception as e:
+            logger.exception("Error in /api/chat stream: %s", e)
+            yield sse_event('error', {'error': str(e)})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no',
+                             'Idempotency-Key': idempotency_key})
+
+@app.route('/api/chat', methods=['POST'])
+def chat():
+    try:
+        # Get user message from request
+        user_message = request.json.get('message', '')
+        
+        if not user_message:
+            return jsonify({'error': 'No message provided'}), 400
+        
+        # Retries of this request carry the same key and get the same reply
+        idempotency_key = idempotency_key_for(request.headers, request.json)
+        # Assigned now so a new session's cookie goes out before a streamed reply starts
+        session_id = get_session_id()
+        
+        # Stream tokens as they arrive if the client asked for it
+        if request.json.get('stream') or request.accept_mimetypes.best == 'text/event-stream':
+            return stream_chat(user_message, session_id, idempotency_key)
+        
+        # Turns of one session run one at a time; duplicates share the first one's reply
+        with turn_coordinator.turn(session_id, user_message, idempotency_key) as turn:
+            if not turn.shared:
+                with metrics.turn(stream=False) as timings:
+                    # Get conversation history from the conversation store
+                    conversation_history = get_conversation_history()
+                    
+                    # The agent manager will determine which agent to use and process the message;
+                    # its model calls count against this session's (or tenant's) admission limit
+                    with tenant_scope(tenant_for(request.headers, session_id)), session_scope(session_id):
+                        response, updated_history, agent_type, facilities = agent_manager.process_message(user_message, conversation_history)
+                    timings.agent = agent_type
+                    
+                    # Log the conversation state for debugging
+                    logger.debug("Conversation state", extra={
+                        'agent': agent_type,
+                        'urgency_level': updated_history.get('urgency_level'),
+                        'has_symptom_data': bool(updated_history.get('symptom_data')),
+                        'has_insurance_data': bool(updated_history.get('insurance_data') or updated_history.get('insurance_file')),
+                        'has_location_data': bool(updated_history.get('location_data'))
+                    })
+                    
+                    analysis_message, facilities, analysis = complete_turn(
+                        user_message, response, updated_history, agent_type, facilities)
+                    
+                    # Save the updated conversation history
+                    save_conversation(updated_history)
+                turn.result = turn_result(response, agent_type, analysis_message, facilities, analysis)
+        
+        payload, headers = chat_payload(turn)
+        return jsonify(payload), 200, headers
     
     except Exception as e:
-        print(f"Error in /api/chat: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in /api/chat: %s", e)
         return jsonify({'error': str(e)}), 500
 
 # Route to reset the conversation
 @app.route('/api/reset', methods=['POST'])
 def reset_conversation():
-    if 'conversation' in session:
-        session.pop('conversation')
+    conversation_store.delete(get_session_id())
+    upload_store.release(get_session_id())
+    g.pop('conversation', None)
+    g.pop('conversation_base', None)
     return jsonify({'status': 'success', 'message': 'Conversation reset successfully'})
 
 # Route to get insurance information (placeholder for actual database/API integration)
@@ -578,76 +1284,55 @@ def reset_conversation():
 def get_insurance_info():
     insurance_provider = request.args.get('provider', '')
     
-    # This would typically query a database or external API
-    # For now, return placeholder data
-    insurance_data = {
-        "blue_cross": {
-            "name": "Blue Cross Blue Shield",
-            "coverage": ["Emergency Room", "Urgent Care", "Primary Care"],
-            "network_restrictions": "In-network providers only for non-emergency care"
-        },
-        "aetna": {
-            "name": "Aetna",
-            "coverage": ["Emergency Room", "Urgent Care", "Primary Care", "Telehealth"],
-            "network_restrictions": "Preferred rates with in-network providers"
-        },
-        "medicare": {
-            "name": "Medicare",
-            "coverage": ["Emergency Room", "Hospital Care", "Primary Care"],
-            "network_restrictions": "Must accept Medicare assignment"
-        }
-    }
-    
-    if insurance_provider.lower() in insurance_data:
-        return jsonify(insurance_data[insurance_provider.lower()])
+    # Provider details come from the coverage rules loaded at startup
+    provider = coverage_rules.provider(insurance_provider)
+    if provider:
+        return jsonify(provider.to_dict())
     else:
         return jsonify({
             "name": "Unknown Provider",
             "message": "Please provide more details about your insurance for accurate information."
         })
 
+def location_data_from(data):
+    """The location data to store for a /api/location payload, or None if it is invalid"""
+    if not data or 'latitude' not in data or 'longitude' not in data:
+        return None
+    
+    location_data = {
+        'latitude': data['latitude'],
+        'longitude': data['longitude'],
+        'detected': True
+    }
+    
+    # City and country are optional; the country picks the emergency number
+    for key in ('city', 'country'):
+        if data.get(key):
+            location_data[key] = data[key]
+    return location_data
+
 # Route to handle location data
 @app.route('/api/location', methods=['POST'])
 def update_location():
-    print("Location API endpoint called")
     try:
         data = request.json
-        print(f"Received location data: {data}")
         
-        if not data or 'latitude' not in data or 'longitude' not in data:
-            print("Error: Invalid location data received")
+        location_data = location_data_from(data)
+        if location_data is None:
+            logger.info("Invalid location data received")
             return jsonify({'error': 'Invalid location data'}), 400
         
         # Initialize conversation history if it doesn't exist
-        conversation_history = session.get('conversation', {})
-        if not conversation_history:
-            conversation_history = {
-                'messages': [],
-                'symptom_data': {},
-                'insurance_data': {},
-                'location_data': {}
-            }
-        
-        # Store location data in session
-        location_data = {
-            'latitude': data['latitude'],
-            'longitude': data['longitude'],
-            'detected': True
-        }
+        conversation_history = load_conversation() or new_conversation()
         
-        # Update the conversation history with location data
+        # Update the conversation history with location data; agents receive it as a
+        # prompt fact, so no synthetic message is added to the history
         conversation_history['location_data'] = location_data
         
-        # Add a message about the location being shared
-        location_message = f"I've shared my location: {data['latitude']}, {data['longitude']}"
-        conversation_history['messages'].append({
-            'role': 'user',
-            'content': location_message
-        })
-        
-        # Save updated conversation history to session
-        session['conversation'] = conversation_history
-        print(f"Location data stored in session: {location_data}")
+        # Save updated conversation history to the conversation store
+        save_conversation(conversation_history)
+        logger.debug("Location data stored in conversation", extra={'has_city': 'city' in location_data,
+                                                                    'has_country': 'country' in location_data})
         
         return jsonify({
             'status': 'success', 
@@ -656,95 +1341,222 @@ def update_location():
             'longitude': data['longitude']
         }), 200
     except Exception as e:
-        print(f"Error in update_location: {str(e)}")
+        logger.exception("Error in update_location: %s", e)
         return jsonify({'error': str(e)}), 500
 
+def record_insurance_upload(conversation_history, session_id, filename, stored, job_id):
+    """Note the uploaded document and its ingestion job in the conversation
+    
+    The session lets go of the document it uploaded before, if any. A document
+    ingested earlier (by anyone) has its result recorded at once.
+    """
+    previous = (conversation_history.get('insurance_file') or {}).get('sha256')
+    if previous and previous != stored['sha256']:
+        upload_store.release(session_id, previous)
+    
+    conversation_history['insurance_file'] = {
+        'filename': filename,       # Original filename for display
+        'path': stored['path'],     # Server path for processing
+        'sha256': stored['sha256'],
+        'uploaded_at': datetime.now().strftime('%Y%m%d%H%M%S'),
+        'job_id': job_id
+    }
+    
+    conversation_history['insurance_data'] = conversation_history.get('insurance_data', {})
+    conversation_history['insurance_data']['file_uploaded'] = True
+    conversation_history['insurance_data']['document'] = {'job_id': job_id, 'status': 'queued'}
+    apply_pending_ingestion(conversation_history)
+
+def store_upload(file, session_id):
+    """Store an uploaded file, referenced by the session, and queue its ingestion
+    
+    Returns what the store recorded (digest, path, size, whether the content was
+    already there) and the ingestion job id. Raises QuotaExceeded if the upload
+    would take the session or the store over its quota.
+    """
+    filename = secure_filename(file.filename)
+    if upload_janitor is not None:
+        upload_janitor.admit(session_id, file.stream)
+    stored = upload_store.put(file.stream, filename)
+    upload_store.add_ref(session_id, stored['sha256'])
+    
+    # Extract the insurer, plan and coverage clauses in the background, unless
+    # the same document was processed before
+    job_id = ingestion_jobs.submit(session_id, stored['path'], filename)
+    logger.info("Insurance document queued for ingestion", extra={
+        'job_id': job_id, 'content_type': file.content_type, 'bytes': stored['size'],
+        'deduplicated': stored['deduplicated']})
+    return filename, stored, job_id
+
+def quota_status(error):
+    """413 for an upload over its conversation's quota, 507 while the store is full"""
+    return 413 if error.quota == 'session' else 507
+
+def upload_reply(filename, stored, job_id, conversation_history):
+    """The JSON body of a successful /api/upload_insurance reply"""
+    return {
+        'status': 'success',
+        'message': 'Insurance file uploaded successfully',
+        'filename': filename,
+        'job_id': job_id,
+        'ingestion_status': conversation_history['insurance_data']['document']['status'],
+        'deduplicated': stored['deduplicated']
+    }
+
 # Route to handle insurance file upload
 @app.route('/api/upload_insurance', methods=['POST'])
 def upload_insurance():
-    print("Insurance upload endpoint called")
-    print("Request files:", request.files)
-    
     try:
         if 'file' not in request.files:
-            print("Error: No file part in the request")
+            logger.info("Insurance upload without a file part")
             return jsonify({'error': 'No file part'}), 400
             
         file = request.files['file']
-        print(f"Received file: {file.filename}, type: {file.content_type}")
         
         if file.filename == '':
-            print("Error: Empty filename")
+            logger.info("Insurance upload with an empty filename")
             return jsonify({'error': 'No selected file'}), 400
             
         if file and allowed_file(file.filename):
-            # Generate a secure filename with timestamp to avoid collisions
-            filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            unique_filename = f"{timestamp}_{uuid.uuid4().hex}_{filename}"
-            print(f"Secured filename: {unique_filename}")
-            
-            # Save the file
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(file_path)
-            print(f"File saved to: {file_path}")
+            # The file was streamed to disk and hashed as it arrived; it is stored once per content
+            filename, stored, job_id = store_upload(file, get_session_id())
             
             # Update conversation history with insurance file info
             conversation_history = get_conversation_history()
-            conversation_history['insurance_file'] = {
-                'filename': filename,  # Original filename for display
-                'path': file_path,     # Server path for processing
-                'uploaded_at': timestamp
-            }
-            
-            # In a real application, you might extract insurance details from the file
-            # For now, just acknowledge the upload
-            conversation_history['insurance_data'] = conversation_history.get('insurance_data', {})
-            conversation_history['insurance_data']['file_uploaded'] = True
-            session['conversation'] = conversation_history
-            print(f"Insurance file stored in session: {filename}")
+            record_insurance_upload(conversation_history, get_session_id(), filename, stored, job_id)
+            save_conversation(conversation_history)
             
-            return jsonify({
-                'status': 'success',
-                'message': 'Insurance file uploaded successfully',
-                'filename': filename
-            })
+            reply = upload_reply(filename, stored, job_id, conversation_history)
+            return jsonify(reply), 202 if reply['ingestion_status'] == 'queued' else 200
         
-        print(f"Error: File type not allowed for {file.filename}")
+        logger.info("Insurance upload of a file type that isn't allowed", extra={'content_type': file.content_type})
         return jsonify({'error': 'File type not allowed'}), 400
     
+    except QuotaExceeded as e:
+        logger.warning("Insurance upload refused: %s", e, extra={'quota': e.quota})
+        return jsonify({'error': str(e)}), quota_status(e)
     except Exception as e:
-        print(f"Error in upload_insurance: {str(e)}")
+        logger.exception("Error in upload_insurance: %s", e)
         return jsonify({'error': str(e)}), 500
 
+def ingestion_job_status(job_id, session_id):
+    """The status of a session's ingestion job while the job is still kept, else None"""
+    job = ingestion_jobs.get(job_id)
+    if job is None or job['session_id'] != session_id:
+        return None
+    return {
+        'job_id': job_id,
+        'status': job['status'],
+        'filename': job['filename'],
+        'result': job['result'],
+        'error': job['error']
+    }
+
+def stored_ingestion_status(job_id, conversation):
+    """The status of an ingestion job as recorded in the conversation, or None"""
+    # Jobs are kept in memory for a while; after that the result lives in the conversation
+    conversation = conversation or {}
+    document = (conversation.get('insurance_data') or {}).get('document') or {}
+    if document.get('job_id') != job_id:
+        return None
+    result = {k: v for k, v in document.items() if k not in ('job_id', 'status', 'error')}
+    return {
+        'job_id': job_id,
+        'status': document.get('status'),
+        'filename': (conversation.get('insurance_file') or {}).get('filename'),
+        'result': result or None,
+        'error': document.get('error')
+    }
+
+# Route to poll the ingestion of an uploaded insurance document
+@app.route('/api/upload_insurance/<job_id>', methods=['GET'])
+def insurance_upload_status(job_id):
+    status = ingestion_job_status(job_id, get_session_id()) or stored_ingestion_status(job_id, load_conversation())
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(status)
+
+def refresh_analysis(conversation_history):
+    """Run the treatment and coverage analysis and store its result in the conversation
+    
+    Returns None when no symptoms have been reported yet.
+    """
+    # Check if we have the necessary data
+    if not conversation_history.get('symptom_data'):
+        return None
+        
+    # Get relevant data
+    symptoms = conversation_history.get('symptom_data', {})
+    urgency_level = conversation_history.get('urgency_level')
+    insurance_provider = conversation_history.get('insurance_data', {}).get('provider')
+    
+    # Perform analysis
+    analysis = analyze_treatment_and_coverage(symptoms, urgency_level, insurance_provider)
+    
+    # Store analysis results in conversation history
+    conversation_history['treatment_available'] = analysis['treatment_available']
+    conversation_history['insurance_covers'] = analysis['insurance_covers']
+    return analysis
+
 # Route to get treatment and coverage analysis
 @app.route('/api/analysis', methods=['GET'])
 def get_analysis():
     try:
         conversation_history = get_conversation_history()
-        
-        # Check if we have the necessary data
-        if not conversation_history.get('symptom_data'):
+        analysis = refresh_analysis(conversation_history)
+        if analysis is None:
             return jsonify({'error': 'No symptom data available'}), 400
-            
-        # Get relevant data
-        symptoms = conversation_history.get('symptom_data', {})
-        urgency_level = conversation_history.get('urgency_level')
-        insurance_provider = conversation_history.get('insurance_data', {}).get('provider')
-        
-        # Perform analysis
-        analysis = analyze_treatment_and_coverage(symptoms, urgency_level, insurance_provider)
-        
-        # Store analysis results in conversation history
-        conversation_history['treatment_available'] = analysis['treatment_available']
-        conversation_history['insurance_covers'] = analysis['insurance_covers']
-        session['conversation'] = conversation_history
+        save_conversation(conversation_history)
         
         return jsonify(analysis)
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Tokens this session's model calls used, by agent and prompt section
+@app.route('/api/token_usage', methods=['GET'])
+def get_token_usage():
+    if token_ledger is None:
+        return jsonify({'error': 'Token accounting is off'}), 404
+    return jsonify(token_ledger.session_usage(get_session_id()))
+
+# The heaviest sessions (by a hash of their id) and the tokens per agent and prompt section;
+# for operators only
+@app.route('/api/token_usage/report', methods=['GET'])
+def get_token_report():
+    refused = metrics.operator_refusal(request.headers.get('Authorization'))
+    if refused:
+        return jsonify({'error': 'This report needs the operator token'}), refused
+    if token_ledger is None:
+        return jsonify({'error': 'Token accounting is off'}), 404
+    return jsonify(token_ledger.report(request.args.get('limit', 10, type=int)))
+
+# Bytes held by the upload store and what the janitor has reclaimed; for operators only
+@app.route('/api/uploads/stats', methods=['GET'])
+def get_upload_stats():
+    refused = metrics.operator_refusal(request.headers.get('Authorization'))
+    if refused:
+        return jsonify({'error': 'This report needs the operator token'}), refused
+    if upload_janitor is None:
+        return jsonify({'error': 'The upload janitor is off'}), 404
+    return jsonify(upload_janitor.stats())
+
+# Per-stage turn latencies, model calls and tokens, cache hits and the agents chosen,
+# in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    metrics.observe_request(request.url_rule and request.url_rule.rule, request.method, response.status_code,
+                            time.perf_counter() - g.get('request_started', time.perf_counter()))
+    return response
+
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))  # Render gives a PORT variable
@@ -0,0 +1,321 @@
+"""Async (ASGI) serving mode for Nurse Ally
+
+The same API as app.py, served by Quart: every view is a coroutine and the model
+calls are awaited, so a conversation waiting on the model holds no thread and one
+process can keep hundreds of them in flight. Agents, the conversation store and the
+ingestion pool are shared with app.py, and session cookies are interchangeable.
+
+Run in production with:  hypercorn --config file:hypercorn_config.py asgi:app
+"""
+import os
+import asyncio
+import time
+import secrets
+import logging
+from quart import Quart, Request, Response, g, request, jsonify, render_template, session, stream_with_context
+
+import metrics
+from llm_client import default_client
+from turn_coordinator import AsyncTurnCoordinator, register_metrics as register_turn_metrics
+from admission import tenant_for, current_tenant
+from token_accounting import current_session
+from conversation_state import snapshot
+from upload_janitor import QuotaExceeded
+from app import (agent_manager, conversation_store, coverage_rules, UPLOAD_FOLDER, new_conversation,
+                 allowed_file, apply_pending_ingestion, complete_turn, turn_result, chat_payload, shared_turn_events,
+                 idempotency_key_for, location_data_from, upload_store, upload_janitor, store_upload, quota_status,
+                 record_insurance_upload, upload_reply, ingestion_job_status, stored_ingestion_status,
+                 refresh_analysis, sse_event, token_ledger)
+
+logger = logging.getLogger(__name__)
+
+app = Quart(__name__)
+app.secret_key = os.getenv("SECRET_KEY", "nurse-ally-secret-key")
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
+
+
+class UploadRequest(Request):
+    """Streams uploaded files straight into the upload store, like app.UploadRequest"""
+
+    def make_form_data_parser(self):
+        return self.form_data_parser_class(stream_factory=self._get_file_stream,
+                                           max_content_length=self.max_content_length,
+                                           cls=self.parameter_storage_class)
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return upload_store.temp_file()
+
+
+app.request_class = UploadRequest
+
+# Serializes each session's chat turns and answers duplicate requests once
+turn_coordinator = AsyncTurnCoordinator()
+register_turn_metrics(turn_coordinator)
+
+
+@app.after_serving
+async def close_llm_pool():
+    await default_client.aclose()
+
+
+@app.route('/')
+async def index():
+    return await render_template('index.html')
+
+
+def get_session_id():
+    if 'sid' not in session:
+        session['sid'] = secrets.token_urlsafe(32)
+    return session['sid']
+
+# The conversation store may be on disk or across the network, so its calls run on
+# worker threads rather than in the event loop
+
+async def load_conversation():
+    """Return the stored conversation for this session, or None if there is none"""
+    if 'conversation' not in g:
+        with metrics.stage('session_load'):
+            conversation = await asyncio.to_thread(conversation_store.get, get_session_id())
+            g.conversation_base = snapshot(conversation)
+        if conversation is not None:
+            apply_pending_ingestion(conversation)
+        g.conversation = conversation
+    return g.conversation
+
+async def save_conversation(conversation):
+    """Write the conversation back to the server-side store, merging concurrent changes"""
+    with metrics.stage('session_save'):
+        g.conversation = await asyncio.to_thread(conversation_store.save, get_session_id(), conversation,
+                                                 g.get('conversation_base'))
+        g.conversation_base = snapshot(g.conversation)
+
+async def get_conversation_history():
+    conversation = await load_conversation()
+    if conversation is None:
+        conversation = new_conversation()
+        await save_conversation(conversation)
+    return conversation
+
+
+def stream_chat(user_message, session_id, idempotency_key, tenant):
+    """Stream the reply as Server-Sent Events, like app.stream_chat"""
+    @stream_with_context
+    async def generate():
+        try:
+            async with turn_coordinator.turn(session_id, user_message, idempotency_key) as turn:
+                if turn.shared:
+                    for event in shared_turn_events(turn.result):
+                        yield event
+                    return
+                current_tenant.set(tenant)
+                current_session.set(session_id)
+
+                with metrics.turn(stream=True) as timings:
+                    conversation_history = await get_conversation_history()
+                    async for kind, value in agent_manager.astream_message(user_message, conversation_history):
+                        if kind == 'agent':
+                            yield sse_event('agent', {'agent': value})
+                        elif kind == 'token':
+                            yield sse_event('token', {'text': value})
+                        else:
+                            response, updated_history, agent_type, facilities = value
+                    timings.agent = agent_type
+
+                    analysis_message, facilities, analysis = complete_turn(
+                        user_message, response, updated_history, agent_type, facilities)
+                    await save_conversation(updated_history)
+                turn.result = turn_result(response, agent_type, analysis_message, facilities, analysis)
+
+                if analysis_message:
+                    yield sse_event('analysis', {'text': analysis_message, 'analysis': analysis})
+                if facilities:
+                    yield sse_event('facilities', {'facilities': facilities})
+                yield sse_event('done', {'agent': agent_type})
+
+        except Exception as e:
+            logger.exception("Error in /api/chat stream: %s", e)
+            yield sse_event('error', {'error': str(e)})
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no',
+                                 'Idempotency-Key': idempotency_key})
+    # A streamed reply lasts as long as the model takes; the LLM client's deadline bounds it
+    response.timeout = None
+    return response
+
+@app.route('/api/chat', methods=['POST'])
+async def chat():
+    try:
+        data = await request.get_json(silent=True) or {}
+        user_message = data.get('message', '')
+
+        if not user_message:
+            return jsonify({'error': 'No message provided'}), 400
+
+        idempotency_key = idempotency_key_for(request.headers, data)
+        session_id = get_session_id()
+        # Every request runs in its own task, so the tenant and session set here go no further
+        tenant = tenant_for(request.headers, session_id)
+
+        if data.get('stream') or request.accept_mimetypes.best == 'text/event-stream':
+            return stream_chat(user_message, session_id, idempotency_key, tenant)
+
+        current_tenant.set(tenant)
+        current_session.set(session_id)
+
+        async with turn_coordinator.turn(session_id, user_message, idempotency_key) as turn:
+            if not turn.shared:
+                with metrics.turn(stream=False) as timings:
+                    conversation_history = await get_conversation_history()
+                    response, updated_history, agent_type, facilities = await agent_manager.aprocess_message(
+                        user_message, conversation_history)
+                    timings.agent = agent_type
+
+                    analysis_message, facilities, analysis = complete_turn(
+                        user_message, response, updated_history, agent_type, facilities)
+                    await save_conversation(updated_history)
+                turn.result = turn_result(response, agent_type, analysis_message, facilities, analysis)
+
+        payload, headers = chat_payload(turn)
+        return jsonify(payload), 200, headers
+
+    except Exception as e:
+        logger.exception("Error in /api/chat: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/reset', methods=['POST'])
+async def reset_conversation():
+    await asyncio.to_thread(conversation_store.delete, get_session_id())
+    await asyncio.to_thread(upload_store.release, get_session_id())
+    g.pop('conversation', None)
+    g.pop('conversation_base', None)
+    return jsonify({'status': 'success', 'message': 'Conversation reset successfully'})
+
+@app.route('/api/insurance_info', methods=['GET'])
+async def get_insurance_info():
+    provider = coverage_rules.provider(request.args.get('provider', ''))
+    if provider:
+        return jsonify(provider.to_dict())
+    return jsonify({
+        "name": "Unknown Provider",
+        "message": "Please provide more details about your insurance for accurate information."
+    })
+
+@app.route('/api/location', methods=['POST'])
+async def update_location():
+    try:
+        data = await request.get_json(silent=True)
+        location_data = location_data_from(data)
+        if location_data is None:
+            return jsonify({'error': 'Invalid location data'}), 400
+
+        conversation_history = await load_conversation() or new_conversation()
+        conversation_history['location_data'] = location_data
+        await save_conversation(conversation_history)
+
+        return jsonify({
+            'status': 'success',
+            'message': 'Location updated successfully',
+            'latitude': data['latitude'],
+            'longitude': data['longitude']
+        }), 200
+    except Exception as e:
+        logger.exception("Error in update_location: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/upload_insurance', methods=['POST'])
+async def upload_insurance():
+    try:
+        files = await request.files
+        if 'file' not in files:
+            return jsonify({'error': 'No file part'}), 400
+
+        file = files['file']
+        if file.filename == '':
+            return jsonify({'error': 'No selected file'}), 400
+
+        if file and allowed_file(file.filename):
+            filename, stored, job_id = await asyncio.to_thread(store_upload, file, get_session_id())
+
+            conversation_history = await get_conversation_history()
+            record_insurance_upload(conversation_history, get_session_id(), filename, stored, job_id)
+            await save_conversation(conversation_history)
+
+            reply = upload_reply(filename, stored, job_id, conversation_history)
+            return jsonify(reply), 202 if reply['ingestion_status'] == 'queued' else 200
+
+        return jsonify({'error': 'File type not allowed'}), 400
+
+    except QuotaExceeded as e:
+        logger.warning("Insurance upload refused: %s", e, extra={'quota': e.quota})
+        return jsonify({'error': str(e)}), quota_status(e)
+    except Exception as e:
+        logger.exception("Error in upload_insurance: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/upload_insurance/<job_id>', methods=['GET'])
+async def insurance_upload_status(job_id):
+    status = ingestion_job_status(job_id, get_session_id())
+    if status is None:
+        status = stored_ingestion_status(job_id, await load_conversation())
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(status)
+
+@app.route('/api/analysis', methods=['GET'])
+async def get_analysis():
+    try:
+        conversation_history = await get_conversation_history()
+        analysis = refresh_analysis(conversation_history)
+        if analysis is None:
+            return jsonify({'error': 'No symptom data available'}), 400
+        await save_conversation(conversation_history)
+
+        return jsonify(analysis)
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/token_usage', methods=['GET'])
+async def get_token_usage():
+    if token_ledger is None:
+        return jsonify({'error': 'Token accounting is off'}), 404
+    return jsonify(token_ledger.session_usage(get_session_id()))
+
+@app.route('/api/token_usage/report', methods=['GET'])
+async def get_token_report():
+    refused = metrics.operator_refusal(request.headers.get('Authorization'))
+    if refused:
+        return jsonify({'error': 'This report needs the operator token'}), refused
+    if token_ledger is None:
+        return jsonify({'error': 'Token accounting is off'}), 404
+    return jsonify(token_ledger.report(request.args.get('limit', 10, type=int)))
+
+@app.route('/api/uploads/stats', methods=['GET'])
+async def get_upload_stats():
+    refused = metrics.operator_refusal(request.headers.get('Authorization'))
+    if refused:
+        return jsonify({'error': 'This report needs the operator token'}), refused
+    if upload_janitor is None:
+        return jsonify({'error': 'The upload janitor is off'}), 404
+    return jsonify(await asyncio.to_thread(upload_janitor.stats))
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+async def record_request(response):
+    metrics.observe_request(request.url_rule and request.url_rule.rule, request.method, response.status_code,
+                            time.perf_counter() - g.get('request_started', time.perf_counter()))
+    return response
+
+
+if __name__ == '__main__':
+    # Quart's development server; use hypercorn (see hypercorn_config.py) in production
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,118 @@
+"""Offline accuracy, calibration and latency benchmark for the intent classifier
+
+Runs k-fold cross-validation over the bundled examples (data/intents.tsv) and
+compares the classifier, the keyword rules it replaces and the combined router
+(classifier above the confidence threshold, rules below it).
+
+Usage: python benchmarks/intent_classifier.py [--folds 5] [--threshold 0.6]
+"""
+import os
+import sys
+import time
+import zlib
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from intent_classifier import DEFAULT_CONFIDENCE_THRESHOLD, load_examples, train_classifier
+from app import AgentManager
+from report import percentile
+
+
+def rules_label(text):
+    # Messages without handoff keywords are left to the conversation state, which
+    # is what the coordinator label stands for
+    return AgentManager._keyword_agent(text) or "coordinator"
+
+
+def expected_calibration_error(predictions, bins=10):
+    """Average gap between confidence and accuracy, weighted by bin size"""
+    total = len(predictions)
+    error = 0.0
+    for b in range(bins):
+        low, high = b / bins, (b + 1) / bins
+        in_bin = [(conf, ok) for conf, ok in predictions if low < conf <= high or (b == 0 and conf == 0)]
+        if in_bin:
+            accuracy = sum(ok for _, ok in in_bin) / len(in_bin)
+            confidence = sum(conf for conf, _ in in_bin) / len(in_bin)
+            error += len(in_bin) / total * abs(accuracy - confidence)
+    return error
+
+
+def cross_validate(examples, folds, threshold):
+    results = {'classifier': 0, 'rules': 0, 'router': 0, 'confident': 0}
+    per_label = {}
+    calibration = []
+    for fold in range(folds):
+        train = [e for e in examples if zlib.crc32(e[1].encode('utf-8')) % folds != fold]
+        test = [e for e in examples if zlib.crc32(e[1].encode('utf-8')) % folds == fold]
+        classifier = train_classifier(train)
+        for label, text in test:
+            intent = classifier.classify(text)
+            rule = rules_label(text)
+            confident = intent.confidence >= threshold
+            routed = intent.label if confident else rule
+            results['classifier'] += intent.label == label
+            results['rules'] += rule == label
+            results['router'] += routed == label
+            results['confident'] += confident
+            calibration.append((intent.confidence, intent.label == label))
+            hits = per_label.setdefault(label, [0, 0, 0])
+            hits[0] += 1
+            hits[1] += intent.label == label
+            hits[2] += rule == label
+    return results, per_label, calibration
+
+
+def latency(examples, repeat):
+    classifier = train_classifier(examples)
+    texts = [text for _, text in examples]
+    classify = classifier._classify.__wrapped__  # bypass the result cache
+
+    timings = {'classifier': [], 'rules': []}
+    for _ in range(repeat):
+        for text in texts:
+            start = time.perf_counter()
+            classify(classifier, text)
+            timings['classifier'].append((time.perf_counter() - start) * 1e6)
+            # Vary the text so the keyword matcher's cache doesn't hide the scan
+            varied = f"{text} {len(timings['rules'])}"
+            start = time.perf_counter()
+            rules_label(varied)
+            timings['rules'].append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_CONFIDENCE_THRESHOLD)
+    parser.add_argument('--repeat', type=int, default=5, help='passes over the examples for the latency run')
+    args = parser.parse_args()
+
+    examples = load_examples()
+    print(f"{len(examples)} examples, {args.folds}-fold cross-validation, threshold {args.threshold}\n")
+
+    results, per_label, calibration = cross_validate(examples, args.folds, args.threshold)
+    total = len(examples)
+    print(f"{'accuracy':<28}{'':>8}")
+    print(f"{'  keyword rules':<28}{results['rules'] / total:>8.1%}")
+    print(f"{'  classifier':<28}{results['classifier'] / total:>8.1%}")
+    print(f"{'  router (with fallback)':<28}{results['router'] / total:>8.1%}")
+    print(f"{'  confident predictions':<28}{results['confident'] / total:>8.1%}")
+    print(f"{'calibration error (ECE)':<28}{expected_calibration_error(calibration):>8.3f}\n")
+
+    print(f"{'label':<28}{'n':>5}{'classifier':>12}{'rules':>8}")
+    for label, (n, classifier_ok, rules_ok) in sorted(per_label.items()):
+        print(f"{label:<28}{n:>5}{classifier_ok / n:>12.1%}{rules_ok / n:>8.1%}")
+
+    timings = latency(examples, args.repeat)
+    print(f"\n{'latency (us)':<28}{'p50':>8}{'p95':>8}{'p99':>8}{'mean':>8}")
+    for name, values in timings.items():
+        print(f"{'  ' + name:<28}{percentile(values, 50):>8.1f}{percentile(values, 95):>8.1f}"
+              f"{percentile(values, 99):>8.1f}{statistics.mean(values):>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
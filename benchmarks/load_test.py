@@ -0,0 +1,302 @@
+"""Load test of the chat API against a local mock of the OpenAI API
+
+Starts benchmarks/mock_openai.py and the app (Flask's app.py or the async app
+under Hypercorn) on local ports, then has --users virtual users play the scripted
+conversations in benchmarks/conversations.json through /api/chat, /api/location
+and /api/upload_insurance, each conversation in a new session, with a random
+think time between steps. Reports throughput and p50/p95/p99 latency per endpoint
+and per answering agent (and the time to the first token with --stream), then the
+mean time per turn stage from the app's /metrics.
+
+Replies from the "rules" agent are turns that admission control or the circuit
+breaker answered without the model. Runs are reproducible with the same --seed
+and mock settings; --save and --baseline compare runs like the microbenchmarks.
+
+Usage: python benchmarks/load_test.py [--server flask|asgi] [--users 10] [--conversations 40]
+       [--stream] [--latency 0.8] [--error-rate 0] [--url http://host:port] [--save FILE] [--baseline FILE]
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+
+import requests
+
+from report import load, print_table, save, summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+
+POLICY_TEXT = (
+    "Aetna Private Health Plan. Policy number AP-1234567. "
+    "Urgent care visits are covered with a copay of 40 dollars. "
+    "Emergency room visits are covered after the annual deductible of 500 dollars. "
+    "To file a claim submit the itemized bill, proof of payment and the claim form within 90 days."
+)
+
+
+def policy_pdf(text=POLICY_TEXT):
+    """A one-page PDF with the text on it, small enough to build in memory"""
+    stream = "BT /F1 10 Tf 40 760 Td 14 TL " + " ".join(
+        f"({line}) '" for line in (text[i:i + 90] for i in range(0, len(text), 90))) + " ET"
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+        "/Resources << /Font << /F1 5 0 R >> >> >>",
+        f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    pdf, offsets = "%PDF-1.4\n", []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n{body}\nendobj\n"
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n"
+    pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return pdf.encode('latin-1')
+
+
+class Results:
+    """Latencies of the requests sent, shared by the virtual users"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_endpoint = defaultdict(list)
+        self.by_agent = defaultdict(list)
+        self.first_token = []
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, ok, agent=None, first_token=None):
+        with self.lock:
+            if not ok:
+                self.errors[endpoint] += 1
+                return
+            self.by_endpoint[endpoint].append(seconds * 1000)
+            if agent:
+                self.by_agent[agent].append(seconds * 1000)
+            if first_token is not None:
+                self.first_token.append(first_token * 1000)
+
+
+class VirtualUser(threading.Thread):
+    """Plays conversations, each in a new session, until the run has played enough"""
+
+    def __init__(self, number, base_url, conversations, claim, results, options):
+        super().__init__(name=f"user-{number}", daemon=True)
+        self.base_url = base_url
+        self.conversations = conversations
+        self.claim = claim
+        self.results = results
+        self.options = options
+        self.random = random.Random(options.seed * 1000 + number)
+        self.pdf = policy_pdf()
+
+    def run(self):
+        while self.claim():
+            conversation = self.random.choice(self.conversations)
+            with requests.Session() as session:
+                for step in conversation['steps']:
+                    self.play(session, step)
+                    if self.options.think_time:
+                        time.sleep(self.random.expovariate(1 / self.options.think_time))
+
+    def play(self, session, step):
+        started = time.perf_counter()
+        try:
+            if 'chat' in step:
+                return self.chat(session, step['chat'], started)
+            if 'location' in step:
+                endpoint = '/api/location'
+                response = session.post(self.base_url + endpoint, json=step['location'], timeout=self.options.timeout)
+            else:
+                endpoint = '/api/upload_insurance'
+                response = session.post(self.base_url + endpoint, timeout=self.options.timeout,
+                                        files={'file': (step['upload'], self.pdf, 'application/pdf')})
+            self.results.record(endpoint, time.perf_counter() - started, response.ok)
+        except requests.RequestException:
+            self.results.record('/api/chat' if 'chat' in step else endpoint, time.perf_counter() - started, False)
+
+    def chat(self, session, message, started):
+        if not self.options.stream:
+            response = session.post(self.base_url + '/api/chat', json={'message': message},
+                                    timeout=self.options.timeout)
+            agent = response.json().get('agent') if response.ok else None
+            self.results.record('/api/chat', time.perf_counter() - started, response.ok, agent)
+            return
+
+        agent, first_token, event, done = None, None, None, False
+        with session.post(self.base_url + '/api/chat', json={'message': message, 'stream': True},
+                          timeout=self.options.timeout, stream=True) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith('event: '):
+                    event = line[len('event: '):]
+                elif line.startswith('data: '):
+                    if event == 'token' and first_token is None:
+                        first_token = time.perf_counter() - started
+                    elif event == 'agent':
+                        agent = json.loads(line[len('data: '):]).get('agent')
+                    elif event == 'done':
+                        done = True
+        self.results.record('/api/chat', time.perf_counter() - started, response.ok and done, agent, first_token)
+
+
+def stage_totals(base_url):
+    """{stage: (seconds, count)} from the app's nurse_ally_stage_seconds histogram"""
+    totals = defaultdict(lambda: [0.0, 0])
+    for line in requests.get(base_url + '/metrics', timeout=10).text.splitlines():
+        for suffix, index in (('_sum', 0), ('_count', 1)):
+            prefix = f'nurse_ally_stage_seconds{suffix}{{stage="'
+            if line.startswith(prefix):
+                stage, value = line[len(prefix):].split('"}', 1)
+                totals[stage][index] = float(value)
+    return totals
+
+
+def start_process(command, env, log):
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+
+
+def stop_process(process):
+    if process.poll() is None:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+def wait_until_up(url, process, log_path, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    with open(log_path, encoding='utf-8', errors='replace') as f:
+        sys.exit(f"{url} didn't come up; its output ended with:\n" + ''.join(f.readlines()[-20:]))
+
+
+def start_servers(options, directory):
+    """Start the mock API and the app; returns the app's URL and the processes"""
+    mock_log = os.path.join(directory, 'mock_openai.log')
+    app_log = os.path.join(directory, 'app.log')
+    env = dict(os.environ)
+    mock = start_process([sys.executable, os.path.join(BENCHMARKS, 'mock_openai.py'),
+                          '--port', str(options.mock_port), '--latency', str(options.latency),
+                          '--jitter', str(options.jitter), '--token-delay', str(options.token_delay),
+                          '--error-rate', str(options.error_rate), '--seed', str(options.seed)],
+                         env, open(mock_log, 'w'))
+    processes = [mock]
+    # The mock only answers POSTs, but any reply to a GET shows it is listening
+    mock_url = f"http://127.0.0.1:{options.mock_port}/v1"
+    wait_until_up(mock_url, mock, mock_log)
+
+    env.update(PORT=str(options.port), OPENAI_API_BASE=mock_url, OPENAI_API_KEY='mock',
+               LOG_LEVEL=os.getenv('LOG_LEVEL', 'WARNING'))
+    if options.server == 'asgi':
+        command = [sys.executable, '-m', 'hypercorn', '--config', 'file:hypercorn_config.py', 'asgi:app']
+    else:
+        command = [sys.executable, 'app.py']
+    processes.append(start_process(command, env, open(app_log, 'w')))
+    url = f"http://127.0.0.1:{options.port}"
+    wait_until_up(url + '/', processes[-1], app_log)
+    return url, processes
+
+
+def run(base_url, options):
+    with open(options.conversations_file, encoding='utf-8') as f:
+        conversations = json.load(f)
+    remaining = [options.conversations]
+    lock = threading.Lock()
+
+    def claim():
+        with lock:
+            remaining[0] -= 1
+            return remaining[0] >= 0
+
+    results = Results()
+    users = [VirtualUser(i, base_url, conversations, claim, results, options) for i in range(options.users)]
+    started = time.perf_counter()
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    return results, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask', help='which app to start')
+    parser.add_argument('--url', help='test an app that is already running instead of starting one')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--mock-port', type=int, default=8099)
+    parser.add_argument('--users', type=int, default=10, help='concurrent virtual users')
+    parser.add_argument('--conversations', type=int, default=40, help='conversations to play in all')
+    parser.add_argument('--conversations-file', default=os.path.join(BENCHMARKS, 'conversations.json'))
+    parser.add_argument('--think-time', type=float, default=0.5, help='mean seconds between steps')
+    parser.add_argument('--stream', action='store_true', help='ask for streamed replies')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.8, help="mock API's median seconds to the first token")
+    parser.add_argument('--jitter', type=float, default=0.4)
+    parser.add_argument('--token-delay', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results saved earlier with --save')
+    options = parser.parse_args()
+
+    processes = []
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            base_url = options.url.rstrip('/') if options.url else None
+            if base_url is None:
+                base_url, processes = start_servers(options, directory)
+            stages_before = stage_totals(base_url)
+            results, seconds = run(base_url, options)
+            stages_after = stage_totals(base_url)
+        finally:
+            for process in reversed(processes):
+                stop_process(process)
+
+    requests_sent = sum(map(len, results.by_endpoint.values())) + sum(results.errors.values())
+    print(f"{options.conversations} conversations by {options.users} users in {seconds:.1f} s: "
+          f"{requests_sent / seconds:.1f} requests/s, {len(results.by_endpoint['/api/chat']) / seconds:.1f} turns/s, "
+          f"{sum(results.errors.values())} errors {dict(results.errors) or ''}\n")
+
+    baseline = load(options.baseline) if options.baseline else None
+    saved = {}
+    for title, timings in (('endpoint', results.by_endpoint), ('agent', results.by_agent)):
+        rows = [(name, summarize(values)) for name, values in sorted(timings.items())]
+        print_table(title, rows, 'ms', baseline and baseline.get(title))
+        saved[title] = dict(rows)
+    if results.first_token:
+        rows = [('/api/chat', summarize(results.first_token))]
+        print_table('time to first token', rows, 'ms', baseline and baseline.get('time to first token'))
+        saved['time to first token'] = dict(rows)
+
+    print(f"{'mean per turn stage (ms)':<44}{'n':>7}{'mean':>10}")
+    for stage, (total, count) in sorted(stages_after.items()):
+        total -= stages_before[stage][0]
+        count -= stages_before[stage][1]
+        if count:
+            print(f"{'  ' + stage:<44}{int(count):>7}{total / count * 1000:>10.1f}")
+
+    if options.save:
+        save(options.save, saved)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""Microbenchmarks of the hot paths of a chat turn that don't call the model
+
+Times agent routing (AgentManager._determine_agent), Nurse Ally's symptom triage
+(NurseAlly._triage_symptoms) and the serialization of a session's conversation
+(the stored encoding against plain JSON, the copy kept to merge against, the
+three-way merge, and a save and load through the memory and SQLite stores, with
+and without a new turn to append), for short and long conversations. Routing and triage are timed on fresh text, so the classifier's and
+keyword matcher's caches don't hide the work, and on repeated text, as cached.
+
+Save the numbers with --save and compare a later run against them with --baseline
+to see regressions.
+
+Usage: python benchmarks/microbench.py [--repeat 5] [--only routing] [--save FILE] [--baseline FILE]
+"""
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(1, os.path.join(ROOT, 'nurse_ally'))
+# Keep the app's log lines out of the report
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from intent_classifier import load_examples
+from keywords import SCAN_CACHE_SIZE
+from conversation_store import MemoryStore, SQLiteStore, merge_changes
+from conversation_state import decode, encode, snapshot
+from app import AgentManager, new_conversation
+from agent import NurseAlly
+from report import load, print_table, save, summarize
+
+# Conversation states routing sees: a new conversation, then symptoms known,
+# then symptoms and insurance, then everything including the location
+STATES = (
+    {},
+    {'symptom_data': {'fever': True}},
+    {'symptom_data': {'fever': True}, 'insurance_data': {'provider': 'Aetna'}},
+    {'symptom_data': {'fever': True}, 'insurance_data': {'provider': 'Aetna'},
+     'location_data': {'latitude': 48.85, 'longitude': 2.35, 'detected': True}},
+)
+
+
+def timed(fn, args_list, repeat):
+    """Microseconds each call took"""
+    timings = []
+    for _ in range(repeat):
+        for args in args_list:
+            start = time.perf_counter()
+            fn(*args)
+            timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+def routing_benchmarks(examples, repeat):
+    texts = [text for _, text in examples]
+    manager = AgentManager()
+    states = [dict(new_conversation(), **state) for state in STATES]
+    fresh = [(f"{text} {i}", states[i % len(states)]) for i, text in enumerate(texts * repeat)]
+    # No more distinct messages than the caches hold
+    cached = [(text, states[i % len(states)]) for i, text in enumerate(texts[:SCAN_CACHE_SIZE])]
+    fresh_timings = timed(manager._determine_agent, fresh, 1)
+    timed(manager._determine_agent, cached, 1)  # warm the caches
+    return {
+        '_determine_agent': fresh_timings,
+        '_determine_agent (cached)': timed(manager._determine_agent, cached, repeat),
+    }
+
+
+def triage_benchmarks(examples, repeat):
+    texts = [text for label, text in examples if label == 'symptom_assessment']
+    nurse_ally = NurseAlly()
+    fresh = [({"symptoms": f"{text} {i}"},) for i, text in enumerate(texts * repeat)]
+    cached = [({"symptoms": text},) for text in texts[:SCAN_CACHE_SIZE]]
+    fresh_timings = timed(nurse_ally._triage_symptoms, fresh, 1)
+    timed(nurse_ally._triage_symptoms, cached, 1)
+    return {
+        '_triage_symptoms': fresh_timings,
+        '_triage_symptoms (cached)': timed(nurse_ally._triage_symptoms, cached, repeat),
+    }
+
+
+def sample_conversation(turns):
+    """A conversation `turns` exchanges long with every kind of state filled in"""
+    conversation = new_conversation()
+    for i in range(turns):
+        conversation['messages'].append({'role': 'user', 'content': f"I still have a fever and a headache, day {i}"})
+        conversation['messages'].append({'role': 'assistant', 'content': "That sounds urgent. " * 12})
+    conversation.update(
+        symptom_data={'fever': True, 'headache': True, 'cough': True},
+        insurance_data={'provider': 'Aetna', 'file_uploaded': True,
+                        'document': {'job_id': 'a' * 32, 'status': 'done', 'insurer': 'Aetna', 'plan_type': 'Private',
+                                     'clauses': [{'kind': 'covered', 'text': "Urgent care is covered. " * 8}] * 8}},
+        location_data={'latitude': 48.85, 'longitude': 2.35, 'detected': True, 'country': 'France'},
+        urgency_level='urgent', version=turns)
+    return conversation
+
+
+def save_turn_timings(store, session_id, turns):
+    """Microseconds saving each of `turns` new chat turns took; its two messages
+    are appended to the stored conversation, which keeps growing"""
+    timings = []
+    for _ in range(turns):
+        conversation = store.get(session_id)
+        base = snapshot(conversation)
+        conversation['messages'].append({'role': 'user', 'content': "And what about my insurance?"})
+        conversation['messages'].append({'role': 'assistant', 'content': "It covers urgent care. " * 12})
+        start = time.perf_counter()
+        store.save(session_id, conversation, base)
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+def serialization_benchmarks(examples, repeat, turns_list=(5, 50)):
+    timings = {}
+    with tempfile.TemporaryDirectory() as directory:
+        stores = {'memory': MemoryStore(), 'sqlite': SQLiteStore(os.path.join(directory, 'conversations.db'))}
+        for turns in turns_list:
+            conversation = sample_conversation(turns)
+            plain = conversation.to_dict()
+            as_json = json.dumps(plain)
+            encoded = encode(conversation)
+            loaded = decode(encoded)
+            updated = copy.deepcopy(conversation)
+            updated['messages'].append({'role': 'user', 'content': "Where is the nearest clinic?"})
+            updated['urgency_level'] = 'routine'
+            # A location update saved while the turn ran
+            concurrent = copy.deepcopy(conversation)
+            concurrent['location_data'] = {'latitude': 52.52, 'longitude': 13.40, 'detected': True}
+            label = f"({turns} turns, {len(as_json) // 1024} KB)"
+            args = [()] * 200
+            timings[f"json encode {label}"] = timed(lambda: json.dumps(plain), args, repeat)
+            timings[f"json decode {label}"] = timed(lambda: json.loads(as_json), args, repeat)
+            timings[f"encode {label}"] = timed(lambda: encode(conversation), args, repeat)
+            # Decoding leaves the messages encoded until they are read
+            timings[f"decode {label}"] = timed(lambda: decode(encoded), args, repeat)
+            timings[f"decode with messages {label}"] = timed(lambda: decode(encoded)['messages'], args, repeat)
+            timings[f"deepcopy {label}"] = timed(lambda: copy.deepcopy(conversation), args, repeat)
+            timings[f"snapshot {label}"] = timed(lambda: snapshot(loaded), args, repeat)
+            timings[f"merge_changes {label}"] = timed(lambda: merge_changes(conversation, updated, concurrent),
+                                                      args, repeat)
+            for name, store in stores.items():
+                store.set(f'bench-{turns}', copy.deepcopy(conversation))
+
+                # A request that doesn't touch the messages, as the app loads and saves it
+                def save_and_load(store=store, session_id=f'bench-{turns}'):
+                    conversation = store.get(session_id)
+                    base = snapshot(conversation)
+                    conversation['urgency_level'] = 'routine'
+                    store.save(session_id, conversation, base)
+                timings[f"{name} store get+save {label}"] = timed(save_and_load, [()] * 50, repeat)
+
+                timings[f"{name} store save turn {label}"] = save_turn_timings(store, f'bench-{turns}', 50 * repeat)
+    return timings
+
+
+BENCHMARKS = {
+    'routing': routing_benchmarks,
+    'triage': triage_benchmarks,
+    'serialization': serialization_benchmarks,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='passes over the inputs')
+    parser.add_argument('--only', choices=sorted(BENCHMARKS), action='append', help='run only these groups')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results saved earlier with --save')
+    args = parser.parse_args()
+
+    examples = load_examples()
+    baseline = load(args.baseline) if args.baseline else None
+    results = {}
+    for group in args.only or BENCHMARKS:
+        rows = [(name, summarize(values)) for name, values in BENCHMARKS[group](examples, args.repeat).items()]
+        print_table(group, rows, 'us', baseline)
+        results.update(rows)
+
+    if args.save:
+        save(args.save, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""Local stand-in for the OpenAI chat completions API, for load tests
+
+Answers POST /v1/chat/completions like the real API, streamed or not, after a
+simulated delay: the time to the first token is drawn from a lognormal
+distribution around --latency, and each further token takes --token-delay.
+--error-rate of the requests fail with --error-status instead. Replies are
+canned text, so agents still see urgency words and facility mentions.
+
+Point the app at it with OPENAI_API_BASE=http://127.0.0.1:<port>/v1 and any
+OPENAI_API_KEY.
+
+Usage: python benchmarks/mock_openai.py [--port 8089] [--latency 0.8] [--jitter 0.4]
+       [--token-delay 0.02] [--reply-tokens 60] [--error-rate 0] [--error-status 503] [--seed 1]
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLIES = (
+    "Thanks for telling me. From what you describe this sounds urgent, so it would be best to be seen "
+    "today at an urgent care clinic. Do you know what insurance you have?",
+    "That sounds like a routine matter. A pharmacist or your primary care doctor can help, and most "
+    "plans cover a regular appointment. Let me know if anything gets worse.",
+    "Your insurance usually covers urgent care and emergency visits. Keep your receipts and your policy "
+    "number for the claim. Would you like me to find a facility near you?",
+    "The nearest suitable places are listed below. The urgent care clinic is closest and accepts most "
+    "insurance; call ahead if you can.",
+)
+
+# Status codes the openai library maps to its retryable errors
+ERROR_TYPES = {429: 'rate_limit_exceeded', 500: 'server_error', 502: 'server_error', 503: 'server_error'}
+
+
+class MockSettings:
+    def __init__(self, latency=0.8, jitter=0.4, token_delay=0.02, reply_tokens=60, error_rate=0.0,
+                 error_status=503, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def draw(self):
+        """(request number, seconds to the first token, whether to fail) for the next request"""
+        with self.lock:
+            self.requests += 1
+            first_token = self.latency * self.random.lognormvariate(0, self.jitter) if self.latency > 0 else 0.0
+            return self.requests, first_token, self.random.random() < self.error_rate
+
+    def reply(self, number):
+        words = REPLIES[number % len(REPLIES)].split()
+        while len(words) < self.reply_tokens:
+            words += REPLIES[(number + len(words)) % len(REPLIES)].split()
+        return [word + ' ' for word in words[:self.reply_tokens]]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    settings: MockSettings = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self._send_json(404, {'error': {'message': f"Unknown path {self.path}", 'type': 'invalid_request_error'}})
+
+        number, first_token, fail = self.settings.draw()
+        time.sleep(first_token)
+        if fail:
+            status = self.settings.error_status
+            return self._send_json(status, {'error': {'message': "Injected failure",
+                                                      'type': ERROR_TYPES.get(status, 'server_error')}})
+
+        tokens = self.settings.reply(number)
+        prompt_tokens = sum(len(m.get('content') or '') for m in body.get('messages', [])) // 4
+        completion = {'id': f"chatcmpl-mock{number}", 'created': int(time.time()), 'model': body.get('model', 'mock')}
+        if body.get('stream'):
+            self._stream(completion, tokens)
+        else:
+            time.sleep(self.settings.token_delay * (len(tokens) - 1))
+            self._send_json(200, dict(completion, object='chat.completion', choices=[{
+                'index': 0, 'message': {'role': 'assistant', 'content': ''.join(tokens)}, 'finish_reason': 'stop'
+            }], usage={'prompt_tokens': prompt_tokens, 'completion_tokens': len(tokens),
+                       'total_tokens': prompt_tokens + len(tokens)}))
+
+    def _stream(self, completion, tokens):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        deltas = [{'role': 'assistant', 'content': tokens[0]}] + [{'content': token} for token in tokens[1:]]
+        for i, delta in enumerate(deltas):
+            if i:
+                time.sleep(self.settings.token_delay)
+            chunk = dict(completion, object='chat.completion.chunk',
+                         choices=[{'index': 0, 'delta': delta, 'finish_reason': None}])
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_mock_server(port: int = 0, **settings) -> ThreadingHTTPServer:
+    """Serve the mock API from a background thread; server.server_port is the port it got"""
+    handler = type('Handler', (MockHandler,), {'settings': MockSettings(**settings)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-openai', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.8, help='median seconds to the first token')
+    parser.add_argument('--jitter', type=float, default=0.4, help='sigma of the lognormal latency')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='seconds between tokens')
+    parser.add_argument('--reply-tokens', type=int, default=60)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests that fail')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    server = start_mock_server(args.port, latency=args.latency, jitter=args.jitter, token_delay=args.token_delay,
+                               reply_tokens=args.reply_tokens, error_rate=args.error_rate,
+                               error_status=args.error_status, seed=args.seed)
+    print(f"Mock OpenAI API on http://127.0.0.1:{server.server_port}/v1", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
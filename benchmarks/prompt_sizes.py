@@ -0,0 +1,77 @@
+"""Prompt sizes of each agent, by section, without calling the model
+
+Builds the prompt each agent would send (the multi-agent app's four agents and
+Nurse Ally) for conversations of a few lengths with symptoms, insurance and a
+location known, and prints its tokens per section as counted by the local
+tokenizer: system prompt, facts, summary, history and the user's message. Run it
+after editing a system prompt or the history budget to see what each turn costs.
+
+Usage: python benchmarks/prompt_sizes.py [--turns 1 5 20 60]
+"""
+import os
+import sys
+import copy
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(1, os.path.join(ROOT, 'nurse_ally'))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from token_accounting import SECTIONS, prompt_sections
+from app import AgentManager, new_conversation
+from agent import NurseAlly
+
+USER_MESSAGE = "Is the nearest urgent care covered by my insurance?"
+
+
+def exchanges(turns):
+    messages = []
+    for i in range(turns):
+        messages.append({'role': 'user', 'content': f"I still have a fever and a sore throat, it's day {i + 1} now."})
+        messages.append({'role': 'assistant', 'content': "Thanks for the update. A fever lasting several days "
+                         "should be checked, so it would be best to be seen at an urgent care clinic today. "
+                         "Do you know whether your plan covers urgent care?"})
+    return messages
+
+
+def app_conversation(turns):
+    conversation = new_conversation()
+    conversation.update(messages=exchanges(turns), symptom_data={'fever': True, 'sore throat': True},
+                        urgency_level='urgent', insurance_data={'provider': 'Aetna'},
+                        location_data={'latitude': 48.8566, 'longitude': 2.3522, 'detected': True})
+    return conversation
+
+
+def nurse_ally_context(turns):
+    return {
+        'conversation_history': exchanges(turns),
+        'symptoms_assessed': True, 'insurance_checked': True, 'facilities_recommended': False,
+        'urgency_level': 'moderate', 'insurance_covers': True, 'coverage_note': "Urgent care is covered",
+        'nearby_facilities': [],
+        'user_profile': {'nationality': 'French', 'insurance_type': 'Private', 'insurance_provider': 'Aetna',
+                         'country': 'France', 'city': 'Paris', 'language': 'English'},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--turns', type=int, nargs='+', default=[1, 5, 20, 60], help='conversation lengths to build')
+    args = parser.parse_args()
+
+    manager = AgentManager()
+    nurse_ally = NurseAlly()
+    builders = [(name, agent, app_conversation) for name, agent in manager.agents.items()]
+    builders.append(('nurse_ally', nurse_ally, nurse_ally_context))
+
+    print(f"{'agent':<26}{'turns':>6}" + ''.join(f"{section:>14}" for section in SECTIONS) + f"{'total':>8}")
+    for name, agent, build in builders:
+        for turns in args.turns:
+            messages = agent._prepare_messages(copy.deepcopy(build(turns)), USER_MESSAGE)
+            sections = prompt_sections(messages)
+            print(f"{name:<26}{turns:>6}" + ''.join(f"{sections.get(section, 0):>14}" for section in SECTIONS)
+                  + f"{sum(sections.values()):>8}")
+
+
+if __name__ == '__main__':
+    main()
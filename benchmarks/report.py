@@ -0,0 +1,49 @@
+"""Percentiles and tables shared by the benchmark scripts"""
+import json
+import statistics
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summarize(values):
+    """p50, p95, p99 and mean of the values"""
+    return {
+        'n': len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'mean': statistics.mean(values),
+    }
+
+
+def print_table(title, rows, unit, baseline=None):
+    """Print one line per (name, summary) row; with a baseline, the change in p50 and p95 too"""
+    header = f"{title + f' ({unit})':<44}{'n':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'mean':>10}"
+    if baseline is not None:
+        header += f"{'p50 vs base':>13}{'p95 vs base':>13}"
+    print(header)
+    for name, summary in rows:
+        line = (f"{'  ' + name:<44}{summary['n']:>7}{summary['p50']:>10.1f}{summary['p95']:>10.1f}"
+                f"{summary['p99']:>10.1f}{summary['mean']:>10.1f}")
+        base = (baseline or {}).get(name)
+        if base:
+            line += f"{_change(summary['p50'], base['p50']):>13}{_change(summary['p95'], base['p95']):>13}"
+        print(line)
+    print()
+
+
+def _change(value, base):
+    return f"{(value - base) / base:+.1%}" if base else ''
+
+
+def save(path, results):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
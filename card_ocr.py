@@ -0,0 +1,125 @@
+"""Reading photos of insurance cards
+
+A photo is normalised for OCR (rotated upright, grey, contrast stretched,
+scaled to a size tesseract reads well) and its text read locally with
+tesseract. The card's number, group number and validity dates are then picked
+out of the text; the insurer and plan type are detected like a policy's.
+
+Needs Pillow, pytesseract and the tesseract binary; without them card photos
+are stored but not read.
+"""
+import os
+import re
+import calendar
+from datetime import date
+from typing import Dict, Optional
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# tesseract language packs to read cards with, e.g. "eng+fra+deu"
+OCR_LANGUAGES = os.getenv("OCR_LANGUAGES", "eng")
+# Photos are scaled so their longest side falls between these: phone photos are
+# far larger than OCR needs, and small scans too small for it to read (a card at
+# 300 dpi is about 1000 pixels wide)
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", "2000"))
+OCR_MIN_SIDE = 1000
+
+_DATE = (r'(\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[./-]\d{1,2}[./-]\d{2,4}|\d{1,2}[./-]\d{2,4}'
+         r'|\d{1,2}\s+[A-Za-z]{3,9}\.?\s+\d{4}|[A-Za-z]{3,9}\.?\s+\d{1,2},?\s+\d{4})')
+VALID_UNTIL = re.compile(r'\b(?:valid\s*(?:until|thru|through|till|to)|expir(?:y|es|ation)(?:\s*date)?|exp\.?'
+                         r'|end\s*date)\s*[:.]?\s*' + _DATE, re.IGNORECASE)
+VALID_FROM = re.compile(r'\b(?:valid\s*from|effective(?:\s*date)?|eff\.?\s*date|start\s*date|issued(?:\s*on)?)'
+                        r'\s*[:.]?\s*' + _DATE, re.IGNORECASE)
+# The EHIC's "Identification number of the card", and card numbers in general
+CARD_NUMBER = re.compile(r'\b(?:card|identification)\s*(?:no\.?|number|#|id)(?:\s+of\s+the\s+card)?\s*[:#]?\s*'
+                         r'([A-Z0-9][A-Z0-9/-]{3,}(?: \d{3,})*)', re.IGNORECASE)
+GROUP_NUMBER = re.compile(r'\bgroup\s*(?:no\.?|number|#|id)?\s*[:#]?\s*((?=[A-Z-]*\d)[A-Z0-9-]{3,})\b', re.IGNORECASE)
+
+_MONTHS = {name.lower(): number for number, name in enumerate(calendar.month_abbr) if name}
+
+
+class OCRUnavailable(RuntimeError):
+    """Pillow, pytesseract or the tesseract binary isn't installed"""
+
+
+def prepare(image):
+    """A photo normalised for OCR: upright, grey, contrast stretched, sensibly sized"""
+    from PIL import Image, ImageOps
+
+    # JPEGs can be decoded at a fraction of their size, much faster than decoding
+    # a whole phone photo and scaling it down afterwards
+    image.draft('L', (OCR_MAX_SIDE, OCR_MAX_SIDE))
+    # Phone photos are often stored sideways with an orientation tag
+    image = ImageOps.exif_transpose(image).convert('L')
+    longest = max(image.size)
+    if longest > OCR_MAX_SIDE:
+        image.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.LANCZOS)
+    elif longest < OCR_MIN_SIDE:
+        scale = OCR_MIN_SIDE / longest
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+    return ImageOps.autocontrast(image, cutoff=1)
+
+
+def read_card(path: str) -> str:
+    """The text of an insurance card photo; raises OCRUnavailable without the OCR packages"""
+    try:
+        from PIL import Image
+        import pytesseract
+    except ImportError:
+        raise OCRUnavailable("The Pillow and pytesseract packages are required to read insurance card photos")
+
+    with Image.open(path) as image:
+        prepared = prepare(image)
+    try:
+        return pytesseract.image_to_string(prepared, lang=OCR_LANGUAGES)
+    except pytesseract.TesseractNotFoundError:
+        raise OCRUnavailable("The tesseract binary is required to read insurance card photos")
+
+
+def parse_date(text: str, end_of_period: bool = False) -> Optional[str]:
+    """An ISO date from a date printed on a card, or None
+
+    Numeric dates are read day first unless that is impossible (13/01/2027 and
+    01/13/2027 are both 13 January), as on European cards. Month and year alone
+    (12/27) mean the month's last day when `end_of_period`, else its first.
+    """
+    text = text.strip().rstrip('.')
+    try:
+        if re.fullmatch(r'\d{4}-\d{1,2}-\d{1,2}', text):
+            year, month, day = (int(part) for part in text.split('-'))
+        elif re.fullmatch(r'[A-Za-z]{3,9}\.?\s+\d{1,2},?\s+\d{4}', text):
+            name, day, year = re.split(r'[\s,.]+', text)
+            month, day, year = _MONTHS.get(name[:3].lower()), int(day), int(year)
+        elif re.fullmatch(r'\d{1,2}\s+[A-Za-z]{3,9}\.?\s+\d{4}', text):
+            day, name, year = re.split(r'[\s.]+', text)
+            month, day, year = _MONTHS.get(name[:3].lower()), int(day), int(year)
+        else:
+            parts = [int(part) for part in re.split(r'[./-]', text)]
+            if len(parts) == 2:
+                month, year = parts
+                day = None
+            else:
+                day, month, year = parts
+                if month > 12 >= day:
+                    day, month = month, day
+            if year < 100:
+                year += 2000
+            if day is None:
+                day = calendar.monthrange(year, month)[1] if end_of_period else 1
+        return date(year, month, day).isoformat() if month else None
+    except ValueError:
+        return None
+
+
+def card_details(text: str) -> Dict[str, Optional[str]]:
+    """The card number, group number and validity dates found in a card's text"""
+    card_number = CARD_NUMBER.search(text)
+    group_number = GROUP_NUMBER.search(text)
+    valid_from = VALID_FROM.search(text)
+    valid_until = VALID_UNTIL.search(text)
+    return {
+        'card_number': card_number.group(1) if card_number else None,
+        'group_number': group_number.group(1) if group_number else None,
+        'valid_from': parse_date(valid_from.group(1)) if valid_from else None,
+        'valid_until': parse_date(valid_until.group(1), end_of_period=True) if valid_until else None,
+    }
@@ -0,0 +1,142 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from typing import Optional
+
+# Calls are judged over a sliding window of this many seconds, once it holds enough
+# of them; the circuit opens when too many failed or were slow
+DEFAULT_WINDOW = float(os.getenv("CIRCUIT_WINDOW", "30"))
+DEFAULT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "10"))
+DEFAULT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+DEFAULT_SLOW_CALL = float(os.getenv("CIRCUIT_SLOW_CALL", "10"))   # seconds
+DEFAULT_SLOW_RATE = float(os.getenv("CIRCUIT_SLOW_RATE", "0.8"))
+# Seconds the circuit stays open before letting probe calls through
+DEFAULT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+DEFAULT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "1"))
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    """The upstream is failing and the call was refused without trying it"""
+
+
+class CircuitBreaker:
+    """Stops calling an upstream that is failing or too slow
+
+    Closed, every call goes through and its outcome is recorded. When enough of
+    the calls in the window failed, or took longer than `slow_call` seconds, the
+    circuit opens and calls are refused at once with CircuitOpen. After
+    `open_seconds` it half-opens: a few probe calls go through, and the circuit
+    closes when they succeed in time or opens again when one doesn't.
+    """
+
+    def __init__(self, window: float = DEFAULT_WINDOW, min_calls: int = DEFAULT_MIN_CALLS,
+                 failure_rate: float = DEFAULT_FAILURE_RATE, slow_call: float = DEFAULT_SLOW_CALL,
+                 slow_rate: float = DEFAULT_SLOW_RATE, open_seconds: float = DEFAULT_OPEN_SECONDS,
+                 half_open_probes: int = DEFAULT_HALF_OPEN_PROBES):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+
+        self._lock = threading.Lock()
+        self._calls = deque()  # (finished at, failed, slow)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._last_probe_at = 0.0
+        self.stats = {'opened': 0, 'refused': 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    @property
+    def is_open(self) -> bool:
+        """True while calls are being refused outright"""
+        return self.state == OPEN
+
+    def _current_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+        return self._state
+
+    def allow(self):
+        """Raise CircuitOpen unless a call may go upstream now"""
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == CLOSED:
+                return
+            # A probe that never reported back (it wasn't admitted, say) frees its
+            # place after a while
+            if state == HALF_OPEN and (self._probes < self.half_open_probes
+                                       or now - self._last_probe_at >= self.open_seconds):
+                self._probes += 1
+                self._last_probe_at = now
+                return
+            self.stats['refused'] += 1
+        raise CircuitOpen("The model is unavailable; calls are paused while it recovers")
+
+    def record_success(self, latency: float):
+        self._record(failed=False, slow=latency >= self.slow_call)
+
+    def record_failure(self):
+        self._record(failed=True, slow=False)
+
+    def _record(self, failed, slow):
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == HALF_OPEN:
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_probes:
+                        logger.warning("Circuit breaker closed; model calls resumed")
+                        self._state = CLOSED
+                        self._calls.clear()
+                return
+            if state == OPEN:
+                # A call that started before the circuit opened
+                return
+
+            self._calls.append((now, failed, slow))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+            total = len(self._calls)
+            if total < self.min_calls:
+                return
+            failures = sum(1 for _, f, _ in self._calls if f)
+            slow_calls = sum(1 for _, _, s in self._calls if s)
+            if failures / total >= self.failure_rate or slow_calls / total >= self.slow_rate:
+                self._open(now)
+
+    def _open(self, now):
+        logger.warning("Circuit breaker opened; refusing model calls", extra={'open_seconds': self.open_seconds})
+        self._state = OPEN
+        self._opened_at = now
+        self._calls.clear()
+        self.stats['opened'] += 1
+
+
+def create_circuit_breaker() -> Optional[CircuitBreaker]:
+    """The circuit breaker configured by the environment; CIRCUIT_BREAKER=off disables it"""
+    if os.getenv("CIRCUIT_BREAKER", "on") == "off":
+        return None
+    return CircuitBreaker()
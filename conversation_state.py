@@ -0,0 +1,463 @@
+"""Typed conversation state and its compact, versioned encoding
+
+A conversation is a slotted object with one attribute per field instead of a
+dict per session, and it still behaves as a mapping, so agents keep reading and
+writing `conversation['urgency_level']` as before. Urgency levels and care
+levels are enums, so every session shares the same few values.
+
+Stored conversations are encoded as a small binary envelope: a header holding
+the fields by position (no key names, enums as small numbers) followed by the
+message list. Only the header is decoded on load; the messages are decoded the
+first time they are read, and written back unchanged if they never were, so a
+request that doesn't touch the history (a location update, an upload, a rules
+reply) never decodes or re-encodes it.
+
+The stores keep the header apart from the messages, which are an append-only
+log of chunks: saving a turn rewrites the header and appends a chunk holding
+just the new messages (see encode_changes()), so a save costs the same however
+long the conversation is. Once the log has grown to enough chunks it is
+compacted, rewritten as a single chunk.
+
+The envelope uses msgpack when it is installed and compact JSON otherwise.
+Conversations stored as plain JSON before this format are still read.
+"""
+import sys
+import copy
+import json
+import struct
+from enum import Enum
+from collections.abc import Mapping, MutableMapping
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Envelope: magic, format version, codec, header length, header, messages. The
+# leading NUL can't start a JSON document, which tells the two formats apart. A
+# header stored apart from its messages has no messages after it.
+MAGIC = b'\x00NA'
+FORMAT_VERSION = 1
+_ENVELOPE = struct.Struct('>3sBcI')
+
+_MISSING = object()
+# The messages of a decoded conversation that haven't been read yet
+_LAZY = object()
+
+
+class Urgency(str, Enum):
+    """How soon care is needed: the agents' scale, then the rules' triage scale"""
+
+    EMERGENCY = 'emergency'
+    URGENT = 'urgent'
+    ROUTINE = 'routine'
+    SEVERE = 'severe'
+    MODERATE = 'moderate'
+    MILD = 'mild'
+
+    # Compare, hash and format as the plain strings they replace
+    __str__ = str.__str__
+    __format__ = str.__format__
+
+
+class CareLevel(str, Enum):
+    """Where to go for care"""
+
+    HOSPITAL = 'hospital'
+    WALK_IN_CLINIC = 'walk-in clinic'
+    PHARMACY = 'pharmacy'
+
+    __str__ = str.__str__
+    __format__ = str.__format__
+
+
+def _dumps_json(value) -> bytes:
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+if msgpack is not None:
+    CODEC = b'm'
+    _dump = msgpack.packb
+else:
+    CODEC = b'j'
+    _dump = _dumps_json
+
+
+def _load(codec: bytes, data: bytes):
+    if codec == b'j':
+        return json.loads(data)
+    if codec == b'm':
+        if msgpack is None:
+            raise RuntimeError("The msgpack package is required to read this conversation")
+        return msgpack.unpackb(data, strict_map_key=False)
+    raise ValueError(f"Unknown conversation codec {codec!r}")
+
+
+class ConversationState(MutableMapping):
+    """Conversation state with a fixed set of typed fields
+
+    Subclasses list their FIELDS, which are encoded by position and so may only
+    ever be appended to, and name the field holding the message list. Keys that
+    aren't fields are kept in a small dict on the side.
+
+    A decoded state remembers how it was stored: its header, the chunks of its
+    message log, and which message list (and how many of its messages) the log
+    holds, so the next save only has to add what came after them.
+    """
+
+    __slots__ = ('_extra', '_source', '_log', '_appendable', '_logged')
+
+    SCHEMA = 0
+    FIELDS: Tuple[str, ...] = ()
+    MESSAGES = ''
+    # Fields holding one of an enum's values, and fields of repeated short strings
+    ENUMS: Dict[str, type] = {}
+    INTERNED: Tuple[str, ...] = ()
+
+    def __init__(self, data: Any = (), **kwargs):
+        for field in self.FIELDS:
+            object.__setattr__(self, field, _MISSING)
+        self._extra = None
+        self._source = None
+        self._log = None
+        self._appendable = False
+        self._logged = None
+        self.update(data, **kwargs)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.FIELDS)
+        cls._codes = {field: {member: code for code, member in enumerate(enum)} for field, enum in cls.ENUMS.items()}
+        cls._members = {field: list(enum) for field, enum in cls.ENUMS.items()}
+        if cls.SCHEMA:
+            SCHEMAS[cls.SCHEMA] = cls
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            value = object.__getattribute__(self, key)
+            if value is _LAZY:
+                value = self._load_messages()
+            if value is _MISSING:
+                raise KeyError(key)
+            return value
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            enum = self.ENUMS.get(key)
+            if enum is not None and isinstance(value, str) and not isinstance(value, enum):
+                value = enum._value2member_map_.get(value, value)
+            object.__setattr__(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._field_set and object.__getattribute__(self, key) is not _MISSING:
+            object.__setattr__(self, key, _MISSING)
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self._field_set:
+            return object.__getattribute__(self, key) is not _MISSING
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self) -> Iterator[str]:
+        for field in self.FIELDS:
+            if object.__getattribute__(self, field) is not _MISSING:
+                yield field
+        if self._extra:
+            yield from list(self._extra)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        # Field by field: merge_changes() compares whole conversations, and
+        # messages neither side has read are compared without decoding them
+        if type(other) is not type(self):
+            return self.to_dict() == dict(other.items()) if isinstance(other, Mapping) else NotImplemented
+        for field in self.FIELDS:
+            ours = object.__getattribute__(self, field)
+            theirs = object.__getattribute__(other, field)
+            if ours is _LAZY and theirs is _LAZY and self._log == other._log:
+                continue
+            if ours is _LAZY:
+                ours = self._load_messages()
+            if theirs is _LAZY:
+                theirs = other._load_messages()
+            if ours is not theirs and ours != theirs:
+                return False
+        return (self._extra or {}) == (other._extra or {})
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+    def __copy__(self):
+        clone = type(self).__new__(type(self))
+        for field in self.FIELDS:
+            object.__setattr__(clone, field, object.__getattribute__(self, field))
+        clone._extra = dict(self._extra) if self._extra else None
+        clone._source = self._source
+        clone._log = self._log
+        clone._appendable = self._appendable
+        clone._logged = self._logged
+        return clone
+
+    def __deepcopy__(self, memo):
+        clone = copy.copy(self)
+        for field in self.FIELDS:
+            value = object.__getattribute__(self, field)
+            if value is not _MISSING and value is not _LAZY:
+                object.__setattr__(clone, field, copy.deepcopy(value, memo))
+        clone._extra = copy.deepcopy(self._extra, memo)
+        if self._logged is not None:
+            # The copied list holds the same logged messages
+            messages, count = self._logged
+            clone._logged = (memo.get(id(messages), messages), count)
+        return clone
+
+    def _load_messages(self):
+        # Each chunk of the log is its codec followed by a list of messages
+        messages = []
+        for chunk in self._log:
+            messages.extend(_load(chunk[:1], chunk[1:]))
+        object.__setattr__(self, self.MESSAGES, messages)
+        self._logged = (messages, len(messages))
+        return messages
+
+    def snapshot(self) -> 'ConversationState':
+        """A copy of the conversation as it was last loaded or saved, at its current version
+
+        Kept by a request to merge against if someone else saves the conversation
+        meanwhile; decoding the stored header costs far less than a deep copy.
+        """
+        if self._source is None:
+            return copy.deepcopy(self)
+        stored = decode(self._source, self._log)
+        if 'version' in self:
+            stored['version'] = self['version']
+        return stored
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The state as a plain dict, with the messages decoded"""
+        data = {}
+        for field in self.FIELDS:
+            value = object.__getattribute__(self, field)
+            if value is _LAZY:
+                value = self._load_messages()
+            if value is not _MISSING:
+                data[field] = value
+        if self._extra:
+            data.update(self._extra)
+        return data
+
+
+# Conversation classes by the schema number they are encoded with
+SCHEMAS: Dict[int, type] = {}
+
+
+class Conversation(ConversationState):
+    """The multi-agent app's conversation"""
+
+    FIELDS = ('messages', 'current_agent', 'symptom_data', 'insurance_data', 'location_data', 'urgency_level',
+              'insurance_file', 'treatment_available', 'insurance_covers', 'history_summary', 'version')
+    __slots__ = FIELDS
+    SCHEMA = 1
+    MESSAGES = 'messages'
+    ENUMS = {'urgency_level': Urgency}
+    INTERNED = ('current_agent',)
+
+    @classmethod
+    def new(cls) -> 'Conversation':
+        """A conversation that hasn't started yet"""
+        return cls(messages=[], current_agent='coordinator', symptom_data={}, insurance_data={}, location_data={},
+                   urgency_level=None, insurance_file=None, treatment_available=None, insurance_covers=None)
+
+
+class NurseAllyContext(ConversationState):
+    """Nurse Ally's conversation context"""
+
+    FIELDS = ('conversation_history', 'symptoms_assessed', 'insurance_checked', 'facilities_recommended',
+              'urgency_level', 'symptoms', 'insurance_covers', 'coverage_note', 'map_link', 'nearby_facilities',
+              'user_profile', 'insurance_file', 'insurance_document', 'history_summary', 'version')
+    __slots__ = FIELDS
+    SCHEMA = 2
+    MESSAGES = 'conversation_history'
+    ENUMS = {'urgency_level': Urgency}
+
+    @classmethod
+    def new(cls) -> 'NurseAllyContext':
+        """The context of a conversation that hasn't started yet"""
+        return cls(conversation_history=[], symptoms_assessed=False, insurance_checked=False,
+                   facilities_recommended=False, urgency_level=None, symptoms=None, insurance_covers=None,
+                   coverage_note=None, map_link=None, nearby_facilities=[],
+                   user_profile={'nationality': 'Unknown', 'insurance_type': 'Unknown', 'insurance_provider': 'Unknown',
+                                 'country': 'Unknown', 'city': 'Unknown', 'language': 'English',
+                                 'chronic_conditions': [], 'allergies': []})
+
+
+def from_mapping(data: Mapping) -> ConversationState:
+    """A plain dict of conversation state (stored before this format, or merged) as its class"""
+    if isinstance(data, ConversationState):
+        return data
+    cls = NurseAllyContext if 'conversation_history' in data else Conversation
+    return cls(data)
+
+
+def _encode_header(state: ConversationState) -> bytes:
+    mask = 0
+    values = []
+    codes = state._codes
+    for bit, field in enumerate(state.FIELDS):
+        value = object.__getattribute__(state, field)
+        if value is _MISSING:
+            continue
+        mask |= 1 << bit
+        if field == state.MESSAGES:
+            continue
+        if field in codes and value in codes[field]:
+            value = codes[field][value]
+        values.append(value)
+    header = _dump([state.SCHEMA, mask, values, state._extra])
+    return _ENVELOPE.pack(MAGIC, FORMAT_VERSION, CODEC, len(header)) + header
+
+
+def encode(state: Mapping) -> bytes:
+    """Encode a conversation for storage as one value, its messages after its header
+
+    The state remembers the encoding as what was last saved (see snapshot()).
+    """
+    state = from_mapping(state)
+    header = _encode_header(state)
+    messages = object.__getattribute__(state, state.MESSAGES)
+    if messages is _LAZY and len(state._log) == 1 and state._log[0][:1] == CODEC:
+        # Never read, so unchanged: written back as it was stored
+        body = state._log[0][1:]
+    elif messages is _LAZY:
+        body = _dump(state._load_messages())
+    elif messages is _MISSING:
+        body = b''
+    else:
+        body = _dump(messages)
+
+    data = header + body
+    state._source = data
+    state._log = (CODEC + body,)
+    state._appendable = False
+    return data
+
+
+def encode_changes(state: Mapping, append: bool = True,
+                   max_chunks: int = 64) -> Tuple[bytes, List[bytes], bool]:
+    """Encode a conversation for storage as a header and a log of message chunks
+
+    Returns the header, the chunks to store and whether they replace the stored
+    log. When they don't, they are to be appended to it and hold only the
+    messages added since the conversation was loaded or last saved: none if its
+    messages were never read. `append` says whether the stored log is still the
+    one the conversation was loaded from, i.e. no one else saved it meanwhile.
+
+    The whole history is written as a single chunk instead when the conversation
+    wasn't stored as a log, its message list was replaced or shortened, or its
+    log has reached `max_chunks` chunks (compaction).
+    """
+    state = from_mapping(state)
+    header = _encode_header(state)
+    messages = object.__getattribute__(state, state.MESSAGES)
+    log = state._log
+    logged = state._logged
+    if messages is _MISSING:
+        chunks, replace = [], True
+        log = ()
+    elif append and state._appendable and len(log) < max_chunks and (
+            messages is _LAZY or (logged is not None and messages is logged[0] and len(messages) >= logged[1])):
+        added = [] if messages is _LAZY else messages[logged[1]:]
+        chunks, replace = ([CODEC + _dump(added)] if added else []), False
+        log = log + tuple(chunks)
+    else:
+        if messages is _LAZY:
+            messages = state._load_messages()
+        chunks, replace = [CODEC + _dump(messages)], True
+        log = tuple(chunks)
+    state._source = header
+    state._log = log
+    state._appendable = True
+    if messages is not _LAZY and messages is not _MISSING:
+        state._logged = (messages, len(messages))
+    return header, chunks, replace
+
+
+def decode(data, log: Optional[Sequence[bytes]] = None) -> Optional[ConversationState]:
+    """Decode a stored conversation; the messages are decoded when first read
+
+    `log` holds the chunks of its message log when the header was stored apart
+    from its messages (see encode_changes()).
+    """
+    if data is None:
+        return None
+    if isinstance(data, str) or not data.startswith(MAGIC):
+        # Stored as JSON before this format
+        return from_mapping(json.loads(data))
+
+    _, version, codec, length = _ENVELOPE.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unknown conversation format version {version}")
+    start = _ENVELOPE.size
+    schema, mask, values, extra = _load(codec, data[start:start + length])
+    cls = SCHEMAS[schema]
+
+    state = cls.__new__(cls)
+    members = cls._members
+    position = 0
+    for bit, field in enumerate(cls.FIELDS):
+        if not mask & (1 << bit):
+            value = _MISSING
+        elif field == cls.MESSAGES:
+            value = _LAZY
+        else:
+            value = values[position]
+            position += 1
+            if field in members:
+                if isinstance(value, int):
+                    value = members[field][value]
+                elif isinstance(value, str):
+                    value = cls.ENUMS[field]._value2member_map_.get(value, value)
+            elif field in cls.INTERNED and isinstance(value, str):
+                value = sys.intern(value)
+        object.__setattr__(state, field, value)
+    state._extra = extra
+    state._source = data
+    state._logged = None
+    if len(data) > start + length:
+        # The messages follow the header
+        state._log = (codec + data[start + length:],)
+        state._appendable = False
+    else:
+        state._log = tuple(log or ())
+        state._appendable = True
+    return state
+
+
+def snapshot(conversation: Optional[Mapping]) -> Optional[Mapping]:
+    """A copy of a loaded conversation to merge against later"""
+    if conversation is None:
+        return None
+    if isinstance(conversation, ConversationState):
+        return conversation.snapshot()
+    return copy.deepcopy(conversation)
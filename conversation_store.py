@@ -0,0 +1,426 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Optional
+
+import metrics
+from conversation_state import ConversationState, decode, encode, encode_changes, from_mapping
+
+# Conversations not touched for this long are dropped by every backend
+DEFAULT_TTL = int(os.getenv("CONVERSATION_TTL", str(24 * 60 * 60)))
+DEFAULT_MAX_ENTRIES = int(os.getenv("CONVERSATION_STORE_MAX_ENTRIES", "10000"))
+# Conflicting writes are merged and retried this many times before giving up
+MAX_MERGE_ATTEMPTS = 5
+# Chunks a conversation's message log may grow to before it is compacted into one
+DEFAULT_COMPACT_CHUNKS = int(os.getenv("CONVERSATION_COMPACT_CHUNKS", "64"))
+
+
+# A key (or a whole conversation) that one side of a merge doesn't have
+_DELETED = object()
+
+
+class VersionConflict(Exception):
+    """The conversation was saved by someone else since it was loaded"""
+
+
+def merge_changes(base: Any, ours: Any, theirs: Any) -> Any:
+    """Three-way merge of conversation state
+
+    `base` is what we loaded, `ours` what we want to save and `theirs` what is
+    stored now. Keys we changed take our value and everything else keeps theirs;
+    lists that both sides only appended to (the messages) keep both sets of
+    additions, theirs first.
+
+    A key missing from `theirs` was deleted there: it stays deleted unless we
+    changed it, and of a list we appended to only our additions are kept.
+    """
+    if ours == base:
+        return theirs
+    if theirs == base:
+        return ours
+    if isinstance(ours, Mapping) and (isinstance(theirs, Mapping) or theirs is _DELETED):
+        base = base if isinstance(base, Mapping) else {}
+        theirs = {} if theirs is _DELETED else theirs
+        # Conversations are merged as plain dicts, which are much faster to walk
+        base, ours, theirs = (m.to_dict() if isinstance(m, ConversationState) else m for m in (base, ours, theirs))
+        merged = dict(theirs)
+        for key, value in ours.items():
+            value = merge_changes(base.get(key, _DELETED), value, theirs.get(key, _DELETED))
+            if value is _DELETED:
+                merged.pop(key, None)
+            else:
+                merged[key] = value
+        for key in base:
+            if key not in ours and key in merged and theirs.get(key) == base[key]:
+                del merged[key]
+        return merged
+    if isinstance(ours, list) and isinstance(base, list) and ours[:len(base)] == base:
+        if theirs is _DELETED:
+            return ours[len(base):]
+        if isinstance(theirs, list) and theirs[:len(base)] == base:
+            return theirs + ours[len(base):]
+    return ours
+
+
+class ConversationStore:
+    """Server-side storage for conversation state, keyed by an opaque session id
+
+    Only the session id travels in the cookie; the messages and the symptom,
+    insurance and location data stay on the server.
+
+    Every write bumps the conversation's 'version'. A write can name the version it
+    was based on and fails with VersionConflict if the stored one has moved on, so
+    concurrent writers never silently overwrite each other.
+
+    A conversation is stored as a small header and an append-only log of message
+    chunks (see conversation_state.encode_changes()): a write replaces the header
+    and appends the messages added since the conversation was loaded, so its cost
+    doesn't grow with the conversation. `stats` counts writes by what they did:
+    'header' (no new messages), 'append' or 'rewrite' (the whole log, written
+    after a merge, on a conversation's first save or to compact it).
+    """
+
+    compact_chunks = DEFAULT_COMPACT_CHUNKS
+
+    def __init__(self):
+        self.stats = {'header': 0, 'append': 0, 'rewrite': 0, 'bytes': 0}
+
+    def _encode(self, conversation, append: bool):
+        """The header and chunks to write, and whether the chunks replace the log"""
+        header, chunks, replace = encode_changes(conversation, append, self.compact_chunks)
+        self.stats['rewrite' if replace else 'append' if chunks else 'header'] += 1
+        self.stats['bytes'] += len(header) + sum(len(chunk) for chunk in chunks)
+        return header, chunks, replace
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Return the stored conversation, or None if there is none or it expired"""
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def set(self, session_id: str, conversation: Dict[str, Any], expected_version: Optional[int] = None) -> int:
+        """Store the conversation and refresh its expiry
+
+        With `expected_version`, only store it if the stored version (0 when there
+        is none) still matches, else raise VersionConflict. Returns the new version,
+        which is also written to conversation['version'].
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def delete(self, session_id: str) -> None:
+        """Remove the conversation if it exists"""
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def save(self, session_id: str, conversation: Dict[str, Any],
+             base: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Store a conversation that was loaded as `base`, merging in concurrent changes
+
+        If someone else saved in the meantime, our changes are merged into theirs
+        with merge_changes() and the write is retried. If the conversation was
+        deleted or expired meanwhile (reset while a turn ran), only our changes are
+        kept, on a new conversation. Returns what was stored.
+        """
+        for _ in range(MAX_MERGE_ATTEMPTS):
+            try:
+                self.set(session_id, conversation, expected_version=(base or {}).get('version', 0))
+                return conversation
+            except VersionConflict:
+                latest = self.get(session_id)
+                if latest is None:
+                    changes = merge_changes(base or {}, conversation, _DELETED)
+                    fresh = type(from_mapping(conversation)).new()
+                    conversation = from_mapping(merge_changes({}, {} if changes is _DELETED else changes, fresh))
+                    base = None
+                    continue
+                conversation = from_mapping(merge_changes(base or {}, conversation, latest))
+                conversation['version'] = latest.get('version', 0)
+                base = latest
+        raise VersionConflict(f"Could not save conversation {session_id} after {MAX_MERGE_ATTEMPTS} attempts")
+
+    def modify(self, session_id: str, change: Callable[[Dict[str, Any]], bool]) -> Optional[Dict[str, Any]]:
+        """Apply `change` to the stored conversation and save it, retrying on conflicts
+
+        `change` edits the conversation in place and returns whether it changed
+        anything. Returns the saved conversation, or None if there was none or
+        nothing changed.
+        """
+        for _ in range(MAX_MERGE_ATTEMPTS):
+            conversation = self.get(session_id)
+            if conversation is None or not change(conversation):
+                return None
+            try:
+                self.set(session_id, conversation, expected_version=conversation.get('version', 0))
+                return conversation
+            except VersionConflict:
+                continue
+        raise VersionConflict(f"Could not update conversation {session_id} after {MAX_MERGE_ATTEMPTS} attempts")
+
+
+class MemoryStore(ConversationStore):
+    """In-process store with least-recently-used eviction and a TTL
+
+    Conversations are kept encoded (see conversation_state) so callers never share
+    mutable state with the store. Only suitable for a single server process.
+    """
+
+    def __init__(self, ttl: int = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        super().__init__()
+        # session id -> (header, message log chunks, expiry, version)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._live_entry(session_id)
+            if entry is None:
+                return None
+            header, log, _, version = entry
+            self._entries.move_to_end(session_id)
+        conversation = decode(header, log)
+        conversation['version'] = version
+        return conversation
+
+    def set(self, session_id, conversation, expected_version=None):
+        with self._lock:
+            entry = self._live_entry(session_id)
+            current = entry[3] if entry else 0
+            if expected_version is not None and expected_version != current:
+                raise VersionConflict(f"Conversation {session_id} is at version {current}, not {expected_version}")
+            header, chunks, replace = self._encode(conversation, append=conversation.get('version') == current)
+            log = tuple(chunks) if replace else entry[1] + tuple(chunks)
+            self._entries[session_id] = (header, log, time.time() + self.ttl, current + 1)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        conversation['version'] = current + 1
+        return current + 1
+
+    def _live_entry(self, session_id):
+        entry = self._entries.get(session_id)
+        if entry is not None and entry[2] <= time.time():
+            del self._entries[session_id]
+            return None
+        return entry
+
+    def delete(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteStore(ConversationStore):
+    """File-backed store that survives restarts and can be shared by worker processes
+
+    Headers live in the conversations table and message chunks in conversation_log,
+    one row per chunk.
+    """
+
+    # Expired rows are purged once every this many writes
+    PURGE_INTERVAL = 500
+
+    def __init__(self, path: str, ttl: int = DEFAULT_TTL):
+        super().__init__()
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "session_id TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL, "
+            "version INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversation_log ("
+            "session_id TEXT NOT NULL, seq INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY (session_id, seq))"
+        )
+        # Databases created before conversations were versioned
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(conversations)")]
+        if 'version' not in columns:
+            self._conn.execute("ALTER TABLE conversations ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    @contextmanager
+    def _transaction(self, begin: str = "BEGIN IMMEDIATE"):
+        # BEGIN IMMEDIATE takes SQLite's write lock, which other processes wait on;
+        # a plain BEGIN reads the header and its log from one snapshot
+        with self._lock:
+            self._conn.execute(begin)
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def get(self, session_id):
+        with self._transaction("BEGIN") as conn:
+            row = conn.execute(
+                "SELECT data, version FROM conversations WHERE session_id = ? AND expires_at > ?",
+                (session_id, time.time())
+            ).fetchone()
+            if row:
+                log = [chunk for chunk, in conn.execute(
+                    "SELECT data FROM conversation_log WHERE session_id = ? ORDER BY seq", (session_id,))]
+        if not row:
+            return None
+        conversation = decode(row[0], log)
+        conversation['version'] = row[1]
+        return conversation
+
+    def set(self, session_id, conversation, expected_version=None):
+        now = time.time()
+        with self._transaction() as conn:
+            # An expired row counts as no conversation at all, i.e. version 0
+            current = conn.execute(
+                "SELECT CASE WHEN expires_at > ? THEN version ELSE 0 END FROM conversations WHERE session_id = ?",
+                (now, session_id)
+            ).fetchone()
+            current = current[0] if current else 0
+            if expected_version is not None and expected_version != current:
+                raise VersionConflict(f"Conversation {session_id} is at version {current}, not {expected_version}")
+            header, chunks, replace = self._encode(conversation, append=conversation.get('version') == current)
+            if replace:
+                conn.execute("DELETE FROM conversation_log WHERE session_id = ?", (session_id,))
+                seq = 0
+            else:
+                seq = conn.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM conversation_log WHERE session_id = ?",
+                                   (session_id,)).fetchone()[0]
+            conn.executemany("INSERT INTO conversation_log (session_id, seq, data) VALUES (?, ?, ?)",
+                             [(session_id, seq + i, chunk) for i, chunk in enumerate(chunks)])
+            conn.execute(
+                "INSERT INTO conversations (session_id, data, expires_at, version) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at, "
+                "version = excluded.version",
+                (session_id, header, now + self.ttl, current + 1)
+            )
+            self._writes += 1
+            if self._writes % self.PURGE_INTERVAL == 0:
+                expired = "SELECT session_id FROM conversations WHERE expires_at <= ?"
+                conn.execute(f"DELETE FROM conversation_log WHERE session_id IN ({expired})", (now,))
+                conn.execute("DELETE FROM conversations WHERE expires_at <= ?", (now,))
+        conversation['version'] = current + 1
+        return current + 1
+
+    def delete(self, session_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM conversation_log WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+
+
+class RedisStore(ConversationStore):
+    """Store backed by Redis or anything that speaks its get/set/delete interface
+
+    `client` only needs get(key), set(key, value, ex=seconds) and delete(key), so a
+    redis-py client or a local stand-in with the same methods both work. With a
+    redis-py client the header is stored under the conversation's key and its
+    message log in a list beside it, and versioned writes are atomic (WATCH/MULTI);
+    a stand-in without pipeline() gets the whole conversation written under its
+    key each time and a plain compare-then-set.
+    """
+
+    def __init__(self, client, ttl: int = DEFAULT_TTL, prefix: str = "nurse_ally:conversation:"):
+        super().__init__()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, session_id):
+        key = self.prefix + session_id
+        if not hasattr(self.client, 'pipeline'):
+            return decode(self.client.get(key))
+        # One transaction, so the header and the log are of the same write
+        with self.client.pipeline() as pipe:
+            pipe.get(key)
+            pipe.lrange(key + ':log', 0, -1)
+            header, log = pipe.execute()
+        return decode(header, log)
+
+    def set(self, session_id, conversation, expected_version=None):
+        key = self.prefix + session_id
+        if not hasattr(self.client, 'pipeline'):
+            current = (self.get(session_id) or {}).get('version', 0)
+            self._check_version(session_id, current, expected_version)
+            conversation['version'] = current + 1
+            data = encode(conversation)
+            self.stats['rewrite'] += 1
+            self.stats['bytes'] += len(data)
+            self.client.set(key, data, ex=self.ttl)
+            return current + 1
+
+        from redis.exceptions import WatchError
+        loaded = conversation.get('version')
+        while True:
+            with self.client.pipeline() as pipe:
+                try:
+                    pipe.watch(key)
+                    current = (decode(pipe.get(key)) or {}).get('version', 0)
+                    self._check_version(session_id, current, expected_version)
+                    # The version is part of the header here, so it is set first
+                    conversation['version'] = current + 1
+                    header, chunks, replace = self._encode(conversation, append=loaded == current)
+                    pipe.multi()
+                    pipe.set(key, header, ex=self.ttl)
+                    if replace:
+                        pipe.delete(key + ':log')
+                    if chunks:
+                        pipe.rpush(key + ':log', *chunks)
+                    pipe.expire(key + ':log', self.ttl)
+                    pipe.execute()
+                    return current + 1
+                except WatchError:
+                    # An unconditional write just tries again on top of the other one
+                    if expected_version is not None:
+                        raise VersionConflict(f"Conversation {session_id} changed while it was being saved")
+
+    @staticmethod
+    def _check_version(session_id, current, expected_version):
+        if expected_version is not None and expected_version != current:
+            raise VersionConflict(f"Conversation {session_id} is at version {current}, not {expected_version}")
+
+    def delete(self, session_id):
+        self.client.delete(self.prefix + session_id)
+        if hasattr(self.client, 'pipeline'):
+            self.client.delete(self.prefix + session_id + ':log')
+
+
+def create_store(url: Optional[str] = None) -> ConversationStore:
+    """Create a store from a URL such as 'memory', 'sqlite:///path/to/db' or 'redis://host:6379/0'
+
+    Defaults to the CONVERSATION_STORE environment variable, then to the in-memory store.
+    """
+    url = url or os.getenv("CONVERSATION_STORE", "memory")
+
+    if url == "memory":
+        return MemoryStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteStore(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://")):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The redis package is required for a redis:// conversation store")
+        return RedisStore(redis.Redis.from_url(url))
+
+    raise ValueError(f"Unknown conversation store: {url}")
+
+
+def register_metrics(store: ConversationStore):
+    """Export the store's write counts and bytes written on /metrics"""
+    metrics.callback('nurse_ally_conversation_writes_total', "Conversation writes by what they stored: the header "
+                     "only, the header and new messages appended to the log, or the whole log rewritten",
+                     lambda: {(kind,): store.stats[kind] for kind in ('header', 'append', 'rewrite')}, ['kind'],
+                     kind='counter')
+    metrics.callback('nurse_ally_conversation_write_bytes_total', "Bytes of conversation state written to the store",
+                     lambda: store.stats['bytes'], kind='counter')
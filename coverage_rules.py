@@ -0,0 +1,127 @@
+import os
+import json
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, NamedTuple, Optional, Tuple
+
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'coverage_rules.json')
+
+# Wildcards for the plan's default rule in any country and at any care level
+ANY_COUNTRY = '*'
+ANY_CARE_LEVEL = '*'
+
+
+class CoverageRule(NamedTuple):
+    covered: bool
+    note: str
+    checklist: Tuple[str, ...]
+
+
+class Provider(NamedTuple):
+    key: str
+    name: str
+    coverage: Tuple[str, ...]
+    network_restrictions: str
+    covers_recommended_treatment: bool
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "coverage": list(self.coverage),
+            "network_restrictions": self.network_restrictions
+        }
+
+
+def _normalize(value: Optional[str]) -> str:
+    return ' '.join((value or '').split()).casefold()
+
+
+class CoverageRules:
+    """Insurance coverage rules compiled into flat, read-only lookup tables
+
+    The rule file describes each plan's default coverage per care level, with
+    optional per-country overrides. At load time every (plan, country, care level)
+    combination is resolved into a CoverageRule, so a lookup is a handful of dict
+    hits walking from the most specific rule to the plan's wildcard rules.
+    """
+
+    def __init__(self, data: Mapping[str, Any]):
+        self.base_checklist = tuple(data.get('base_checklist', ()))
+        self._unknown_rule = CoverageRule(False, data.get('unknown_plan_note', ''), self.base_checklist)
+
+        rules: Dict[Tuple[str, str, str], CoverageRule] = {}
+        for plan, plan_data in data.get('plans', {}).items():
+            plan_key = _normalize(plan)
+            defaults = plan_data.get('care', {})
+            for care_level, care in defaults.items():
+                rules[(plan_key, ANY_COUNTRY, _normalize(care_level))] = self._compile(plan_data, care)
+            rules[(plan_key, ANY_COUNTRY, ANY_CARE_LEVEL)] = self._compile(plan_data, {})
+
+            # Country overrides inherit anything they don't set from the plan defaults
+            for country, override in plan_data.get('countries', {}).items():
+                country_key = _normalize(country)
+                note = override.get('note', plan_data.get('note', ''))
+                override_care = override.get('care', {})
+                for care_level in set(defaults) | set(override_care):
+                    care = dict(defaults.get(care_level, {}))
+                    care.update(override_care.get(care_level, {}))
+                    rules[(plan_key, country_key, _normalize(care_level))] = self._compile({'note': note}, care)
+                rules[(plan_key, country_key, ANY_CARE_LEVEL)] = self._compile({'note': note}, {})
+        self._rules = MappingProxyType(rules)
+
+        providers: Dict[str, Provider] = {}
+        for key, provider_data in data.get('providers', {}).items():
+            provider = Provider(
+                key=key,
+                name=provider_data['name'],
+                coverage=tuple(provider_data.get('coverage', ())),
+                network_restrictions=provider_data.get('network_restrictions', ''),
+                covers_recommended_treatment=provider_data.get('covers_recommended_treatment', False)
+            )
+            for alias in (key, provider_data['name'], *provider_data.get('aliases', ())):
+                providers[_normalize(alias)] = provider
+        self._providers = MappingProxyType(providers)
+
+    def _compile(self, plan_data, care) -> CoverageRule:
+        return CoverageRule(
+            covered=bool(care.get('covered', False)),
+            note=plan_data.get('note', ''),
+            checklist=self.base_checklist + tuple(care.get('checklist', ()))
+        )
+
+    def lookup(self, insurance_type: str, country: Optional[str], care_level: str) -> CoverageRule:
+        """Return the rule for a plan in a country at a care level
+
+        Falls back to the plan's default when there is no country-specific rule, to
+        the plan's note with no coverage for an unknown care level, and to an
+        'unknown plan' rule (not covered, base checklist only) for an unknown plan.
+        """
+        plan_key = _normalize(insurance_type)
+        country_key = _normalize(country)
+        care_key = _normalize(care_level)
+        for key in ((plan_key, country_key, care_key), (plan_key, ANY_COUNTRY, care_key),
+                    (plan_key, country_key, ANY_CARE_LEVEL), (plan_key, ANY_COUNTRY, ANY_CARE_LEVEL)):
+            rule = self._rules.get(key)
+            if rule is not None:
+                return rule
+        return self._unknown_rule
+
+    def provider(self, name: Optional[str]) -> Optional[Provider]:
+        """Return the provider known by this name, key or alias, if any"""
+        return self._providers.get(_normalize(name))
+
+    def __len__(self):
+        return len(self._rules)
+
+
+def load_coverage_rules(path: Optional[str] = None) -> CoverageRules:
+    """Load and compile the rule file (COVERAGE_RULES_PATH, or data/coverage_rules.json)"""
+    path = path or os.getenv("COVERAGE_RULES_PATH", DEFAULT_RULES_PATH)
+    with open(path, encoding='utf-8') as f:
+        return CoverageRules(json.load(f))
+
+
+@lru_cache(maxsize=None)
+def default_rules() -> CoverageRules:
+    """The process-wide rules, loaded once on first use"""
+    return load_coverage_rules()
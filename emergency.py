@@ -0,0 +1,144 @@
+import os
+import re
+import json
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, NamedTuple, Optional, Tuple
+
+from keywords import SCAN_CACHE_MAX_LENGTH, SCAN_CACHE_SIZE, KeywordMatcher
+
+DEFAULT_NUMBERS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'emergency_numbers.json')
+
+# Score at which a message is treated as an emergency
+EMERGENCY_THRESHOLD = 3.0
+
+# Weighted warning signs. Any single red flag reaches the threshold on its own;
+# the weaker signs only do in combination ("sudden severe headache"). Words with
+# a negative weight play down the weaker sign right after them ("mild headache")
+# but never a red flag
+EMERGENCY_SIGNALS: Mapping[str, float] = MappingProxyType({
+    # Red flags
+    'chest pain': 3, 'chest pressure': 3, 'crushing chest': 3, 'heart attack': 3,
+    'difficulty breathing': 3, 'trouble breathing': 3, 'struggling to breathe': 3, "can't breathe": 3,
+    'cannot breathe': 3, 'not breathing': 3, "isn't breathing": 3, 'stopped breathing': 3, 'choking': 3,
+    'blue lips': 3,
+    'unconscious': 3, 'unresponsive': 3, 'passed out': 3, 'fainting': 3, 'fainted': 3, 'collapsed': 3,
+    'seizure': 3, 'convulsion': 3, 'stroke': 3, 'face drooping': 3, 'slurred speech': 3, 'paralysis': 3,
+    'bleeding': 3, 'severe bleeding': 3, 'heavy bleeding': 3, "won't stop bleeding": 3,
+    'coughing up blood': 3, 'vomiting blood': 3, 'confusion': 3,
+    'anaphylaxis': 3, 'anaphylactic': 3, 'throat swelling': 3, 'throat closing': 3,
+    'overdose': 3, 'poisoning': 3, 'suicidal': 3, 'suicide': 3, 'kill myself': 3,
+    # Warning signs that count in combination
+    'shortness of breath': 2, 'head injury': 2, 'stiff neck': 1.5, 'numbness': 1.5, 'numb': 1.5,
+    'sudden': 1.5, 'severe': 1, 'worst': 1, 'high fever': 1, 'headache': 0.5, 'vomiting': 0.5,
+    'dizziness': 0.5, 'pain': 0.5,
+    # Words that play a sign down
+    'a little': -1.5, 'slight': -1.5, 'slightly': -1.5, 'minor': -1.5, 'mild': -1.5,
+})
+
+# A negation right before a sign, or separated from it only by words like "have
+# any", denies it ("no chest pain", "not bleeding anymore", "I don't have a
+# fever"). Anything else between them ("I never had chest pain like this", "not
+# sure whether it's chest pain") leaves the sign counted: when in doubt, the
+# message is treated as an emergency
+_NEGATION = re.compile(
+    r"\b(?:no|not|without|denies|deny|don't|doesn't|didn't|isn't|wasn't|hasn't|haven't|no longer)"
+    r"(?:\s+(?:have|has|had|any|a|an|feel|feeling|experience|experiencing|been|got|get|notice|noticed)){0,2}\s+$"
+)
+# How far back to look for a negation
+_NEGATION_WINDOW = 40
+# What may stand between a word that plays a sign down and the sign: a word, in
+# the same clause ("mild headache", "slightly bad headache")
+_DIMINISHED = re.compile(r"\s+(?:[\w']+\s+)?")
+
+RESPONSE_TEMPLATE = (
+    "This may be a medical emergency. Call {number}{note} now, or go to the nearest emergency department. "
+    "If someone is unconscious, not breathing or bleeding heavily, call straight away and follow the "
+    "dispatcher's instructions. Don't drive yourself, and don't wait for a reply here."
+)
+
+
+class EmergencyAssessment(NamedTuple):
+    is_emergency: bool
+    score: float
+    signals: Tuple[str, ...]
+
+
+class EmergencyDetector:
+    """Decides locally, without the model, whether a message describes an emergency
+
+    Warning signs are matched in one pass of the shared compiled matcher and summed
+    by weight; negated signs are ignored. Replies are rendered per country up front
+    so an emergency turn is a couple of dict lookups.
+    """
+
+    def __init__(self, numbers: Mapping[str, Any], signals: Mapping[str, float] = EMERGENCY_SIGNALS,
+                 threshold: float = EMERGENCY_THRESHOLD):
+        self.signals = {' '.join(keyword.lower().split()): weight for keyword, weight in signals.items()}
+        self.threshold = threshold
+        self._matcher = KeywordMatcher({'signal': self.signals})
+        # Per detector, and only for short messages, like KeywordMatcher's cache
+        self._cached_assess = lru_cache(maxsize=SCAN_CACHE_SIZE)(self._assess)
+
+        default = numbers.get('default', {})
+        self._default_response = self._render(default)
+        responses: Dict[str, str] = {}
+        for country, entry in numbers.get('countries', {}).items():
+            response = self._render(entry)
+            for name in (country, *entry.get('aliases', ())):
+                responses[_normalize(name)] = response
+        self._responses = MappingProxyType(responses)
+
+    @staticmethod
+    def _render(entry):
+        note = f" ({entry['note']})" if entry.get('note') else ''
+        return RESPONSE_TEMPLATE.format(number=entry.get('number', 'your local emergency number'), note=note)
+
+    def assess(self, text: str) -> EmergencyAssessment:
+        """Score the message and report the warning signs found in it"""
+        text = text.replace('’', "'").lower()
+        if len(text) > SCAN_CACHE_MAX_LENGTH:
+            return self._assess(text)
+        return self._cached_assess(text)
+
+    def _assess(self, lowered):
+        score = 0.0
+        signals = []
+        # (weight, end) of a word playing down the sign after it
+        diminisher = None
+        for keyword, start, end in self._matcher.finditer(lowered):
+            weight = self.signals[keyword]
+            if weight < 0:
+                diminisher = (weight, end)
+                continue
+            if _NEGATION.search(lowered[max(0, start - _NEGATION_WINDOW):start]):
+                continue
+            if (diminisher is not None and weight < self.threshold
+                    and _DIMINISHED.fullmatch(lowered, diminisher[1], start)):
+                weight = max(weight + diminisher[0], 0.0)
+            diminisher = None
+            score += weight
+            if keyword not in signals:
+                signals.append(keyword)
+        return EmergencyAssessment(bool(signals) and score >= self.threshold, score, tuple(signals))
+
+    def response_for(self, country: Optional[str]) -> str:
+        """The emergency reply with the emergency number for the user's country"""
+        return self._responses.get(_normalize(country), self._default_response)
+
+
+def _normalize(value: Optional[str]) -> str:
+    return ' '.join((value or '').replace('.', ' ').split()).casefold()
+
+
+def load_emergency_detector(path: Optional[str] = None) -> EmergencyDetector:
+    """Load the emergency numbers (EMERGENCY_NUMBERS_PATH, or data/emergency_numbers.json)"""
+    path = path or os.getenv("EMERGENCY_NUMBERS_PATH", DEFAULT_NUMBERS_PATH)
+    with open(path, encoding='utf-8') as f:
+        return EmergencyDetector(json.load(f))
+
+
+@lru_cache(maxsize=None)
+def default_detector() -> EmergencyDetector:
+    """The process-wide detector, loaded once on first use"""
+    return load_emergency_detector()
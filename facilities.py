@@ -0,0 +1,159 @@
+import os
+import csv
+import json
+import math
+import heapq
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+DEFAULT_FACILITIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'facilities.csv')
+DEFAULT_RADIUS_KM = float(os.getenv("FACILITY_SEARCH_RADIUS_KM", "25"))
+DEFAULT_LIMIT = int(os.getenv("FACILITY_SEARCH_LIMIT", "5"))
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# Grid cells are this many degrees on a side (about 28 km of latitude), so a search
+# within the default radius only looks at the few cells around the user
+DEFAULT_CELL_DEGREES = 0.25
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two points in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class Facility(NamedTuple):
+    name: str
+    type: str
+    address: str
+    city: str
+    country: str
+    latitude: float
+    longitude: float
+    phone: Optional[str]
+    website: Optional[str]
+    services: Tuple[str, ...]
+    rating: Optional[float]
+
+    def to_dict(self, distance_km: float) -> Dict[str, Any]:
+        """The facility card shape the frontend renders"""
+        return {
+            "name": self.name,
+            "address": self.address,
+            "distance": f"{distance_km:.1f} km",
+            "distance_km": round(distance_km, 2),
+            "type": self.type,
+            "rating": self.rating,
+            "wait_time": None,
+            "services": list(self.services),
+            "phone": self.phone,
+            "website": self.website,
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "google_maps_url": f"https://www.google.com/maps/search/?api=1&query={self.latitude},{self.longitude}"
+        }
+
+
+class FacilityIndex:
+    """Healthcare facilities bucketed into a latitude/longitude grid
+
+    A search only measures the facilities in the grid cells that overlap the search
+    radius, instead of every facility in the dataset, and returns the nearest ones
+    of the requested types by great-circle distance.
+    """
+
+    def __init__(self, facilities: Iterable[Facility], cell_degrees: float = DEFAULT_CELL_DEGREES):
+        self.facilities: Tuple[Facility, ...] = tuple(facilities)
+        self.cell_degrees = cell_degrees
+        self._lon_cells = math.ceil(360 / cell_degrees)
+
+        grid: Dict[Tuple[int, int], List[Facility]] = {}
+        for facility in self.facilities:
+            grid.setdefault(self._cell(facility.latitude, facility.longitude), []).append(facility)
+        self._grid = {cell: tuple(members) for cell, members in grid.items()}
+
+    def _cell(self, latitude, longitude):
+        return (math.floor((latitude + 90) / self.cell_degrees),
+                math.floor(((longitude + 180) % 360) / self.cell_degrees) % self._lon_cells)
+
+    def _candidates(self, latitude, longitude, radius_km):
+        lat_span = radius_km / KM_PER_DEGREE
+        row_low, _ = self._cell(max(latitude - lat_span, -90.0), longitude)
+        row_high, _ = self._cell(min(latitude + lat_span, 90.0), longitude)
+
+        # Degrees of longitude shrink towards the poles; near them scan every column
+        cos_lat = math.cos(math.radians(min(abs(latitude) + lat_span, 90.0)))
+        lon_span = radius_km / (KM_PER_DEGREE * cos_lat) if cos_lat > 1e-6 else 180.0
+        if lon_span >= 180:
+            columns: Iterable[int] = range(self._lon_cells)
+        else:
+            _, col_low = self._cell(latitude, longitude - lon_span)
+            col_count = math.ceil(2 * lon_span / self.cell_degrees) + 1
+            columns = {(col_low + i) % self._lon_cells for i in range(min(col_count, self._lon_cells))}
+
+        for row in range(row_low, row_high + 1):
+            for column in columns:
+                yield from self._grid.get((row, column), ())
+
+    def nearest(self, latitude: float, longitude: float, types: Optional[Sequence[str]] = None,
+                limit: int = DEFAULT_LIMIT, radius_km: float = DEFAULT_RADIUS_KM) -> List[Tuple[float, Facility]]:
+        """Return up to `limit` (distance_km, facility) pairs within `radius_km`,
+        nearest first, optionally restricted to the given facility types"""
+        wanted = {t.casefold() for t in types} if types else None
+        found = []
+        for facility in self._candidates(latitude, longitude, radius_km):
+            if wanted is not None and facility.type.casefold() not in wanted:
+                continue
+            distance = haversine_km(latitude, longitude, facility.latitude, facility.longitude)
+            if distance <= radius_km:
+                found.append((distance, facility))
+        return heapq.nsmallest(limit, found, key=lambda pair: pair[0])
+
+    def __len__(self):
+        return len(self.facilities)
+
+
+def _facility(record: Dict[str, Any], latitude, longitude) -> Facility:
+    services = record.get('services') or ()
+    if isinstance(services, str):
+        services = [s.strip() for s in services.split(';') if s.strip()]
+    rating = record.get('rating')
+    return Facility(
+        name=record['name'],
+        type=record.get('type') or 'Hospital',
+        address=record.get('address') or '',
+        city=record.get('city') or '',
+        country=record.get('country') or '',
+        latitude=float(latitude),
+        longitude=float(longitude),
+        phone=record.get('phone') or None,
+        website=record.get('website') or None,
+        services=tuple(services),
+        rating=float(rating) if rating not in (None, '') else None
+    )
+
+
+def load_facilities(path: Optional[str] = None) -> FacilityIndex:
+    """Load facilities from a CSV file or a GeoJSON FeatureCollection of points
+    (FACILITIES_PATH, or data/facilities.csv) and index them"""
+    path = path or os.getenv("FACILITIES_PATH", DEFAULT_FACILITIES_PATH)
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith(('.geojson', '.json')):
+            features = json.load(f).get('features', [])
+            facilities = [_facility(feature.get('properties', {}), feature['geometry']['coordinates'][1],
+                                    feature['geometry']['coordinates'][0])
+                          for feature in features if (feature.get('geometry') or {}).get('type') == 'Point']
+        else:
+            facilities = [_facility(row, row['latitude'], row['longitude']) for row in csv.DictReader(f)]
+    return FacilityIndex(facilities)
+
+
+@lru_cache(maxsize=None)
+def default_index() -> FacilityIndex:
+    """The process-wide facility index, loaded once on first use"""
+    return load_facilities()
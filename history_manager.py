@@ -0,0 +1,151 @@
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+# Token budget for the whole prompt: system prompt, facts, summary and recent turns
+DEFAULT_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+# Part of the budget reserved for the rolling summary of older turns
+DEFAULT_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "400"))
+# The most recent messages are always sent verbatim, whatever their size
+DEFAULT_MIN_RECENT_MESSAGES = 4
+# When the recent window overflows it is cut back to this fraction of its budget, so
+# the summary is only recomputed every few turns instead of on every turn
+LOW_WATER_MARK = 0.6
+
+# Fixed per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# First lines of the system messages carrying the facts and the rolling summary
+FACTS_HEADER = "Known facts about this conversation:"
+SUMMARY_HEADER = "Summary of the earlier conversation:"
+
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s|\n')
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (about four characters per token for English text)"""
+    return len(text) // 4 + 1
+
+
+def message_tokens(message: Dict[str, str]) -> int:
+    return estimate_tokens(message.get('content') or '') + MESSAGE_OVERHEAD_TOKENS
+
+
+def compact_summary(previous: str, messages: Sequence[Dict[str, str]], max_tokens: int) -> str:
+    """Extend the summary with the first sentence of each message, dropping the oldest
+    lines once it no longer fits in max_tokens"""
+    lines = previous.splitlines() if previous else []
+    for message in messages:
+        content = (message.get('content') or '').strip()
+        if not content:
+            continue
+        first_sentence = _SENTENCE_END.split(content, 1)[0]
+        if len(first_sentence) > 160:
+            first_sentence = first_sentence[:157] + '...'
+        speaker = 'User' if message.get('role') == 'user' else 'Nurse Ally'
+        lines.append(f"{speaker}: {first_sentence}")
+
+    while lines and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+class LLMSummarizer:
+    """Summarizer that asks the model to fold evicted turns into the running summary"""
+
+    PROMPT = ("Update the summary of a healthcare navigation conversation with the new messages. "
+              "Keep symptoms, urgency, insurance, location and any decisions. Reply with the "
+              "summary only, in at most {words} words.")
+
+    def __init__(self, llm):
+        self.llm = llm
+
+    def __call__(self, previous: str, messages: Sequence[Dict[str, str]], max_tokens: int) -> str:
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        prompt = [
+            {"role": "system", "content": self.PROMPT.format(words=max_tokens * 3 // 4)},
+            {"role": "user", "content": f"Current summary:\n{previous or '(none)'}\n\nNew messages:\n{transcript}"}
+        ]
+        return self.llm.chat(prompt, agent="summarizer", temperature=0)
+
+
+class HistoryManager:
+    """Builds prompts that stay under a token budget however long the conversation gets
+
+    Recent turns are sent verbatim. Older turns are folded into a rolling summary that
+    is cached in the conversation state and only extended with the turns that leave
+    the window, and structured state (urgency, insurance, location...) is sent as a
+    short block of system facts rather than relying on the history to carry it.
+    """
+
+    def __init__(self, max_tokens: int = DEFAULT_TOKEN_BUDGET, summary_tokens: int = DEFAULT_SUMMARY_TOKENS,
+                 min_recent_messages: int = DEFAULT_MIN_RECENT_MESSAGES,
+                 summarizer: Optional[Callable[[str, Sequence[Dict[str, str]], int], str]] = None):
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.min_recent_messages = min_recent_messages
+        self.summarizer = summarizer or compact_summary
+
+    def build_messages(self, system_prompt: str, history: List[Dict[str, str]], state: Dict[str, Any],
+                       user_message: Optional[str] = None, facts: Sequence[str] = ()) -> List[Dict[str, str]]:
+        """Return the messages for a completion call
+
+        `state` is the conversation state dict; the rolling summary is cached in it
+        under 'history_summary' so it has to be saved with the conversation.
+        """
+        messages = [{"role": "system", "content": system_prompt}]
+        if facts:
+            facts_text = FACTS_HEADER + "\n" + "\n".join(f"- {fact}" for fact in facts)
+            messages.append({"role": "system", "content": facts_text})
+
+        # Budget left for the recent turns once the fixed parts are accounted for
+        fixed_tokens = sum(message_tokens(m) for m in messages) + self.summary_tokens
+        pending = None
+        if user_message and (not history or history[-1]['role'] != 'user' or history[-1]['content'] != user_message):
+            pending = {"role": "user", "content": user_message}
+            fixed_tokens += message_tokens(pending)
+
+        summary = self._update_summary(history, state, max(self.max_tokens - fixed_tokens, 0))
+        if summary['text']:
+            messages.append({"role": "system", "content": SUMMARY_HEADER + "\n" + summary['text']})
+
+        messages.extend(history[summary['covered']:])
+        if pending:
+            messages.append(pending)
+        return messages
+
+    def _update_summary(self, history, state, recent_budget):
+        summary = state.get('history_summary')
+        if not summary or summary.get('covered', 0) > len(history):
+            summary = {'text': '', 'covered': 0}
+
+        covered = summary['covered']
+        recent_tokens = sum(message_tokens(m) for m in history[covered:])
+        if recent_tokens <= recent_budget:
+            state['history_summary'] = summary
+            return summary
+
+        # Slide the window forward to the low-water mark, keeping the newest messages
+        target = recent_budget * LOW_WATER_MARK
+        new_covered = covered
+        last_allowed = len(history) - self.min_recent_messages
+        while new_covered < last_allowed and recent_tokens > target:
+            recent_tokens -= message_tokens(history[new_covered])
+            new_covered += 1
+
+        if new_covered > covered:
+            text = self.summarizer(summary['text'], history[covered:new_covered], self.summary_tokens)
+            summary = {'text': text, 'covered': new_covered}
+        state['history_summary'] = summary
+        return summary
+
+
+def create_history_manager(llm=None) -> HistoryManager:
+    """Create the history manager configured by the environment
+
+    HISTORY_SUMMARIZER=llm uses the model for the rolling summary; the default is a
+    local extractive summary that adds no latency to the turn.
+    """
+    if os.getenv("HISTORY_SUMMARIZER", "extractive") == "llm" and llm is not None:
+        return HistoryManager(summarizer=LLMSummarizer(llm))
+    return HistoryManager()
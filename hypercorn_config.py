@@ -0,0 +1,21 @@
+"""Hypercorn settings for serving Nurse Ally in production
+
+    hypercorn --config file:hypercorn_config.py asgi:app
+
+The same settings serve the synchronous Flask app (app:app) as well.
+"""
+import os
+
+bind = [f"0.0.0.0:{os.getenv('PORT', '5000')}"]
+
+# Each worker is a separate process with its own event loop. Conversations and
+# upload jobs are only shared between workers with CONVERSATION_STORE set to
+# sqlite or redis, so the default is one worker
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "asyncio"
+
+keep_alive_timeout = 75
+graceful_timeout = float(os.getenv("GRACEFUL_TIMEOUT", "30"))
+
+accesslog = "-"
+errorlog = "-"
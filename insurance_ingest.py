@@ -0,0 +1,334 @@
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import metrics
+from card_ocr import IMAGE_EXTENSIONS, OCRUnavailable, card_details, read_card
+from keywords import KeywordMatcher
+from coverage_rules import default_rules
+from policy_index import PAGE_BREAK, PolicyIndex, index_path_for
+
+DEFAULT_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# Finished jobs are forgotten after this long; their results live on in the conversation
+DEFAULT_JOB_TTL = int(os.getenv("INGEST_JOB_TTL", "3600"))
+# Clauses of each kind kept in the structured result
+MAX_CLAUSES_PER_KIND = 8
+MAX_CLAUSE_CHARS = 300
+# Lines repeated this many times are page headers or footers
+REPEATED_LINE_COUNT = 3
+
+logger = logging.getLogger(__name__)
+
+INGESTION_SECONDS = metrics.histogram('nurse_ally_ingestion_seconds', "Time from an insurance document's upload "
+                                      "to the end of its ingestion, by outcome", ['status'])
+
+# Insurers recognised in policy documents, with the name to show for each keyword
+INSURER_NAMES = {
+    'aetna': 'Aetna', 'aig': 'AIG', 'allianz': 'Allianz', 'anthem': 'Anthem', 'april international': 'APRIL International',
+    'axa': 'AXA', 'blue cross': 'Blue Cross Blue Shield', 'blue shield': 'Blue Cross Blue Shield', 'bupa': 'Bupa',
+    'chubb': 'Chubb', 'cigna': 'Cigna', 'europ assistance': 'Europ Assistance', 'generali': 'Generali',
+    'geoblue': 'GeoBlue', 'humana': 'Humana', 'kaiser': 'Kaiser Permanente', 'mapfre': 'Mapfre',
+    'medicaid': 'Medicaid', 'medicare': 'Medicare', 'safetywing': 'SafetyWing', 'united healthcare': 'UnitedHealthcare',
+    'world nomads': 'World Nomads', 'zurich': 'Zurich',
+}
+INSURERS = KeywordMatcher({'insurer': INSURER_NAMES})
+
+# Plan types from the coverage rules, in the order they are tried
+PLAN_TYPES = KeywordMatcher({
+    'EHIC': ['european health insurance card', 'ehic', 'ghic'],
+    'Travel': ['travel insurance', 'travel medical', 'schengen', 'trip', 'travel'],
+    'Private': ['private health', 'private medical', 'international health', 'expatriate', 'expat'],
+})
+PLAN_TYPE_ORDER = ('EHIC', 'Travel', 'Private')
+
+# Kinds of clause worth surfacing, most specific first
+CLAUSE_KINDS = ('exclusion', 'limit', 'coverage')
+CLAUSES = KeywordMatcher({
+    'exclusion': ['exclusion', 'excluded', 'not covered', 'not cover', 'does not cover', 'shall not'],
+    'limit': ['maximum', 'up to', 'limit', 'excess', 'deductible', 'threshold', 'ceiling', 'co-payment'],
+    'coverage': ['cover', 'coverage', 'reimburse', 'reimbursement', 'payment of', 'we will pay', 'benefit',
+                 'medical expenses', 'hospitalization', 'hospitalisation', 'repatriation'],
+})
+
+POLICY_NUMBER = re.compile(
+    r'\b(?:policy|certificate|contract|member)\s*(?:no\.?|number|#|id)\s*[:#]?\s*([A-Z0-9][A-Z0-9/-]{4,})',
+    re.IGNORECASE
+)
+AMOUNT = re.compile(r'[€$£]\s?\d|\d[\d,.\s]*\s?(?:EUR|USD|GBP|CHF|euros?|dollars?)\b', re.IGNORECASE)
+_CLAUSE_SPLIT = re.compile(r'(?<=[.;])\s+|\n{2,}|\f')
+_QUOTES = re.compile(r'["“”]')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def extract_text(path: str) -> Tuple[str, int]:
+    """Return the text of a policy document and its page count
+
+    PDFs are read from their text layer and photos of insurance cards with OCR
+    (raising OCRUnavailable without it). Pages are separated by form feeds.
+    """
+    if path.lower().endswith(IMAGE_EXTENSIONS):
+        return read_card(path), 1
+    if not path.lower().endswith('.pdf'):
+        return '', 0
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise RuntimeError("The pypdf package is required to extract text from PDF uploads")
+
+    reader = PdfReader(path)
+    pages = [page.extract_text() or '' for page in reader.pages]
+    return PAGE_BREAK.join(pages), len(pages)
+
+
+def _plan_name(text):
+    """The first heading line naming the insurance product, if any"""
+    for line in text.splitlines()[:15]:
+        line = _WHITESPACE.sub(' ', _QUOTES.sub('', line)).strip()
+        if 'insurance' in line.lower() and len(line) <= 80:
+            return line
+    return None
+
+
+def strip_page_furniture(text: str) -> str:
+    """Drop header and footer lines repeated on many pages, keeping page breaks"""
+    pages = [page.split('\n') for page in text.split(PAGE_BREAK)]
+    counts: Dict[str, int] = {}
+    for lines in pages:
+        for line in lines:
+            line = line.strip()
+            if line:
+                counts[line] = counts.get(line, 0) + 1
+    return PAGE_BREAK.join(
+        '\n'.join(line for line in lines if counts.get(line.strip(), 0) < REPEATED_LINE_COUNT)
+        for lines in pages
+    )
+
+
+def _is_heading(clause):
+    letters = [ch for ch in clause if ch.isalpha()]
+    return not letters or sum(ch.isupper() for ch in letters) / len(letters) > 0.6
+
+
+def _clauses(text) -> List[Dict[str, str]]:
+    candidates: Dict[str, List[Tuple[bool, int, str]]] = {kind: [] for kind in CLAUSE_KINDS}
+    seen = set()
+    for position, raw in enumerate(_CLAUSE_SPLIT.split(text)):
+        clause = _WHITESPACE.sub(' ', raw).strip()
+        # Skip table-of-contents entries, headings and duplicates
+        if len(clause) < 40 or clause in seen or _is_heading(clause):
+            continue
+        hits = CLAUSES.scan(clause)
+        kind = next((k for k in CLAUSE_KINDS if k in hits), None)
+        if kind is None:
+            continue
+        seen.add(clause)
+        if len(clause) > MAX_CLAUSE_CHARS:
+            clause = clause[:MAX_CLAUSE_CHARS - 3] + '...'
+        candidates[kind].append((not AMOUNT.search(clause), position, clause))
+
+    # Clauses stating an amount are the most useful; keep those first, then
+    # restore document order
+    clauses = []
+    for kind in CLAUSE_KINDS:
+        chosen = sorted(candidates[kind])[:MAX_CLAUSES_PER_KIND]
+        clauses.extend({'kind': kind, 'text': clause} for _, _, clause in sorted(chosen, key=lambda c: c[1]))
+    return clauses
+
+
+def detect_policy_details(text: str) -> Dict[str, Any]:
+    """Detect the insurer, plan type, policy number and notable coverage clauses"""
+    insurer = None
+    insurer_hits = INSURERS.scan(text).get('insurer')
+    if insurer_hits:
+        # Prefer the canonical provider name when the coverage rules know the insurer
+        provider = default_rules().provider(insurer_hits[0])
+        insurer = provider.name if provider else INSURER_NAMES[insurer_hits[0]]
+
+    plan_hits = PLAN_TYPES.scan(text)
+    plan_type = next((plan for plan in PLAN_TYPE_ORDER if plan in plan_hits), None)
+
+    policy_number = POLICY_NUMBER.search(text)
+    return {
+        'insurer': insurer,
+        'plan_type': plan_type,
+        'plan_name': _plan_name(text),
+        'policy_number': policy_number.group(1) if policy_number else None,
+        'clauses': _clauses(text)
+    }
+
+
+def result_path_for(path: str) -> str:
+    return path + '.result.json'
+
+
+def cached_result(path: str) -> Optional[Dict[str, Any]]:
+    """The result of an earlier ingestion of the same file, if its artifacts are all still there"""
+    try:
+        with open(result_path_for(path), encoding='utf-8') as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if any(result.get(key) and not os.path.exists(result[key]) for key in ('text_path', 'index_path')):
+        return None
+    return result
+
+
+def ingest_document(path: str) -> Dict[str, Any]:
+    """Extract and analyse one uploaded document; runs in a worker process
+
+    The extracted text is written next to the upload as <upload>.txt, a retrieval
+    index over its chunks as <upload>.index.json and the result as
+    <upload>.result.json, so later steps, and later uploads of the same file,
+    reuse them without parsing the document again. A card photo's result also
+    has the card's number and validity; it isn't saved if the photo couldn't be
+    read for want of OCR, so it is read once OCR is installed.
+    """
+    started = time.time()
+    is_card = path.lower().endswith(IMAGE_EXTENSIONS)
+    try:
+        text, pages = extract_text(path)
+        ocr_unavailable = False
+    except OCRUnavailable as e:
+        logger.warning("Insurance card not read: %s", e)
+        text, pages, ocr_unavailable = '', 1, True
+    text_path = index_path = None
+    if text.strip():
+        text = strip_page_furniture(text)
+        text_path = path + '.txt'
+        with open(text_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        index_path = index_path_for(path)
+        PolicyIndex.from_text(text).save(index_path)
+
+    result = detect_policy_details(text)
+    if is_card:
+        result.update(card_details(text), document_type='card')
+    result.update({
+        'pages': pages,
+        'text_extracted': bool(text_path),
+        'text_path': text_path,
+        'index_path': index_path,
+        'seconds': round(time.time() - started, 3)
+    })
+    if ocr_unavailable:
+        result['ocr'] = 'unavailable'
+        return result
+    temp_path = f"{result_path_for(path)}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+    os.replace(temp_path, result_path_for(path))
+    return result
+
+
+class IngestionJobs:
+    """Runs document ingestion in a worker pool and tracks each upload's job
+
+    submit() returns a job id straight away. The parsing happens in worker
+    processes, and when a job finishes `on_complete(job)` is called from a pool
+    thread so the caller can write the result into the conversation. A file
+    ingested before (the same content, in the upload store) is done at once with
+    the earlier result; on_complete isn't called for it, since get() has the
+    result as soon as submit() returns.
+    """
+
+    def __init__(self, on_complete: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 max_workers: int = DEFAULT_WORKERS, job_ttl: int = DEFAULT_JOB_TTL,
+                 executor: Optional[Executor] = None):
+        self.on_complete = on_complete
+        self.max_workers = max_workers
+        self.job_ttl = job_ttl
+        self._executor = executor
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._futures: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _ensure_executor(self):
+        # Created on first use so importing the app doesn't start worker processes
+        if self._executor is None:
+            if multiprocessing.current_process().daemon:
+                # Hypercorn's workers are daemon processes, which can't start children
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ingest')
+            else:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def submit(self, session_id: str, path: str, filename: str) -> str:
+        """Queue a document for ingestion and return its job id"""
+        job_id = uuid.uuid4().hex
+        job = {
+            'job_id': job_id,
+            'session_id': session_id,
+            'filename': filename,
+            'path': path,
+            'status': 'queued',
+            'submitted_at': time.time(),
+            'finished_at': None,
+            'result': None,
+            'error': None
+        }
+        result = cached_result(path)
+        if result is not None:
+            job.update(status='done', result=dict(result, reused=True), finished_at=time.time())
+            with self._lock:
+                self._prune()
+                self._jobs[job_id] = job
+            INGESTION_SECONDS.observe(job['finished_at'] - job['submitted_at'], status='reused')
+            return job_id
+
+        with self._lock:
+            self._prune()
+            self._jobs[job_id] = job
+            executor = self._ensure_executor()
+            future = executor.submit(ingest_document, path)
+            self._futures[job_id] = future
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return a copy of the job, or None if it is unknown or expired"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+            future = self._futures.get(job_id)
+        if job['status'] == 'queued' and future is not None and future.running():
+            job['status'] = 'processing'
+        return job
+
+    def _finish(self, job_id, future):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            self._futures.pop(job_id, None)
+            if job is None:
+                return
+            error = future.exception()
+            if error is None:
+                job.update(status='done', result=future.result())
+            else:
+                job.update(status='failed', error=str(error) or error.__class__.__name__)
+            job['finished_at'] = time.time()
+            job = dict(job)
+        INGESTION_SECONDS.observe(job['finished_at'] - job['submitted_at'], status=job['status'])
+
+        if self.on_complete is not None:
+            try:
+                self.on_complete(job)
+            except Exception as e:
+                logger.exception("Error applying ingestion result for job %s: %s", job_id, e)
+
+    def _prune(self):
+        cutoff = time.time() - self.job_ttl
+        for job_id in [j for j, job in self._jobs.items() if job['finished_at'] and job['finished_at'] < cutoff]:
+            del self._jobs[job_id]
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
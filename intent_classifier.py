@@ -0,0 +1,181 @@
+import os
+import re
+import csv
+import math
+import zlib
+import random
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from keywords import SCAN_CACHE_MAX_LENGTH, SCAN_CACHE_SIZE
+
+DEFAULT_EXAMPLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'intents.tsv')
+# Below this probability the classifier defers to the keyword rules
+DEFAULT_CONFIDENCE_THRESHOLD = float(os.getenv("INTENT_CONFIDENCE_THRESHOLD", "0.6"))
+
+# Features are hashed into this many buckets, so the vocabulary needs no storage
+HASH_BITS = 20
+_HASH_MASK = (1 << HASH_BITS) - 1
+
+# Training settings
+EPOCHS = 25
+LEARNING_RATE = 0.5
+L2 = 1e-5
+SEED = 13
+
+_WORD = re.compile(r"[\w']+")
+
+
+def _hash(feature: str) -> int:
+    # crc32 rather than hash(), which is salted per process for strings
+    return zlib.crc32(feature.encode('utf-8')) & _HASH_MASK
+
+
+def features(text: str) -> Dict[int, float]:
+    """Hashed word unigrams and bigrams plus character 3- and 4-grams of each word
+
+    Character n-grams make the model tolerant of typos ("insurence", "docter");
+    values are L2-normalized so long messages don't dominate.
+    """
+    words = _WORD.findall(text.lower())
+    names = [f"w:{w}" for w in words]
+    names += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f"<{word}>"
+        for n in (3, 4):
+            names += [f"c:{padded[i:i + n]}" for i in range(len(padded) - n + 1)]
+    if not names:
+        return {}
+
+    counts: Dict[int, float] = {}
+    for name in names:
+        key = _hash(name)
+        counts[key] = counts.get(key, 0.0) + 1.0
+    norm = math.sqrt(sum(v * v for v in counts.values()))
+    return {key: value / norm for key, value in counts.items()}
+
+
+def _softmax(scores: Sequence[float]) -> List[float]:
+    top = max(scores)
+    exps = [math.exp(s - top) for s in scores]
+    total = sum(exps)
+    return [e / total for e in exps]
+
+
+class Intent(NamedTuple):
+    label: str
+    confidence: float
+    probabilities: Mapping[str, float]
+
+
+class IntentClassifier:
+    """Multinomial logistic regression over hashed n-gram features
+
+    Weights are kept sparsely, only for the feature buckets seen in training, so
+    classifying a message is a few hundred dict lookups. Probabilities are
+    calibrated with a temperature fitted on held-out examples.
+    """
+
+    def __init__(self, labels: Sequence[str], weights: Dict[int, List[float]], bias: List[float],
+                 temperature: float = 1.0):
+        self.labels = tuple(labels)
+        self.weights = weights
+        self.bias = bias
+        self.temperature = temperature
+        # Per classifier, and only for short messages, like KeywordMatcher's cache
+        self._cached_classify = lru_cache(maxsize=SCAN_CACHE_SIZE)(self._classify)
+
+    @classmethod
+    def train(cls, examples: Sequence[Tuple[str, str]], epochs: int = EPOCHS, learning_rate: float = LEARNING_RATE,
+              l2: float = L2, seed: int = SEED) -> 'IntentClassifier':
+        """Fit the model on (label, text) examples with stochastic gradient descent"""
+        labels = sorted({label for label, _ in examples})
+        index = {label: i for i, label in enumerate(labels)}
+        data = [(features(text), index[label]) for label, text in examples]
+        weights: Dict[int, List[float]] = {}
+        bias = [0.0] * len(labels)
+
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(data)
+            rate = learning_rate / (1 + epoch * 0.1)
+            for x, y in data:
+                rows = [weights.setdefault(key, [0.0] * len(labels)) for key in x]
+                scores = [bias[c] + sum(row[c] * v for row, v in zip(rows, x.values())) for c in range(len(labels))]
+                probs = _softmax(scores)
+                for c in range(len(labels)):
+                    gradient = probs[c] - (1.0 if c == y else 0.0)
+                    bias[c] -= rate * gradient
+                    for row, v in zip(rows, x.values()):
+                        row[c] -= rate * (gradient * v + l2 * row[c])
+        return cls(labels, weights, bias)
+
+    def _scores(self, x: Mapping[int, float]) -> List[float]:
+        scores = list(self.bias)
+        for key, value in x.items():
+            row = self.weights.get(key)
+            if row is not None:
+                for c, w in enumerate(row):
+                    scores[c] += w * value
+        return scores
+
+    def fit_temperature(self, examples: Sequence[Tuple[str, str]]) -> float:
+        """Pick the softmax temperature that minimizes log loss on held-out examples"""
+        index = {label: i for i, label in enumerate(self.labels)}
+        scored = [(self._scores(features(text)), index[label]) for label, text in examples if label in index]
+        if not scored:
+            return self.temperature
+
+        def log_loss(t):
+            return -sum(math.log(max(_softmax([s / t for s in scores])[y], 1e-12)) for scores, y in scored)
+
+        self.temperature = min((0.25 + 0.05 * i for i in range(96)), key=log_loss)
+        self._cached_classify.cache_clear()
+        return self.temperature
+
+    def predict_proba(self, text: str) -> Dict[str, float]:
+        scores = self._scores(features(text))
+        return dict(zip(self.labels, _softmax([s / self.temperature for s in scores])))
+
+    def classify(self, text: str) -> Intent:
+        """Return the most likely intent with its calibrated probability"""
+        text = ' '.join(text.split())
+        if len(text) > SCAN_CACHE_MAX_LENGTH:
+            return self._classify(text)
+        return self._cached_classify(text)
+
+    def _classify(self, text):
+        probabilities = self.predict_proba(text)
+        label = max(probabilities, key=probabilities.get)
+        return Intent(label, probabilities[label], MappingProxyType(probabilities))
+
+
+def load_examples(path: Optional[str] = None) -> List[Tuple[str, str]]:
+    """Read (label, text) pairs from a tab-separated file with a header row"""
+    path = path or os.getenv("INTENT_EXAMPLES_PATH", DEFAULT_EXAMPLES_PATH)
+    with open(path, encoding='utf-8', newline='') as f:
+        return [(row['label'], row['text']) for row in csv.DictReader(f, delimiter='\t') if row.get('text')]
+
+
+def split_examples(examples: Sequence[Tuple[str, str]], holdout: int = 5) -> Tuple[list, list]:
+    """Deterministically hold out about one example in `holdout` for calibration"""
+    train, held_out = [], []
+    for example in examples:
+        (held_out if zlib.crc32(example[1].encode('utf-8')) % holdout == 0 else train).append(example)
+    return train, held_out
+
+
+def train_classifier(examples: Sequence[Tuple[str, str]]) -> IntentClassifier:
+    """Fit the temperature on a held-out split, then train on every example"""
+    train, held_out = split_examples(examples)
+    temperature = IntentClassifier.train(train).fit_temperature(held_out)
+    classifier = IntentClassifier.train(examples)
+    classifier.temperature = temperature
+    return classifier
+
+
+@lru_cache(maxsize=None)
+def default_classifier() -> IntentClassifier:
+    """The process-wide classifier, trained once from the bundled examples"""
+    return train_classifier(load_examples())
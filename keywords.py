@@ -0,0 +1,141 @@
+import re
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Iterable, Iterator, Mapping, Tuple
+
+# Inflections accepted after a keyword, so "headache" also matches "headaches" and
+# "immediate" matches "immediately", while "er" no longer matches "fever" or "water"
+_SUFFIXES = r'(?:s|es|ing|ed|ly)?'
+
+# Scans of short texts (the same user message is scanned by routing and by each
+# extractor) are cached; longer ones, like assistant replies, are scanned every
+# time rather than kept in memory
+SCAN_CACHE_SIZE = 256
+SCAN_CACHE_MAX_LENGTH = 200
+
+
+def _trie_pattern(phrases: Iterable[str]) -> str:
+    """Compile phrases into a regex shaped like a trie, so the engine walks shared
+    prefixes once instead of trying every keyword in turn"""
+    trie: Dict[str, dict] = {}
+    for phrase in phrases:
+        node = trie
+        for ch in phrase:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+
+    def emit(node):
+        is_end = '' in node
+        branches = [(r'\s+' if ch == ' ' else re.escape(ch)) + emit(child)
+                    for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        if len(branches) == 1 and not is_end:
+            return branches[0]
+        group = '(?:' + '|'.join(branches) + ')'
+        return group + '?' if is_end else group
+
+    return emit(trie)
+
+
+class KeywordMatcher:
+    """Finds keywords from several categories in a single pass over a message
+
+    All keywords are compiled once into one word-boundary-aware regex. scan() returns
+    every category that was hit, with the keywords that matched it in the order they
+    first appear.
+    """
+
+    def __init__(self, categories: Mapping[str, Iterable[str]]):
+        self.categories = {name: tuple(keywords) for name, keywords in categories.items()}
+
+        # A keyword may belong to several categories (e.g. "aetna")
+        self._keyword_categories: Dict[str, Tuple[str, ...]] = {}
+        for name, keywords in self.categories.items():
+            for keyword in keywords:
+                keyword = ' '.join(keyword.lower().split())
+                self._keyword_categories[keyword] = self._keyword_categories.get(keyword, ()) + (name,)
+
+        pattern = _trie_pattern(self._keyword_categories)
+        self._regex = re.compile(r'\b(' + pattern + ')' + _SUFFIXES + r'\b')
+
+        # Matches don't overlap, so a phrase like "chest pain" also has to report the
+        # keywords it contains ("pain")
+        self._contained: Dict[str, Tuple[str, ...]] = {}
+        for keyword in self._keyword_categories:
+            self._contained[keyword] = tuple(
+                other for other in self._keyword_categories
+                if other != keyword and re.search(r'\b' + re.escape(other) + r'\b', keyword)
+            )
+
+        # Per matcher, so the cache goes away with it
+        self._cached_scan = lru_cache(maxsize=SCAN_CACHE_SIZE)(self._scan)
+
+    def scan(self, text: str) -> Mapping[str, Tuple[str, ...]]:
+        """Return {category: matched keywords} for every category found in the text"""
+        if len(text) > SCAN_CACHE_MAX_LENGTH:
+            return self._scan(text.lower())
+        return self._cached_scan(' '.join(text.lower().split()))
+
+    def finditer(self, text: str) -> Iterator[Tuple[str, int, int]]:
+        """Yield (keyword, start, end) for every keyword occurrence in the lowercased text
+
+        Occurrences don't overlap: where keywords nest, only the longest is reported.
+        """
+        for match in self._regex.finditer(text.lower()):
+            yield ' '.join(match.group(1).split()), match.start(), match.end()
+
+    def _scan(self, text):
+        hits: Dict[str, list] = {}
+        for match in self._regex.finditer(text):
+            keyword = ' '.join(match.group(1).split())
+            for found_keyword in (keyword,) + self._contained[keyword]:
+                for category in self._keyword_categories[found_keyword]:
+                    found = hits.setdefault(category, [])
+                    if found_keyword not in found:
+                        found.append(found_keyword)
+        # Results are cached and shared between callers, so hand out read-only views
+        return MappingProxyType({category: tuple(found) for category, found in hits.items()})
+
+
+# Keywords looked for in user messages, shared by agent routing, symptom and insurance
+# extraction in app.py and by the NurseAlly triage in nurse_ally/agent.py (emergency
+# detection has its own weighted signals in emergency.py)
+USER_MESSAGE_KEYWORDS = KeywordMatcher({
+    'symptom': ['pain', 'hurt', 'sick', 'fever', 'cough', 'headache', 'injury', 'nausea', 'vomiting', 'dizziness'],
+    'symptom_mention': ['symptom'],
+    'insurance': ['insurance', 'coverage', 'plan', 'provider', 'aetna', 'blue cross', 'blue shield', 'cigna',
+                  'humana', 'kaiser', 'medicare', 'medicaid'],
+    'insurance_provider': ['aetna', 'blue cross', 'blue shield', 'cigna', 'humana', 'kaiser', 'medicare',
+                           'medicaid', 'united healthcare', 'anthem'],
+    'location': ['location', 'near me', 'nearby', 'closest', 'address', 'where'],
+    'facility': ['hospital', 'clinic', 'doctor', 'emergency room', 'er', 'urgent care', 'facility',
+                 'recommendation'],
+    'triage_severe': ['chest pain', 'heart', 'breathing', 'unconscious', 'severe bleeding', 'head injury',
+                      'stroke', 'seizure', 'anaphylaxis', 'allergic reaction'],
+    'triage_moderate': ['fever', 'infection', 'broken', 'fracture', 'sprain', 'cut', 'wound', 'vomiting',
+                        'dehydration', 'migraine', 'severe pain'],
+})
+
+# Urgency indicators looked for in the symptom assessment agent's replies, in
+# priority order
+URGENCY_LEVELS = ('emergency', 'urgent', 'routine')
+RESPONSE_KEYWORDS = KeywordMatcher({
+    'emergency': ['emergency', 'immediate', 'severe', 'critical', '911', 'ambulance'],
+    'urgent': ['urgent', 'soon', 'concerning', '24 hours', 'today'],
+    'routine': ['routine', 'mild', 'regular', 'appointment'],
+})
+
+
+def scan_message(text: str) -> Mapping[str, Tuple[str, ...]]:
+    """Scan a user message for every keyword category in one pass"""
+    return USER_MESSAGE_KEYWORDS.scan(text)
+
+
+def detect_urgency(text: str):
+    """Return the highest urgency level indicated by an assistant reply, or None"""
+    hits = RESPONSE_KEYWORDS.scan(text)
+    for level in URGENCY_LEVELS:
+        if level in hits:
+            return level
+    return None
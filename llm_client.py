@@ -0,0 +1,459 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import aiohttp
+import openai
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+# Load environment variables from .env file before reading the defaults below
+load_dotenv()
+
+import metrics
+from response_cache import ResponseCache, create_response_cache
+from admission import AdmissionController, Overloaded, create_admission_controller, current_tenant
+from circuit_breaker import CircuitBreaker, CircuitOpen, create_circuit_breaker
+from token_accounting import TokenLedger, count_tokens, create_token_ledger, message_tokens
+
+# Defaults can be overridden from the environment; the model can also be set per
+# agent with OPENAI_MODEL_<AGENT_NAME>, e.g. OPENAI_MODEL_SYMPTOM_ASSESSMENT=gpt-4o
+DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+DEFAULT_TEMPERATURE = float(os.getenv("OPENAI_TEMPERATURE", "0.7"))
+DEFAULT_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))     # seconds per attempt
+DEFAULT_DEADLINE = float(os.getenv("OPENAI_DEADLINE", "60"))   # seconds for a call including retries
+DEFAULT_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+DEFAULT_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "20"))
+
+# Errors that are worth another attempt: rate limits, overloaded or failing upstream,
+# dropped connections and timeouts
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+# Errors after which a turn is answered without the model: the call was refused
+# (overload, open circuit) or the upstream failed even after retries
+MODEL_UNAVAILABLE = (Overloaded, CircuitOpen, openai.error.OpenAIError)
+
+LLM_CALLS = metrics.counter('nurse_ally_llm_calls_total', "Model calls by outcome: ok, error, cancelled, "
+                            "cached (answered from the response cache) or refused (not admitted, circuit open)",
+                            ['agent', 'outcome'])
+LLM_SECONDS = metrics.histogram('nurse_ally_llm_call_seconds', "Time model calls took upstream, including "
+                                "retries; a streamed call lasts until its last token", ['agent'])
+LLM_TOKENS = metrics.counter('nurse_ally_llm_tokens_total', "Tokens sent to (in) and generated by (out) the model",
+                             ['agent', 'direction'])
+CACHE_LOOKUPS = metrics.counter('nurse_ally_response_cache_lookups_total', "Response cache lookups", ['result'])
+
+
+class _SharedSession(requests.Session):
+    """requests session shared by every thread
+
+    The openai library recycles its per-thread session every few minutes by closing
+    it, which would tear down the shared connection pool, so close() is a no-op here
+    and shutdown() really closes the session.
+    """
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+class LLMClient:
+    """Chat completion client shared by all agents
+
+    Keeps a persistent HTTP connection pool to the OpenAI API, bounds every attempt
+    with a timeout and every call with a deadline, and retries rate limits and
+    upstream failures with jittered exponential backoff. Both blocking and asyncio
+    entry points are provided, each with a streaming variant. With a response cache
+    attached, identical prompts are answered from the cache. With an admission
+    controller attached, a call first waits to be admitted and raises Overloaded
+    if it isn't; a streamed call keeps its slot until the stream ends. With a
+    circuit breaker attached, calls fail fast with CircuitOpen while the upstream
+    is failing, before they wait for admission. With a token ledger attached, the
+    tokens of every call are charged to the current session, agent and prompt
+    section.
+    """
+
+    def __init__(self, model: str = DEFAULT_MODEL, temperature: float = DEFAULT_TEMPERATURE,
+                 timeout: float = DEFAULT_TIMEOUT, deadline: float = DEFAULT_DEADLINE,
+                 max_retries: int = DEFAULT_MAX_RETRIES, pool_size: int = DEFAULT_POOL_SIZE,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 cache: Optional[ResponseCache] = None, admission: Optional[AdmissionController] = None,
+                 breaker: Optional[CircuitBreaker] = None, ledger: Optional[TokenLedger] = None):
+        self.model = model
+        self.temperature = temperature
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.cache = cache
+        self.admission = admission
+        self.breaker = breaker
+        self.ledger = ledger
+
+        self._lock = threading.Lock()
+        self._session: Optional[_SharedSession] = None
+        self._async_sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+    def model_for(self, agent_name: Optional[str]) -> str:
+        """Return the model configured for an agent, falling back to the default model"""
+        if agent_name:
+            return os.getenv(f"OPENAI_MODEL_{agent_name.upper()}", self.model)
+        return self.model
+
+    # ----- Blocking entry points -----
+
+    def chat(self, messages: List[Dict[str, str]], agent: Optional[str] = None, **options: Any) -> str:
+        """Return the full completion for the messages"""
+        key, cached = self._cache_lookup(messages, agent, options)
+        if cached is not None:
+            return cached
+
+        with self._admitted(agent, options), self._measured(agent):
+            response = self._create(messages, agent, stream=False, **options)
+        content = response.choices[0].message.content
+        self._count_tokens(agent, messages, content, usage=response.get('usage'))
+        self._cache_store(key, content)
+        return content
+
+    def stream(self, messages: List[Dict[str, str]], agent: Optional[str] = None, **options: Any) -> Iterator[str]:
+        """Yield completion tokens as they arrive
+
+        Retries only cover opening the stream; once tokens have been delivered a
+        failure is raised to the caller rather than replayed. The circuit breaker
+        hears of the call once the stream has ended, cleanly or not.
+        """
+        key, cached = self._cache_lookup(messages, agent, options)
+        if cached is not None:
+            yield cached
+            return
+
+        tokens = []
+        with self._admitted(agent, options), self._measured(agent):
+            started = time.monotonic()
+            first_chunk = None
+            response = self._create(messages, agent, stream=True, **options)
+            try:
+                for chunk in response:
+                    if first_chunk is None:
+                        first_chunk = time.monotonic() - started
+                    token = chunk.choices[0].delta.get('content')
+                    if token:
+                        tokens.append(token)
+                        yield token
+            except Exception as e:
+                # Cut off mid-way, or timed out between chunks
+                self._record_failure(e)
+                raise
+            self._record_success(first_chunk if first_chunk is not None else time.monotonic() - started)
+        self._count_tokens(agent, messages, tokens, chunks=len(tokens))
+        self._cache_store(key, ''.join(tokens))
+
+    def _create(self, messages, agent, stream, timeout=None, deadline=None, **options):
+        self._ensure_session()
+        kwargs = self._request_kwargs(messages, agent, stream, options)
+        expires_at = time.monotonic() + (deadline or self.deadline)
+
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                kwargs['request_timeout'] = self._attempt_timeout(timeout, expires_at)
+                response = openai.ChatCompletion.create(**kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, expires_at)
+                if delay is None:
+                    self._record_failure(e)
+                    raise
+            else:
+                # A stream is recorded once it has been read to the end
+                if not stream:
+                    self._record_success(time.monotonic() - started)
+                return response
+            time.sleep(delay)
+            attempt += 1
+
+    def _ensure_session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = _SharedSession()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    openai.requestssession = session
+
+    # ----- asyncio entry points -----
+
+    async def achat(self, messages: List[Dict[str, str]], agent: Optional[str] = None, **options: Any) -> str:
+        """Return the full completion for the messages without blocking the event loop"""
+        key, cached = self._cache_lookup(messages, agent, options)
+        if cached is not None:
+            return cached
+
+        async with self._aadmitted(agent, options):
+            with self._measured(agent):
+                response = await self._acreate(messages, agent, stream=False, **options)
+        content = response.choices[0].message.content
+        self._count_tokens(agent, messages, content, usage=response.get('usage'))
+        self._cache_store(key, content)
+        return content
+
+    async def astream(self, messages: List[Dict[str, str]], agent: Optional[str] = None,
+                      **options: Any) -> AsyncIterator[str]:
+        """Yield completion tokens as they arrive without blocking the event loop"""
+        key, cached = self._cache_lookup(messages, agent, options)
+        if cached is not None:
+            yield cached
+            return
+
+        tokens = []
+        async with self._aadmitted(agent, options):
+            with self._measured(agent):
+                started = time.monotonic()
+                first_chunk = None
+                response = await self._acreate(messages, agent, stream=True, **options)
+                try:
+                    async for chunk in response:
+                        if first_chunk is None:
+                            first_chunk = time.monotonic() - started
+                        token = chunk.choices[0].delta.get('content')
+                        if token:
+                            tokens.append(token)
+                            yield token
+                except Exception as e:
+                    self._record_failure(e)
+                    raise
+                self._record_success(first_chunk if first_chunk is not None else time.monotonic() - started)
+        self._count_tokens(agent, messages, tokens, chunks=len(tokens))
+        self._cache_store(key, ''.join(tokens))
+
+    async def _acreate(self, messages, agent, stream, timeout=None, deadline=None, **options):
+        openai.aiosession.set(self._async_session())
+        kwargs = self._request_kwargs(messages, agent, stream, options)
+        expires_at = time.monotonic() + (deadline or self.deadline)
+
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                kwargs['request_timeout'] = self._attempt_timeout(timeout, expires_at)
+                response = await openai.ChatCompletion.acreate(**kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, expires_at)
+                if delay is None:
+                    self._record_failure(e)
+                    raise
+            else:
+                # A stream is recorded once it has been read to the end
+                if not stream:
+                    self._record_success(time.monotonic() - started)
+                return response
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _async_session(self) -> aiohttp.ClientSession:
+        # aiohttp sessions are bound to the loop they were created on
+        loop = asyncio.get_running_loop()
+        session = self._async_sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            session = aiohttp.ClientSession(connector=connector)
+            self._async_sessions[loop] = session
+        return session
+
+    async def aclose(self):
+        """Close the connection pool of the running event loop"""
+        session = self._async_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def close(self):
+        """Close the blocking connection pool"""
+        with self._lock:
+            if self._session is not None:
+                self._session.shutdown()
+                self._session = None
+                openai.requestssession = None
+
+    # ----- Shared helpers -----
+
+    @contextmanager
+    def _admitted(self, agent, options):
+        """Hold an admission slot for the call; it may wait up to the call's deadline"""
+        try:
+            if self.breaker is not None:
+                self.breaker.allow()
+            if self.admission is not None:
+                with metrics.stage('admission'):
+                    self.admission.acquire(current_tenant.get(), options.get('deadline') or self.deadline)
+        except (Overloaded, CircuitOpen):
+            LLM_CALLS.inc(agent=agent or 'none', outcome='refused')
+            raise
+        try:
+            yield
+        finally:
+            if self.admission is not None:
+                self.admission.release()
+
+    @asynccontextmanager
+    async def _aadmitted(self, agent, options):
+        try:
+            if self.breaker is not None:
+                self.breaker.allow()
+            if self.admission is not None:
+                with metrics.stage('admission'):
+                    await self.admission.aacquire(current_tenant.get(), options.get('deadline') or self.deadline)
+        except (Overloaded, CircuitOpen):
+            LLM_CALLS.inc(agent=agent or 'none', outcome='refused')
+            raise
+        try:
+            yield
+        finally:
+            if self.admission is not None:
+                self.admission.release()
+
+    @contextmanager
+    def _measured(self, agent):
+        """Time an admitted call as the turn's llm stage and count its outcome"""
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            with metrics.stage('llm'):
+                yield
+            outcome = 'ok'
+        except GeneratorExit:
+            # The caller stopped reading the stream
+            outcome = 'cancelled'
+            raise
+        finally:
+            LLM_SECONDS.observe(time.perf_counter() - started, agent=agent or 'none')
+            LLM_CALLS.inc(agent=agent or 'none', outcome=outcome)
+
+    def _count_tokens(self, agent, messages, reply, usage=None, chunks=None):
+        if usage:
+            tokens_in, tokens_out = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+        else:
+            # Streams don't report usage: count with the local tokenizer, except that
+            # each chunk of a streamed reply is a token
+            tokens_in = None
+            tokens_out = chunks if chunks is not None else count_tokens(reply)
+        if self.ledger is not None:
+            self.ledger.record(agent, messages, tokens_out, tokens_in)
+        if tokens_in is None:
+            tokens_in = sum(message_tokens(message) for message in messages)
+        LLM_TOKENS.inc(tokens_in, agent=agent or 'none', direction='in')
+        LLM_TOKENS.inc(tokens_out, agent=agent or 'none', direction='out')
+
+    def _record_success(self, latency):
+        # For a stream, latency is the time to its first chunk
+        if self.breaker is not None:
+            self.breaker.record_success(latency)
+
+    def _record_failure(self, error):
+        # A rejected request says nothing about the upstream's health
+        if self.breaker is not None and not isinstance(error, openai.error.InvalidRequestError):
+            self.breaker.record_failure()
+
+    def _cache_lookup(self, messages, agent, options):
+        """Return (cache key, cached response); the key is None when the call bypasses the cache"""
+        if self.cache is None:
+            return None, None
+        model = options.get('model') or self.model_for(agent)
+        temperature = options.get('temperature')
+        key = self.cache.make_key(agent, messages, model, self.temperature if temperature is None else temperature)
+        if key is None:
+            return None, None
+        cached = self.cache.get(key)
+        CACHE_LOOKUPS.inc(result='miss' if cached is None else 'hit')
+        if cached is not None:
+            LLM_CALLS.inc(agent=agent or 'none', outcome='cached')
+        return key, cached
+
+    def _cache_store(self, key, content):
+        if key is not None and content:
+            self.cache.set(key, content)
+
+    def _request_kwargs(self, messages, agent, stream, options):
+        kwargs = {
+            'model': options.pop('model', None) or self.model_for(agent),
+            'messages': messages,
+            'temperature': options.pop('temperature', None),
+            'stream': stream,
+        }
+        if kwargs['temperature'] is None:
+            kwargs['temperature'] = self.temperature
+        kwargs.update(options)
+        return kwargs
+
+    def _attempt_timeout(self, timeout, expires_at):
+        remaining = expires_at - time.monotonic()
+        if remaining <= 0:
+            raise openai.error.Timeout("LLM call deadline exceeded")
+        return min(timeout or self.timeout, remaining)
+
+    def _retry_delay(self, error, attempt, expires_at) -> Optional[float]:
+        """Return how long to wait before retrying, or None if the error should be raised"""
+        if attempt >= self.max_retries or not self._is_retryable(error):
+            return None
+
+        # Full jitter: a random delay up to the exponential backoff cap
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+        # Honour Retry-After from a rate limit when the upstream sends one
+        headers = getattr(error, 'headers', None) or {}
+        retry_after = headers.get('retry-after') or headers.get('Retry-After')
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+
+        # Give up rather than sleep past the deadline
+        if time.monotonic() + delay >= expires_at:
+            return None
+        return delay
+
+    def _is_retryable(self, error) -> bool:
+        if isinstance(error, RETRYABLE_ERRORS):
+            return True
+        status = getattr(error, 'http_status', None)
+        return isinstance(error, openai.error.APIError) and status is not None and status >= 500
+
+
+def register_metrics(client: LLMClient):
+    """Export the client's admission and circuit breaker state on /metrics"""
+    admission, breaker = client.admission, client.breaker
+    if admission is not None:
+        metrics.callback('nurse_ally_admission_in_flight', "Model calls admitted and not yet finished",
+                         lambda: admission.in_flight)
+        metrics.callback('nurse_ally_admission_waiting', "Model calls waiting to be admitted",
+                         lambda: admission.waiting)
+        metrics.callback('nurse_ally_admission_total', "Admission decisions: admitted, queued, rejected "
+                         "(queue full) or timed_out", lambda: {(result,): n for result, n in admission.stats.items()},
+                         ['result'], kind='counter')
+    if breaker is not None:
+        metrics.callback('nurse_ally_circuit_open', "1 while the circuit breaker refuses model calls, "
+                         "0.5 while it is half-open", lambda: {'closed': 0, 'half_open': 0.5, 'open': 1}[breaker.state])
+        metrics.callback('nurse_ally_circuit_events_total', "Times the circuit opened, and calls it refused",
+                         lambda: {(event,): n for event, n in breaker.stats.items()}, ['event'], kind='counter')
+
+
+# Client shared by every agent in the process
+default_client = LLMClient(cache=create_response_cache(), admission=create_admission_controller(),
+                           breaker=create_circuit_breaker(), ledger=create_token_ledger())
+register_metrics(default_client)
@@ -0,0 +1,283 @@
+import os
+import hmac
+import time
+import logging
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Content type of the Prometheus text exposition format served at /metrics
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds, in seconds, of the latency histograms' buckets: from local lookups
+# of a few milliseconds up to model calls that run to their deadline
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Bearer token for the operator reports that span every session (token usage,
+# upload stats); while it is unset those reports aren't served at all
+OPERATOR_TOKEN = os.getenv("OPERATOR_TOKEN", "")
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} takes the labels {', '.join(self.label_names) or '(none)'}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self._samples()
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A count that only goes up, one per combination of label values"""
+
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    """Counts observations into cumulative buckets, with their sum and count"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple[str, ...], list] = {}  # label values -> [bucket counts..., sum]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, [('le', _format_value(float(bound)))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {_format_value(counts[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Callback(_Metric):
+    """A gauge or counter read from elsewhere when metrics are collected
+
+    `read` returns a number, or a dict from label values (a tuple, one per label)
+    to numbers; it returns None when there is nothing to report.
+    """
+
+    def __init__(self, name: str, documentation: str, read: Callable, labels: Sequence[str] = (),
+                 kind: str = 'gauge'):
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self.read = read
+
+    def _samples(self):
+        values = self.read()
+        if values is None:
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Registry:
+    """The metrics of the process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        # Registering a callback again replaces it, e.g. when a client is recreated
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and not isinstance(metric, Callback):
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                logger.exception("Error collecting metric", extra={'metric': metric.name})
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+    return registry.register(Counter(name, documentation, labels))
+
+
+def histogram(name: str, documentation: str, labels: Sequence[str] = (),
+              buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, documentation, labels, buckets))
+
+
+def callback(name: str, documentation: str, read: Callable, labels: Sequence[str] = (),
+             kind: str = 'gauge') -> Callback:
+    return registry.register(Callback(name, documentation, read, labels, kind))
+
+
+def render() -> str:
+    return registry.render()
+
+
+# ----- Chat turns and their stages -----
+
+TURN_SECONDS = histogram('nurse_ally_turn_seconds', "Time to answer a chat turn, by the agent that answered",
+                         ['agent'])
+STAGE_SECONDS = histogram('nurse_ally_stage_seconds', "Time a chat turn spent in each stage", ['stage'])
+HTTP_REQUESTS = counter('nurse_ally_http_requests_total', "HTTP requests served", ['endpoint', 'method', 'status'])
+HTTP_SECONDS = histogram('nurse_ally_http_request_seconds', "Time to respond to an HTTP request (to the first "
+                         "byte of a streamed reply)", ['endpoint'])
+
+
+class TurnTimings:
+    """Seconds spent in each stage of one chat turn
+
+    Stages run on worker threads (fanned-out model calls, say) add to the same
+    turn, so a stage can add up to more than the turn's wall-clock time.
+    """
+
+    __slots__ = ('started', 'agent', 'stages', '_lock')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.agent: Optional[str] = None
+        self.stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+current_turn: contextvars.ContextVar = contextvars.ContextVar('metrics_turn', default=None)
+
+
+@contextmanager
+def turn(**fields):
+    """Time a chat turn; set `agent` on the yielded timings once it is known
+
+    When the turn ends its stage totals go to the stage histogram and a summary
+    line with the per-stage breakdown is logged, along with `fields`.
+    """
+    timings = TurnTimings()
+    token = current_turn.set(timings)
+    failed = False
+    try:
+        yield timings
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        current_turn.reset(token)
+        seconds = time.perf_counter() - timings.started
+        agent = 'error' if failed else timings.agent or 'unknown'
+        TURN_SECONDS.observe(seconds, agent=agent)
+        for name, stage_seconds in timings.stages.items():
+            STAGE_SECONDS.observe(stage_seconds, stage=name)
+        logger.info("Turn answered" if not failed else "Turn failed",
+                    extra=dict(fields, agent=agent, seconds=round(seconds, 6),
+                               stages={name: round(s, 6) for name, s in timings.stages.items()}))
+
+
+@contextmanager
+def stage(name: str):
+    """Time a stage of the current chat turn; outside a turn it is observed on its own"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        timings = current_turn.get()
+        if timings is not None:
+            timings.add(name, seconds)
+        else:
+            STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def operator_refusal(authorization: Optional[str]) -> Optional[int]:
+    """The status to refuse an operator report with, or None if the request's
+    Authorization header carries the operator token
+
+    404 while no OPERATOR_TOKEN is configured, so the reports look absent, and 403
+    for a missing or wrong token.
+    """
+    if not OPERATOR_TOKEN:
+        return 404
+    if hmac.compare_digest((authorization or '').encode('utf-8'), f"Bearer {OPERATOR_TOKEN}".encode('utf-8')):
+        return None
+    return 403
+
+
+def observe_request(endpoint: Optional[str], method: str, status: int, seconds: float):
+    """Record a served HTTP request; `endpoint` is the matched route, so ids in URLs don't add labels"""
+    endpoint = endpoint or 'unmatched'
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=method, status=status)
+    HTTP_SECONDS.observe(seconds, endpoint=endpoint)
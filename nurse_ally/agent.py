@@ -1,50 +1,97 @@
 import os
-import openai
-import json
-from typing import Dict, List, Any, Optional, Tuple
+import sys
+import logging
+from datetime import date
+from typing import Dict, List, Any, Iterator, Optional, Tuple
+
+# Shared services live in the project root next to the multi-agent app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_client import MODEL_UNAVAILABLE, LLMClient, default_client
+from history_manager import create_history_manager
+from keywords import scan_message
+from coverage_rules import CoverageRules, default_rules
+from facilities import FacilityIndex, default_index
+from emergency import EmergencyDetector, default_detector
+from conversation_state import CareLevel
+from rules_responder import CARE_LEVELS, FACILITY_TYPES, map_link, render_reply, triage
+import metrics
+
+logger = logging.getLogger(__name__)
 
 # Base Agent class
 class Agent:
     """Base agent class that defines the interface for all specialized agents"""
     
-    def __init__(self, system_prompt: str):
+    def __init__(self, system_prompt: str, name: Optional[str] = None, llm: Optional[LLMClient] = None):
         self.system_prompt = system_prompt
+        self.name = name
+        self.llm = llm or default_client
+        self.history = create_history_manager(self.llm)
     
     def process(self, user_message: str, context: Dict[str, Any]) -> str:
         """Process a user message and return a response"""
         raise NotImplementedError("Subclasses must implement this method")
 
     def _prepare_messages(self, context: Dict[str, Any], user_message: str) -> List[Dict[str, str]]:
-        """Prepare messages for the OpenAI API"""
-        messages = [{"role": "system", "content": self.system_prompt}]
-        
-        # Add conversation history if available
-        if 'conversation_history' in context and context['conversation_history']:
-            for msg in context['conversation_history']:
-                messages.append(msg)
-        
-        # Add current user message if not already in history
-        if user_message and (not context.get('conversation_history') or 
-                            context['conversation_history'][-1]['role'] != 'user' or 
-                            context['conversation_history'][-1]['content'] != user_message):
-            messages.append({"role": "user", "content": user_message})
-        
-        return messages
+        """Prepare messages for the OpenAI API: recent turns verbatim, older turns
+        summarized and the known profile and triage state as facts"""
+        with metrics.stage('prompt'):
+            return self.history.build_messages(self.system_prompt, context.get('conversation_history', []),
+                                               context, user_message, facts=self._context_facts(context))
+
+    def _context_facts(self, context: Dict[str, Any]) -> List[str]:
+        """Summarize the user profile and conversation state as short facts for the prompt"""
+        facts = []
+        for key, value in context.get('user_profile', {}).items():
+            if value and value != 'Unknown':
+                label = key.replace('_', ' ').capitalize()
+                if isinstance(value, list):
+                    value = ', '.join(value)
+                elif isinstance(value, dict):
+                    value = ', '.join(f"{k} {v}" for k, v in value.items())
+                facts.append(f"{label}: {value}")
+        if context.get('urgency_level'):
+            facts.append(f"Urgency level: {context['urgency_level']}")
+        if context.get('insurance_covers') is not None:
+            facts.append(f"Insurance covers this care: {'yes' if context['insurance_covers'] else 'no'} ({context.get('coverage_note', '')})")
+        document = context.get('insurance_document') or {}
+        if document.get('status') == 'done':
+            # Read from the uploaded policy or card photo
+            policy_number = document.get('policy_number') or document.get('card_number')
+            if policy_number:
+                facts.append(f"Policy or member number: {policy_number}")
+            if document.get('valid_until'):
+                expired = document['valid_until'] < date.today().isoformat()
+                facts.append(f"Insurance valid until {document['valid_until']}"
+                             + (" (expired, so the cover may have lapsed)" if expired else ""))
+        if context.get('map_link'):
+            facts.append(f"Map of nearby care: {context['map_link']}")
+        if context.get('nearby_facilities'):
+            nearby = '; '.join(f"{f['name']} ({f['type']}, {f['distance']}, {f['address']})" for f in context['nearby_facilities'])
+            facts.append(f"Nearest suitable facilities: {nearby}")
+        return facts
 
     def _call_openai_api(self, messages: List[Dict[str, str]]) -> str:
-        """Call the OpenAI API with the prepared messages"""
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",  # Can be configured based on needs
-            messages=messages,
-            temperature=0.7
-        )
-        return response.choices[0].message.content
+        """Call the OpenAI API with the prepared messages through the shared client"""
+        return self.llm.chat(messages, agent=self.name)
+
+    def _stream_openai_api(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        """Call the OpenAI API and yield response tokens as they arrive"""
+        return self.llm.stream(messages, agent=self.name)
 
 
 class NurseAlly(Agent):
     """Main Nurse Ally agent that uses tools to provide healthcare navigation assistance"""
     
-    def __init__(self):
+    # Instruction for the optional elaboration streamed after an emergency reply
+    EMERGENCY_ELABORATION_PROMPT = ("The user has already been shown this emergency advice: \"{response}\" "
+                                    "Add two or three short, practical steps to take while waiting for help, "
+                                    "specific to what they described. Never suggest waiting or delaying the call.")
+    
+    def __init__(self, llm: Optional[LLMClient] = None, coverage_rules: Optional[CoverageRules] = None,
+                 facilities: Optional[FacilityIndex] = None, emergency: Optional[EmergencyDetector] = None,
+                 elaborate_emergencies: Optional[bool] = None):
         super().__init__(
             """You are Nurse Ally, a compassionate and professional AI health assistant helping users access 
             the right level of healthcare while traveling, studying abroad, or living as digital nomads.
@@ -77,8 +124,16 @@ class NurseAlly(Agent):
             
             Always use simple, clear, and reassuring language. Use bullet points when listing options or steps.
             Include links to maps or helpful resources using Markdown if supported. Refer to yourself as "Nurse Ally."
-            Never say you are an AI model. Stay in character as a trusted assistant."""
+            Never say you are an AI model. Stay in character as a trusted assistant.""",
+            name="nurse_ally",
+            llm=llm
         )
+        self.coverage_rules = coverage_rules or default_rules()
+        self.facilities = facilities or default_index()
+        self.emergency = emergency or default_detector()
+        if elaborate_emergencies is None:
+            elaborate_emergencies = os.getenv("EMERGENCY_ELABORATION", "stream") == "stream"
+        self.elaborate_emergencies = elaborate_emergencies
         self.tools = {
             "triage_symptoms": self._triage_symptoms,
             "check_insurance_coverage": self._check_insurance_coverage,
@@ -88,210 +143,238 @@ class NurseAlly(Agent):
     
     def process(self, user_message: str, context: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
         """Process a user message using appropriate tools and return a response"""
-        # Check for emergency keywords first
-        emergency_keywords = ["chest pain", "fainting", "difficulty breathing", "bleeding", "confusion"]
-        if any(keyword in user_message.lower() for keyword in emergency_keywords):
-            emergency_response = "This may be an emergency. Please go to the nearest hospital or call the local emergency number immediately."
+        # Emergencies are answered locally first, never waiting on the model
+        emergency_response = self._check_emergency(user_message, context)
+        if emergency_response:
             return emergency_response, context
         
-        # Prepare messages for the OpenAI API
-        messages = self._prepare_messages(context, user_message)
+        messages = self._run_tools(user_message, context)
         
-        # Determine which tool to use based on the conversation state
-        if not context.get('symptoms_assessed') and not context.get('urgency_level'):
-            # If symptoms haven't been assessed yet, use the triage tool
-            if any(symptom in user_message.lower() for symptom in ["pain", "hurt", "sick", "fever", "cough", "headache"]):
-                symptoms_result = self._triage_symptoms({"symptoms": user_message})
-                context['urgency_level'] = symptoms_result['urgency']
-                context['symptoms_assessed'] = True
-                context['symptoms'] = user_message
+        # Call OpenAI API to generate a response based on the updated context
+        try:
+            response = self._call_openai_api(messages)
+        except MODEL_UNAVAILABLE as e:
+            return self._fallback_response(user_message, context, e), context
         
-        # If we have symptoms and urgency but no insurance check yet
-        elif context.get('symptoms_assessed') and not context.get('insurance_checked'):
-            # Check insurance coverage
-            insurance_type = context.get('user_profile', {}).get('insurance_type', 'Unknown')
-            country = context.get('user_profile', {}).get('country', 'Unknown')
-            care_level = self._map_urgency_to_care_level(context.get('urgency_level', 'mild'))
-            
-            coverage_result = self._check_insurance_coverage({
-                "insurance_type": insurance_type,
-                "country": country,
-                "care_level": care_level
-            })
-            
-            context['insurance_checked'] = True
-            context['insurance_covers'] = coverage_result['covered']
-            context['coverage_note'] = coverage_result['note']
+        # If we've completed all steps, provide a claim checklist
+        response += self._claim_checklist_text(context)
+        
+        return response, context
+    
+    def process_stream(self, user_message: str, context: Dict[str, Any]) -> Iterator[Tuple[str, str]]:
+        """Process a user message, yielding ('token', text) pieces of the response as they
+        are generated and a trailing ('checklist', text) block; `context` is updated in place"""
+        emergency_response = self._check_emergency(user_message, context)
+        if emergency_response:
+            yield 'token', emergency_response
+            if self.elaborate_emergencies:
+                yield from self._stream_emergency_elaboration(user_message, emergency_response, context)
+            return
+        
+        messages = self._run_tools(user_message, context)
+        
+        started = False
+        try:
+            for token in self._stream_openai_api(messages):
+                started = True
+                yield 'token', token
+        except MODEL_UNAVAILABLE as e:
+            if started:
+                raise
+            yield 'token', self._fallback_response(user_message, context, e)
+            return
+        
+        checklist_text = self._claim_checklist_text(context)
+        if checklist_text:
+            yield 'checklist', checklist_text
+    
+    def _check_emergency(self, user_message: str, context: Dict[str, Any]) -> Optional[str]:
+        """Return the emergency response, with the emergency number for the user's
+        country, if the message describes an emergency; triage is recorded as severe"""
+        with metrics.stage('routing'):
+            assessment = self.emergency.assess(user_message)
+        if not assessment.is_emergency:
+            return None
         
-        # If we have symptoms, urgency, and insurance check but no facility recommendations
-        elif context.get('symptoms_assessed') and context.get('insurance_checked') and not context.get('facilities_recommended'):
-            # Search for nearby facilities
-            city = context.get('user_profile', {}).get('city', 'Unknown')
-            care_level = self._map_urgency_to_care_level(context.get('urgency_level', 'mild'))
+        context['urgency_level'] = 'severe'
+        context['symptoms_assessed'] = True
+        context['symptoms'] = user_message
+        return self.emergency.response_for(context.get('user_profile', {}).get('country'))
+    
+    def _fallback_response(self, user_message: str, context: Dict[str, Any], error: Exception) -> str:
+        """Answer from the tools alone when the model can't be used (overloaded,
+        failing, or its circuit is open); `context` is left as the tools step set it"""
+        logger.info("Model unavailable; answering from the tools", extra={'reason': type(error).__name__})
+        profile = context.get('user_profile', {})
+        insurance_type = profile.get('insurance_type', 'Unknown')
+        country = profile.get('country', 'Unknown')
+        location = profile.get('location') or {}
+        
+        urgency = context.get('urgency_level') or self._triage_symptoms({"symptoms": user_message})['urgency']
+        care_level = self._map_urgency_to_care_level(urgency)
+        coverage = self._check_insurance_coverage({
+            "insurance_type": insurance_type,
+            "country": country,
+            "care_level": care_level
+        })
+        map_result = self._map_search({
+            "city": profile.get('city', 'Unknown'),
+            "care_level": care_level,
+            "latitude": location.get('latitude'),
+            "longitude": location.get('longitude')
+        })
+        checklist = self._get_claim_checklist({
+            "insurance_type": insurance_type,
+            "country": country,
+            "care_level": care_level
+        })['checklist']
+        
+        return render_reply(care_level, insurance_type, coverage['covered'], coverage['note'],
+                            map_result['facilities'], map_result['map_link'], checklist)
+    
+    def _stream_emergency_elaboration(self, user_message: str, response: str,
+                                      context: Dict[str, Any]) -> Iterator[Tuple[str, str]]:
+        """Stream first-aid detail after the emergency response; failures are dropped
+        since the essential advice has already been given"""
+        messages = self._prepare_messages(context, user_message)
+        messages.append({"role": "system", "content": self.EMERGENCY_ELABORATION_PROMPT.format(response=response)})
+        started = False
+        try:
+            for token in self._stream_openai_api(messages):
+                if not started:
+                    started = True
+                    yield 'token', "\n\n"
+                yield 'token', token
+        except Exception as e:
+            logger.warning("Error streaming emergency elaboration: %s", e)
+    
+    def _run_tools(self, user_message: str, context: Dict[str, Any]) -> List[Dict[str, str]]:
+        """Update the context with the tool appropriate for the conversation state and
+        return the messages for the OpenAI API"""
+        # Prepare messages for the OpenAI API
+        messages = self._prepare_messages(context, user_message)
+        
+        with metrics.stage('tools'):
+            # Determine which tool to use based on the conversation state
+            if not context.get('symptoms_assessed') and not context.get('urgency_level'):
+                # If symptoms haven't been assessed yet, use the triage tool
+                if 'symptom' in scan_message(user_message):
+                    symptoms_result = self._triage_symptoms({"symptoms": user_message})
+                    context['urgency_level'] = symptoms_result['urgency']
+                    context['symptoms_assessed'] = True
+                    context['symptoms'] = user_message
             
-            if city != 'Unknown':
-                map_result = self._map_search({
-                    "city": city,
+            # If we have symptoms and urgency but no insurance check yet
+            elif context.get('symptoms_assessed') and not context.get('insurance_checked'):
+                # Check insurance coverage
+                insurance_type = context.get('user_profile', {}).get('insurance_type', 'Unknown')
+                country = context.get('user_profile', {}).get('country', 'Unknown')
+                care_level = self._map_urgency_to_care_level(context.get('urgency_level', 'mild'))
+                
+                coverage_result = self._check_insurance_coverage({
+                    "insurance_type": insurance_type,
+                    "country": country,
                     "care_level": care_level
                 })
                 
-                context['facilities_recommended'] = True
-                context['map_link'] = map_result['map_link']
-        
-        # Call OpenAI API to generate a response based on the updated context
-        response = self._call_openai_api(messages)
-        
-        # If we've completed all steps, provide a claim checklist
-        if context.get('symptoms_assessed') and context.get('insurance_checked') and context.get('facilities_recommended'):
-            insurance_type = context.get('user_profile', {}).get('insurance_type', 'Unknown')
-            care_level = self._map_urgency_to_care_level(context.get('urgency_level', 'mild'))
+                context['insurance_checked'] = True
+                context['insurance_covers'] = coverage_result['covered']
+                context['coverage_note'] = coverage_result['note']
             
-            checklist_result = self._get_claim_checklist({
-                "insurance_type": insurance_type,
-                "care_level": care_level
-            })
+            # If we have symptoms, urgency, and insurance check but no facility recommendations
+            elif context.get('symptoms_assessed') and context.get('insurance_checked') and not context.get('facilities_recommended'):
+                # Search for nearby facilities
+                city = context.get('user_profile', {}).get('city', 'Unknown')
+                location = context.get('user_profile', {}).get('location') or {}
+                care_level = self._map_urgency_to_care_level(context.get('urgency_level', 'mild'))
+                
+                if city != 'Unknown' or location:
+                    map_result = self._map_search({
+                        "city": city,
+                        "care_level": care_level,
+                        "latitude": location.get('latitude'),
+                        "longitude": location.get('longitude')
+                    })
+                    
+                    context['facilities_recommended'] = True
+                    context['map_link'] = map_result['map_link']
+                    context['nearby_facilities'] = map_result['facilities']
             
-            # Add checklist to the response
-            checklist_items = "\n".join([f"- {item}" for item in checklist_result['checklist']])
-            response += f"\n\nHere's a checklist of what you'll need for insurance claims:\n{checklist_items}"
+        return messages
+    
+    def _claim_checklist_text(self, context: Dict[str, Any]) -> str:
+        """Return the claim checklist block once all steps are complete, otherwise an empty string"""
+        if not (context.get('symptoms_assessed') and context.get('insurance_checked') and context.get('facilities_recommended')):
+            return ""
         
-        return response, context
+        insurance_type = context.get('user_profile', {}).get('insurance_type', 'Unknown')
+        country = context.get('user_profile', {}).get('country', 'Unknown')
+        care_level = self._map_urgency_to_care_level(context.get('urgency_level', 'mild'))
+        
+        checklist_result = self._get_claim_checklist({
+            "insurance_type": insurance_type,
+            "country": country,
+            "care_level": care_level
+        })
+        
+        checklist_items = "\n".join([f"- {item}" for item in checklist_result['checklist']])
+        return f"\n\nHere's a checklist of what you'll need for insurance claims:\n{checklist_items}"
     
     def _map_urgency_to_care_level(self, urgency: str) -> str:
         """Map urgency level to care level"""
-        urgency_map = {
-            "severe": "hospital",
-            "moderate": "walk-in clinic",
-            "mild": "pharmacy"
-        }
-        return urgency_map.get(urgency, "walk-in clinic")
+        return CARE_LEVELS.get(urgency, CareLevel.WALK_IN_CLINIC)
     
     # Tool implementations
     def _triage_symptoms(self, input_data: Dict[str, str]) -> Dict[str, str]:
         """Triage symptoms to determine urgency level"""
-        symptoms = input_data.get("symptoms", "")
-        
-        # Emergency keywords that indicate severe urgency
-        emergency_keywords = ["chest pain", "heart", "breathing", "unconscious", "severe bleeding", 
-                             "head injury", "stroke", "seizure", "anaphylaxis", "allergic reaction"]
-        
-        # Urgent keywords that indicate moderate urgency
-        urgent_keywords = ["fever", "infection", "broken", "fracture", "sprain", "cut", "wound", 
-                          "vomiting", "dehydration", "migraine", "severe pain"]
-        
-        # Determine urgency based on keywords
-        if any(keyword in symptoms.lower() for keyword in emergency_keywords):
-            return {"urgency": "severe"}
-        elif any(keyword in symptoms.lower() for keyword in urgent_keywords):
-            return {"urgency": "moderate"}
-        else:
-            return {"urgency": "mild"}
+        # Determine urgency based on emergency (severe) and urgent (moderate) keywords
+        return {"urgency": triage(input_data.get("symptoms", ""))}
     
     def _check_insurance_coverage(self, input_data: Dict[str, str]) -> Dict[str, Any]:
         """Check if insurance covers the care level in the specified country"""
-        insurance_type = input_data.get("insurance_type", "Unknown")
-        country = input_data.get("country", "Unknown")
-        care_level = input_data.get("care_level", "walk-in clinic")
-        
-        # Simple coverage rules (would be more complex in a real system)
-        coverage_rules = {
-            "Travel": {
-                "hospital": True,
-                "walk-in clinic": True,
-                "pharmacy": False,
-                "note": "Most travel insurance covers emergency and urgent care, but not routine pharmacy visits."
-            },
-            "EHIC": {
-                "hospital": True,
-                "walk-in clinic": True,
-                "pharmacy": True,
-                "note": "EHIC covers public healthcare services in EU countries at the same cost as locals."
-            },
-            "Private": {
-                "hospital": True,
-                "walk-in clinic": True,
-                "pharmacy": True,
-                "note": "Your private insurance likely covers all levels of care, but may require pre-authorization for hospital visits."
-            },
-            "None": {
-                "hospital": False,
-                "walk-in clinic": False,
-                "pharmacy": False,
-                "note": "Without insurance, you'll need to pay out-of-pocket for healthcare services."
-            }
-        }
-        
-        # Get coverage for the specified insurance type and care level
-        if insurance_type in coverage_rules:
-            covered = coverage_rules[insurance_type].get(care_level, False)
-            note = coverage_rules[insurance_type].get("note", "")
-        else:
-            covered = False
-            note = "I don't have specific information about your insurance type. Please check with your provider."
+        rule = self.coverage_rules.lookup(
+            input_data.get("insurance_type", "Unknown"),
+            input_data.get("country", "Unknown"),
+            input_data.get("care_level", "walk-in clinic")
+        )
         
         return {
-            "covered": covered,
-            "note": note
+            "covered": rule.covered,
+            "note": rule.note
         }
     
-    def _map_search(self, input_data: Dict[str, str]) -> Dict[str, str]:
-        """Search for healthcare facilities based on city and care level"""
+    def _map_search(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Search for healthcare facilities based on location or city and care level"""
         city = input_data.get("city", "")
         care_level = input_data.get("care_level", "walk-in clinic")
         
-        # Map care level to search term
-        search_terms = {
-            "hospital": "emergency hospital",
-            "walk-in clinic": "urgent care clinic",
-            "pharmacy": "pharmacy"
-        }
-        
-        search_term = search_terms.get(care_level, care_level)
+        try:
+            latitude = float(input_data["latitude"])
+            longitude = float(input_data["longitude"])
+        except (KeyError, TypeError, ValueError):
+            latitude = longitude = None
         
-        # Create Google Maps search URL
-        map_link = f"https://www.google.com/maps/search/{search_term}+in+{city}".replace(" ", "+")
+        # Nearest matching facilities from the local facility index
+        facilities = []
+        if latitude is not None:
+            nearest = self.facilities.nearest(latitude, longitude, FACILITY_TYPES.get(care_level))
+            facilities = [facility.to_dict(distance) for distance, facility in nearest]
         
         return {
-            "map_link": map_link
+            # Google Maps search, centred on the user when we know where they are
+            "map_link": map_link(care_level, city, latitude, longitude),
+            "facilities": facilities
         }
     
     def _get_claim_checklist(self, input_data: Dict[str, str]) -> Dict[str, List[str]]:
         """Get a checklist of documents needed for insurance claims"""
-        insurance_type = input_data.get("insurance_type", "Unknown")
-        care_level = input_data.get("care_level", "walk-in clinic")
-        
-        # Base checklist items needed for all claims
-        base_checklist = [
-            "Receipt from healthcare provider",
-            "Copy of passport/ID",
-            "Insurance policy number"
-        ]
-        
-        # Additional items based on insurance type and care level
-        additional_items = {
-            "Travel": {
-                "hospital": ["Hospital discharge summary", "Medical report", "Proof of travel (e.g., flight tickets)"],
-                "walk-in clinic": ["Medical report", "Proof of travel (e.g., flight tickets)"],
-                "pharmacy": ["Prescription from doctor", "Proof of travel (e.g., flight tickets)"]
-            },
-            "EHIC": {
-                "hospital": ["EHIC card details", "Hospital discharge summary"],
-                "walk-in clinic": ["EHIC card details", "Medical report"],
-                "pharmacy": ["EHIC card details", "Prescription from doctor"]
-            },
-            "Private": {
-                "hospital": ["Pre-authorization form (if required)", "Hospital discharge summary", "Itemized bill"],
-                "walk-in clinic": ["Medical report", "Itemized bill"],
-                "pharmacy": ["Prescription from doctor"]
-            }
-        }
-        
-        # Combine base checklist with additional items
-        checklist = base_checklist.copy()
-        
-        if insurance_type in additional_items and care_level in additional_items[insurance_type]:
-            checklist.extend(additional_items[insurance_type][care_level])
+        # Base items needed for all claims plus those for the insurance type, country and care level
+        rule = self.coverage_rules.lookup(
+            input_data.get("insurance_type", "Unknown"),
+            input_data.get("country", "Unknown"),
+            input_data.get("care_level", "walk-in clinic")
+        )
         
         return {
-            "checklist": checklist
-        }
\ No newline at end of file
+            "checklist": list(rule.checklist)
+        }
@@ -1,15 +1,29 @@
 import os
 import json
-import uuid
+import time
+import logging
+import secrets
 from datetime import datetime
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, render_template, session
+from flask import Flask, Request, Response, g, request, jsonify, render_template, session, stream_with_context
 from agent import NurseAlly
+from conversation_store import create_store, register_metrics as register_store_metrics
+from conversation_state import NurseAllyContext, snapshot
+from insurance_ingest import IngestionJobs
+from admission import tenant_for, tenant_scope
+from upload_store import UploadStore
+from upload_janitor import QuotaExceeded, create_upload_janitor
+from token_accounting import session_scope
+from structured_logging import configure_logging
+import metrics
 
 # Load environment variables from .env file
 load_dotenv()
 
+configure_logging()
+logger = logging.getLogger(__name__)
+
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "nurse-ally-secret-key")
@@ -25,6 +39,17 @@ if not os.path.exists(UPLOAD_FOLDER):
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
 
+# Uploads are stored once per content and shared by the sessions that uploaded them
+upload_store = UploadStore(UPLOAD_FOLDER)
+
+class UploadRequest(Request):
+    """Streams uploaded files straight into the upload store, hashing them on the way"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return upload_store.temp_file()
+
+app.request_class = UploadRequest
+
 # Initialize the NurseAlly agent
 nurse_ally = NurseAlly()
 
@@ -32,36 +57,140 @@ nurse_ally = NurseAlly()
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Initialize or get conversation context from session
+# Conversation context lives server-side; the session cookie only carries an opaque id
+conversation_store = create_store()
+register_store_metrics(conversation_store)
+
+# Deletes uploads no conversation needs any more and keeps them within their quotas
+upload_janitor = create_upload_janitor(upload_store, lambda session_id: conversation_store.get(session_id) is not None)
+
+def get_session_id():
+    if 'sid' not in session:
+        session['sid'] = secrets.token_urlsafe(32)
+    return session['sid']
+
+def save_conversation_context(context):
+    """Write the conversation context back to the server-side store
+
+    Changes saved by other requests (or the ingestion pool) since it was loaded
+    are merged in rather than overwritten.
+    """
+    with metrics.stage('session_save'):
+        g.conversation_context = conversation_store.save(get_session_id(), context,
+                                                         base=g.get('conversation_context_base'))
+        g.conversation_context_base = snapshot(g.conversation_context)
+
+# Initialize or get conversation context from the conversation store
 def get_conversation_context():
-    if 'conversation_context' not in session:
-        session['conversation_context'] = {
-            'conversation_history': [],
-            'symptoms_assessed': False,
-            'insurance_checked': False,
-            'facilities_recommended': False,
-            'urgency_level': None,
-            'symptoms': None,
-            'insurance_covers': None,
-            'coverage_note': None,
-            'map_link': None,
-            'user_profile': {
-                'nationality': 'Unknown',
-                'insurance_type': 'Unknown',
-                'insurance_provider': 'Unknown',
-                'country': 'Unknown',
-                'city': 'Unknown',
-                'language': 'English',
-                'chronic_conditions': [],
-                'allergies': []
-            }
-        }
-    return session['conversation_context']
+    if 'conversation_context' not in g:
+        with metrics.stage('session_load'):
+            context = conversation_store.get(get_session_id())
+        # Kept to merge against if someone else saves while this request runs
+        g.conversation_context_base = snapshot(context)
+        if context is not None:
+            # Pick up ingestion results a concurrent save may have missed
+            job_id = (context.get('insurance_file') or {}).get('job_id')
+            job = ingestion_jobs.get(job_id) if job_id else None
+            if job is not None:
+                apply_ingestion_result(context, job)
+        g.conversation_context = context
+    if g.conversation_context is None:
+        context = NurseAllyContext.new()
+        save_conversation_context(context)
+    return g.conversation_context
+
+def apply_ingestion_result(context, job):
+    """Write a finished ingestion job into the context and fill in the insurance
+    type and provider the user hasn't given yet. Returns True if the context changed."""
+    document = context.get('insurance_document') or {}
+    if ((context.get('insurance_file') or {}).get('job_id') != job['job_id']
+            or job['status'] not in ('done', 'failed') or document.get('status') in ('done', 'failed')):
+        return False
+    
+    document = {'job_id': job['job_id'], 'status': job['status'], 'error': job['error']}
+    if job['status'] == 'done':
+        document.update(job['result'])
+        profile = context['user_profile']
+        if document.get('plan_type') and profile.get('insurance_type', 'Unknown') == 'Unknown':
+            profile['insurance_type'] = document['plan_type']
+        if document.get('insurer') and profile.get('insurance_provider', 'Unknown') == 'Unknown':
+            profile['insurance_provider'] = document['insurer']
+    context['insurance_document'] = document
+    return True
+
+def store_ingestion_result(job):
+    """Called from the ingestion pool when a job finishes"""
+    conversation_store.modify(job['session_id'], lambda context: apply_ingestion_result(context, job))
+
+# Uploaded insurance documents are parsed in a worker pool, off the request thread
+ingestion_jobs = IngestionJobs(on_complete=store_ingestion_result)
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def record_exchange(user_message, response, context):
+    """Add the user message and the assistant's response to the conversation history"""
+    if user_message and (not context['conversation_history'] or 
+                        context['conversation_history'][-1]['role'] != 'user' or 
+                        context['conversation_history'][-1]['content'] != user_message):
+        context['conversation_history'].append({"role": "user", "content": user_message})
+    
+    context['conversation_history'].append({"role": "assistant", "content": response})
+
+def tool_results(context):
+    """Collect the map link, nearby facilities and insurance coverage results to send alongside the reply"""
+    results = {}
+    
+    # Add map link if available
+    if context.get('map_link'):
+        results['map_link'] = context['map_link']
+    
+    # Add the nearest facilities found for the user's location
+    if context.get('nearby_facilities'):
+        results['facilities'] = context['nearby_facilities']
+    
+    # Add insurance coverage information if available
+    if context.get('insurance_covers') is not None:
+        results['insurance_coverage'] = {
+            'covered': context['insurance_covers'],
+            'note': context.get('coverage_note', '')
+        }
+    
+    return results
+
+def sse_event(event, data):
+    """Format a Server-Sent Event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_chat(user_message, context):
+    """Stream the reply as Server-Sent Events: 'token' events while the model generates
+    text, then 'checklist' and 'tools' events and a final 'done' (or 'error') event"""
+    def generate():
+        try:
+            parts = []
+            with metrics.turn(stream=True) as timings:
+                timings.agent = 'nurse_ally'
+                with tenant_scope(tenant_for(request.headers, get_session_id())), session_scope(get_session_id()):
+                    for kind, text in nurse_ally.process_stream(user_message, context):
+                        parts.append(text)
+                        yield sse_event(kind, {'text': text})
+                
+                record_exchange(user_message, ''.join(parts), context)
+                save_conversation_context(context)
+            
+            results = tool_results(context)
+            if results:
+                yield sse_event('tools', results)
+            yield sse_event('done', {})
+        
+        except Exception as e:
+            logger.exception("Error in /api/chat stream: %s", e)
+            yield sse_event('error', {'error': str(e)})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     try:
@@ -71,53 +200,42 @@ def chat():
         if not user_message:
             return jsonify({'error': 'No message provided'}), 400
         
-        # Get conversation context from session
-        context = get_conversation_context()
-        
-        # Process the message using the NurseAlly agent
-        response, updated_context = nurse_ally.process(user_message, context)
-        
-        # Update session with the updated context
-        session['conversation_context'] = updated_context
-        
-        # Add the exchange to the conversation history
-        if user_message and (not updated_context['conversation_history'] or 
-                            updated_context['conversation_history'][-1]['role'] != 'user' or 
-                            updated_context['conversation_history'][-1]['content'] != user_message):
-            updated_context['conversation_history'].append({"role": "user", "content": user_message})
+        # Stream tokens as they arrive if the client asked for it
+        if request.json.get('stream') or request.accept_mimetypes.best == 'text/event-stream':
+            # Get conversation context from the conversation store
+            return stream_chat(user_message, get_conversation_context())
         
-        # Add the assistant's response to the conversation history
-        updated_context['conversation_history'].append({"role": "assistant", "content": response})
-        session['conversation_context'] = updated_context
+        with metrics.turn(stream=False) as timings:
+            timings.agent = 'nurse_ally'
+            context = get_conversation_context()
+            
+            # Process the message using the NurseAlly agent; its model calls count against
+            # this session's (or tenant's) admission limit
+            with tenant_scope(tenant_for(request.headers, get_session_id())), session_scope(get_session_id()):
+                response, updated_context = nurse_ally.process(user_message, context)
+            
+            # Add the exchange to the conversation history
+            record_exchange(user_message, response, updated_context)
+            save_conversation_context(updated_context)
         
         # Prepare the response data
         response_data = {
             'reply': response
         }
-        
-        # Add map link if available
-        if updated_context.get('map_link'):
-            response_data['map_link'] = updated_context['map_link']
-        
-        # Add insurance coverage information if available
-        if updated_context.get('insurance_covers') is not None:
-            response_data['insurance_coverage'] = {
-                'covered': updated_context['insurance_covers'],
-                'note': updated_context.get('coverage_note', '')
-            }
+        response_data.update(tool_results(updated_context))
         
         return jsonify(response_data)
     
     except Exception as e:
-        print(f"Error in /api/chat: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in /api/chat: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/reset', methods=['POST'])
 def reset_conversation():
-    if 'conversation_context' in session:
-        session.pop('conversation_context')
+    conversation_store.delete(get_session_id())
+    upload_store.release(get_session_id())
+    g.pop('conversation_context', None)
+    g.pop('conversation_context_base', None)
     return jsonify({'status': 'success', 'message': 'Conversation reset successfully'})
 
 @app.route('/api/location', methods=['POST'])
@@ -145,8 +263,8 @@ def update_location():
         if 'country' in data:
             context['user_profile']['country'] = data['country']
         
-        # Save updated context to session
-        session['conversation_context'] = context
+        # Save updated context to the conversation store
+        save_conversation_context(context)
         
         return jsonify({
             'status': 'success', 
@@ -167,41 +285,83 @@ def upload_insurance():
             return jsonify({'error': 'No selected file'}), 400
             
         if file and allowed_file(file.filename):
-            # Generate a secure filename with timestamp to avoid collisions
+            # The file was streamed to disk and hashed as it arrived; it is stored once per content
             filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            unique_filename = f"{timestamp}_{uuid.uuid4().hex}_{filename}"
+            if upload_janitor is not None:
+                upload_janitor.admit(get_session_id(), file.stream)
+            stored = upload_store.put(file.stream, filename)
+            upload_store.add_ref(get_session_id(), stored['sha256'])
             
-            # Save the file
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(file_path)
+            # Extract the insurer, plan and coverage clauses in the background, unless
+            # the same document was processed before
+            job_id = ingestion_jobs.submit(get_session_id(), stored['path'], filename)
             
-            # Update conversation context with insurance file info
+            # Update conversation context with insurance file info; the session lets
+            # go of the document it uploaded before
             context = get_conversation_context()
+            previous = (context.get('insurance_file') or {}).get('sha256')
+            if previous and previous != stored['sha256']:
+                upload_store.release(get_session_id(), previous)
             context['insurance_file'] = {
-                'filename': filename,  # Original filename for display
-                'path': file_path,     # Server path for processing
-                'uploaded_at': timestamp
+                'filename': filename,       # Original filename for display
+                'path': stored['path'],     # Server path for processing
+                'sha256': stored['sha256'],
+                'uploaded_at': datetime.now().strftime('%Y%m%d%H%M%S'),
+                'job_id': job_id
             }
+            context['insurance_document'] = {'job_id': job_id, 'status': 'queued'}
+            apply_ingestion_result(context, ingestion_jobs.get(job_id))
             
             # Update user profile with insurance information
-            # In a real application, you might extract insurance details from the file
             context['user_profile']['has_insurance_file'] = True
             
-            # Save updated context to session
-            session['conversation_context'] = context
+            # Save updated context to the conversation store
+            save_conversation_context(context)
             
+            status = context['insurance_document']['status']
             return jsonify({
                 'status': 'success',
                 'message': 'Insurance file uploaded successfully',
-                'filename': filename
-            })
+                'filename': filename,
+                'job_id': job_id,
+                'ingestion_status': status,
+                'deduplicated': stored['deduplicated']
+            }), 202 if status == 'queued' else 200
         
         return jsonify({'error': 'File type not allowed'}), 400
     
+    except QuotaExceeded as e:
+        # 413 for an upload over its conversation's quota, 507 while the store is full
+        return jsonify({'error': str(e)}), 413 if e.quota == 'session' else 507
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/upload_insurance/<job_id>', methods=['GET'])
+def insurance_upload_status(job_id):
+    job = ingestion_jobs.get(job_id)
+    if job is not None and job['session_id'] == get_session_id():
+        return jsonify({
+            'job_id': job_id,
+            'status': job['status'],
+            'filename': job['filename'],
+            'result': job['result'],
+            'error': job['error']
+        })
+    
+    # Finished jobs are eventually forgotten; the result stays in the context
+    context = get_conversation_context()
+    document = context.get('insurance_document') or {}
+    if document.get('job_id') != job_id:
+        return jsonify({'error': 'Unknown job'}), 404
+    result = {k: v for k, v in document.items() if k not in ('job_id', 'status', 'error')}
+    return jsonify({
+        'job_id': job_id,
+        'status': document.get('status'),
+        'filename': (context.get('insurance_file') or {}).get('filename'),
+        'result': result or None,
+        'error': document.get('error')
+    })
+
 @app.route('/api/profile', methods=['POST'])
 def update_profile():
     try:
@@ -218,8 +378,8 @@ def update_profile():
             if key in context['user_profile']:
                 context['user_profile'][key] = data[key]
         
-        # Save updated context to session
-        session['conversation_context'] = context
+        # Save updated context to the conversation store
+        save_conversation_context(context)
         
         return jsonify({
             'status': 'success', 
@@ -228,5 +388,46 @@ def update_profile():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Tokens this session's model calls used, by prompt section
+@app.route('/api/token_usage', methods=['GET'])
+def get_token_usage():
+    if nurse_ally.llm.ledger is None:
+        return jsonify({'error': 'Token accounting is off'}), 404
+    return jsonify(nurse_ally.llm.ledger.session_usage(get_session_id()))
+
+# The heaviest sessions (by a hash of their id) and the tokens per prompt section;
+# for operators only
+@app.route('/api/token_usage/report', methods=['GET'])
+def get_token_report():
+    refused = metrics.operator_refusal(request.headers.get('Authorization'))
+    if refused:
+        return jsonify({'error': 'This report needs the operator token'}), refused
+    if nurse_ally.llm.ledger is None:
+        return jsonify({'error': 'Token accounting is off'}), 404
+    return jsonify(nurse_ally.llm.ledger.report(request.args.get('limit', 10, type=int)))
+
+@app.route('/api/uploads/stats', methods=['GET'])
+def get_upload_stats():
+    refused = metrics.operator_refusal(request.headers.get('Authorization'))
+    if refused:
+        return jsonify({'error': 'This report needs the operator token'}), refused
+    if upload_janitor is None:
+        return jsonify({'error': 'The upload janitor is off'}), 404
+    return jsonify(upload_janitor.stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    metrics.observe_request(request.url_rule and request.url_rule.rule, request.method, response.status_code,
+                            time.perf_counter() - g.get('request_started', time.perf_counter()))
+    return response
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -254,6 +254,9 @@ document.addEventListener('DOMContentLoaded', function() {
         .then(data => {
             insuranceStatus.textContent = 'File uploaded: ' + file.name;
             console.log('Insurance file uploaded:', data);
+            if (data.job_id) {
+                pollInsuranceJob(data.job_id, file.name);
+            }
         })
         .catch(error => {
             console.error('Error uploading insurance file:', error);
@@ -261,6 +264,24 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    // Poll the background processing of an uploaded insurance document
+    function pollInsuranceJob(jobId, fileName, attempt = 0) {
+        fetch(`/api/upload_insurance/${jobId}`)
+        .then(response => response.json())
+        .then(job => {
+            if (job.status === 'done') {
+                const result = job.result || {};
+                const details = [result.insurer, result.plan_type].filter(Boolean).join(', ');
+                insuranceStatus.textContent = details ? `File processed: ${details}` : 'File uploaded: ' + fileName;
+            } else if (job.status === 'failed') {
+                insuranceStatus.textContent = 'File uploaded: ' + fileName + ' (could not be read)';
+            } else if (attempt < 60) {
+                setTimeout(() => pollInsuranceJob(jobId, fileName, attempt + 1), 1000);
+            }
+        })
+        .catch(error => console.error('Error checking insurance file:', error));
+    }
+    
     function openProfileModal() {
         // Populate form with current profile data
         document.getElementById('nationality').value = userProfile.nationality;
@@ -0,0 +1,183 @@
+import os
+import re
+import json
+import math
+import heapq
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Chunks are about this many words; the last sentence of each chunk is repeated at
+# the start of the next so a clause split across the boundary is still found whole
+DEFAULT_CHUNK_WORDS = int(os.getenv("POLICY_CHUNK_WORDS", "120"))
+DEFAULT_TOP_K = int(os.getenv("POLICY_RETRIEVAL_TOP_K", "3"))
+
+# Page separator in extracted document text
+PAGE_BREAK = '\f'
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+INDEX_VERSION = 1
+
+STOPWORDS = frozenset("""
+a an and are as at be been but by can do does for from has have he her his i if in into is it its
+me my no not of on or our she so such that the their them then there these they this to was we
+were what when where which who will with would you your shall may any all other than also
+""".split())
+
+_TOKEN = re.compile(r'[a-z0-9]+')
+_SENTENCE_SPLIT = re.compile(r'(?<=[.;:!?])\s+|\n{2,}')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _stem(token):
+    # Light suffix stripping so "expenses" matches "expense" and "covered" matches "cover"
+    for suffix, replacement in (('ies', 'y'), ('ing', ''), ('ed', ''), ('es', ''), ('s', '')):
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[:-len(suffix)] + replacement
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, drop stopwords and stem the words of a text"""
+    return [_stem(token) for token in _TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def chunk_text(text: str, chunk_words: int = DEFAULT_CHUNK_WORDS) -> List[Dict[str, Any]]:
+    """Split document text into overlapping chunks of whole sentences
+
+    Pages are separated by form feeds in the extracted text; each chunk records the
+    page it starts on.
+    """
+    chunks: List[Dict[str, Any]] = []
+    for page_number, page in enumerate(text.split(PAGE_BREAK), 1):
+        sentences = [_WHITESPACE.sub(' ', s).strip() for s in _SENTENCE_SPLIT.split(page)]
+        sentences = [s for s in sentences if s]
+        current: List[str] = []
+        words = 0
+        for sentence in sentences:
+            sentence_words = len(sentence.split())
+            if current and words + sentence_words > chunk_words:
+                chunks.append({'page': page_number, 'text': ' '.join(current)})
+                current = current[-1:] if len(current) > 1 else []
+                words = sum(len(s.split()) for s in current)
+            current.append(sentence)
+            words += sentence_words
+        if current:
+            chunks.append({'page': page_number, 'text': ' '.join(current)})
+
+    # Tables of contents and title pages are mostly capitals and only add noise
+    chunks = [chunk for chunk in chunks if not _mostly_capitals(chunk['text'])]
+    for chunk_id, chunk in enumerate(chunks):
+        chunk['id'] = chunk_id
+    return chunks
+
+
+def _mostly_capitals(text):
+    letters = [ch for ch in text if ch.isalpha()]
+    return not letters or sum(ch.isupper() for ch in letters) / len(letters) > 0.6
+
+
+class PolicyIndex:
+    """BM25 index over the chunks of one policy document
+
+    Built once when the document is ingested and saved next to the upload as JSON,
+    so answering a question only loads the postings and scores the query terms.
+    """
+
+    def __init__(self, chunks: Sequence[Dict[str, Any]], lengths: Sequence[int],
+                 postings: Dict[str, List[Tuple[int, int]]]):
+        self.chunks = list(chunks)
+        self.lengths = list(lengths)
+        self.postings = postings
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+
+    @classmethod
+    def build(cls, chunks: Sequence[Dict[str, Any]]) -> 'PolicyIndex':
+        lengths = []
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        for chunk in chunks:
+            counts: Dict[str, int] = {}
+            tokens = tokenize(chunk['text'])
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((chunk['id'], count))
+            lengths.append(len(tokens))
+        return cls(chunks, lengths, postings)
+
+    @classmethod
+    def from_text(cls, text: str, chunk_words: int = DEFAULT_CHUNK_WORDS) -> 'PolicyIndex':
+        return cls.build(chunk_text(text, chunk_words))
+
+    def search(self, query: str, k: int = DEFAULT_TOP_K) -> List[Tuple[float, Dict[str, Any]]]:
+        """Return up to k (score, chunk) pairs for the query, best first"""
+        if not self.chunks:
+            return []
+        total = len(self.chunks)
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, tf in postings:
+                norm = K1 * (1 - B + B * self.lengths[chunk_id] / self.avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(score, self.chunks[chunk_id]) for chunk_id, score in best]
+
+    def save(self, path: str) -> None:
+        data = {
+            'version': INDEX_VERSION,
+            'chunks': self.chunks,
+            'lengths': self.lengths,
+            'postings': self.postings
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'PolicyIndex':
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != INDEX_VERSION:
+            raise ValueError(f"Unsupported policy index version: {data.get('version')}")
+        postings = {term: [tuple(p) for p in entries] for term, entries in data['postings'].items()}
+        return cls(data['chunks'], data['lengths'], postings)
+
+    def __len__(self):
+        return len(self.chunks)
+
+
+def index_path_for(upload_path: str) -> str:
+    """Where the index of an upload is kept, next to the file itself"""
+    return upload_path + '.index.json'
+
+
+@lru_cache(maxsize=64)
+def _load_cached(path, mtime):
+    return PolicyIndex.load(path)
+
+
+def load_policy_index(index_path: Optional[str] = None, text_path: Optional[str] = None) -> Optional[PolicyIndex]:
+    """Load a saved policy index, building it from the extracted text if it is missing
+
+    Loaded indexes are cached per file and modification time.
+    """
+    if not index_path or not os.path.exists(index_path):
+        if not text_path or not os.path.exists(text_path):
+            return None
+        with open(text_path, encoding='utf-8') as f:
+            index = PolicyIndex.from_text(f.read())
+        index_path = index_path or index_path_for(text_path[:-len('.txt')])
+        index.save(index_path)
+    return _load_cached(index_path, os.path.getmtime(index_path))
+
+
+def relevant_clauses(index: PolicyIndex, query: str, k: int = DEFAULT_TOP_K) -> List[str]:
+    """Return the text of the top-k chunks for the query, labelled with their page"""
+    return [f"(page {chunk['page']}) {chunk['text']}" for score, chunk in index.search(query, k) if score > 0]
@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+DEFAULT_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+DEFAULT_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+
+# Turns that carry anything looking like personal data are never cached: emails,
+# phone or policy numbers, coordinates and self-introductions
+PERSONAL_DATA = re.compile(
+    r'[\w.+-]+@[\w-]+\.[\w.]+'                   # email address
+    r'|\+?\d[\d\s().-]{6,}\d'                    # phone number or long digit run
+    r'|\b(?=[a-z0-9-]*\d)[a-z0-9]+-?[a-z0-9]{5,}\b'  # policy / card / ID number
+    r'|-?\d{1,3}\.\d{3,}'                        # latitude or longitude
+    r'|\bmy name is\b|\bi am \d+ years\b',
+    re.IGNORECASE
+)
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(text: str) -> str:
+    """Normalize case, whitespace and trailing punctuation so trivially different
+    phrasings of the same message share a cache entry"""
+    return _WHITESPACE.sub(' ', text).strip().lower().rstrip('.!?')
+
+
+class ResponseCache:
+    """Cache of completions for prompts that many users send identically
+
+    Keyed on a hash of the agent, model, temperature and the normalized message list
+    (which includes the system prompt and injected facts). Entries live in an
+    in-memory LRU with a TTL and, optionally, in a SQLite file shared by workers and
+    kept across restarts. Prompts containing personal data bypass the cache.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: int = DEFAULT_TTL,
+                 disk_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'bypassed': 0, 'stores': 0}
+
+        self._disk = None
+        if disk_path:
+            directory = os.path.dirname(os.path.abspath(disk_path))
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def make_key(self, agent: Optional[str], messages: List[Dict[str, str]], model: str,
+                 temperature: float) -> Optional[str]:
+        """Return the cache key for a prompt, or None if it must not be cached"""
+        # The agent's own system prompt comes first and never holds user data
+        if any(PERSONAL_DATA.search(m.get('content') or '') for m in messages[1:]):
+            with self._lock:
+                self.stats['bypassed'] += 1
+            return None
+
+        normalized = [[m.get('role'), normalize_text(m.get('content') or '')] for m in messages]
+        payload = json.dumps([agent, model, temperature, normalized], separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                response, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.stats['memory_hits'] += 1
+                    return response
+                del self._entries[key]
+
+            if self._disk is not None:
+                row = self._disk.execute(
+                    "SELECT response, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+                if row:
+                    self._remember(key, row[0], row[1])
+                    self.stats['disk_hits'] += 1
+                    return row[0]
+
+            self.stats['misses'] += 1
+            return None
+
+    def set(self, key: str, response: str) -> None:
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, response, expires_at)
+            if self._disk is not None:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, expires_at) VALUES (?, ?, ?)",
+                    (key, response, expires_at)
+                )
+            self.stats['stores'] += 1
+
+    def _remember(self, key, response, expires_at):
+        self._entries[key] = (response, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the hit/miss counters and the number of entries held in memory"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
+
+
+def create_response_cache(setting: Optional[str] = None) -> Optional[ResponseCache]:
+    """Create the cache configured by RESPONSE_CACHE: unset or 'off' disables it,
+    'memory' keeps entries in process and 'disk:/path/to/cache.db' adds a disk tier"""
+    setting = setting if setting is not None else os.getenv("RESPONSE_CACHE", "off")
+
+    if setting in ("", "off"):
+        return None
+    if setting == "memory":
+        return ResponseCache()
+    if setting.startswith("disk:"):
+        return ResponseCache(disk_path=setting[len("disk:"):])
+
+    raise ValueError(f"Unknown response cache setting: {setting}")
@@ -0,0 +1,121 @@
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from keywords import scan_message
+from conversation_state import CareLevel
+from coverage_rules import CoverageRules, default_rules
+from facilities import FacilityIndex, default_index
+
+# Care level suited to each triage urgency
+CARE_LEVELS = {
+    "severe": CareLevel.HOSPITAL,
+    "moderate": CareLevel.WALK_IN_CLINIC,
+    "mild": CareLevel.PHARMACY
+}
+
+# Facility types in the facility index that provide each care level
+FACILITY_TYPES = {
+    "hospital": ["Emergency Room"],
+    "walk-in clinic": ["Urgent Care", "Primary Care", "Emergency Room"],
+    "pharmacy": ["Pharmacy"]
+}
+
+# What to search the map for at each care level
+MAP_SEARCH_TERMS = {
+    "hospital": "emergency hospital",
+    "walk-in clinic": "urgent care clinic",
+    "pharmacy": "pharmacy"
+}
+
+CARE_ADVICE = {
+    "hospital": "What you describe sounds serious. Please go to the nearest hospital emergency department, "
+                "or call your local emergency number if it gets worse.",
+    "walk-in clinic": "From what you describe, a walk-in or urgent care clinic is the right place to be seen, "
+                      "ideally today.",
+    "pharmacy": "From what you describe, a pharmacist can probably help; see a doctor if it doesn't improve "
+                "in a few days."
+}
+
+INTRO = "I can't give you a full answer right now, so here is what I can tell you from your details:"
+OUTRO = "Ask me again in a moment for a fuller answer."
+
+
+def triage(symptoms: str) -> str:
+    """Triage symptoms to an urgency level: severe, moderate or mild"""
+    hits = scan_message(symptoms)
+    if 'triage_severe' in hits:
+        return "severe"
+    if 'triage_moderate' in hits:
+        return "moderate"
+    return "mild"
+
+
+def map_link(care_level: str, city: Optional[str] = None, latitude: Optional[float] = None,
+             longitude: Optional[float] = None) -> str:
+    """Google Maps search for the care level, centred on the user when we know where they are"""
+    search_term = MAP_SEARCH_TERMS.get(care_level, care_level)
+    known_city = city and city != 'Unknown'
+    if latitude is not None and longitude is not None and not known_city:
+        return f"https://www.google.com/maps/search/{search_term}/@{latitude},{longitude},13z".replace(" ", "+")
+    if not known_city:
+        # Maps searches around the device's own location
+        return f"https://www.google.com/maps/search/{search_term}+near+me".replace(" ", "+")
+    return f"https://www.google.com/maps/search/{search_term}+in+{city}".replace(" ", "+")
+
+
+def render_reply(care_level: str, insurance_type: Optional[str], covered: bool, coverage_note: str,
+                 facilities: List[Dict[str, Any]], link: str, checklist: Sequence[str]) -> str:
+    """The templated reply given in place of the model's"""
+    lines = [INTRO, f"- {CARE_ADVICE.get(care_level, CARE_ADVICE['walk-in clinic'])}"]
+    if insurance_type and insurance_type != 'Unknown':
+        covers = "usually covers" if covered else "may not cover"
+        lines.append(f"- Your {insurance_type} insurance {covers} this kind of care. {coverage_note}".rstrip())
+    if facilities:
+        nearby = '; '.join(f"{f['name']} ({f['type']}, {f['distance']})" for f in facilities[:3])
+        lines.append(f"- Nearest suitable places: {nearby}")
+    lines.append(f"- [Find {MAP_SEARCH_TERMS.get(care_level, care_level)} options on the map]({link})")
+    lines.append("- Keep these for an insurance claim: " + ', '.join(checklist))
+    lines.append("")
+    lines.append(OUTRO)
+    return '\n'.join(lines)
+
+
+class RulesReply(NamedTuple):
+    text: str
+    urgency: str
+    care_level: str
+    covered: bool
+    coverage_note: str
+    map_link: str
+    facilities: List[Dict[str, Any]]
+    checklist: Tuple[str, ...]
+
+
+class RulesResponder:
+    """Answers a turn from the local rules alone, without the model
+
+    Used when the model can't be (overloaded, failing, or its circuit is open):
+    the urgency comes from keyword triage, coverage and the claim checklist from
+    the coverage rules, and where to go from the facility index and a map link.
+    Every part is a local lookup, so the reply is immediate.
+    """
+
+    def __init__(self, coverage_rules: Optional[CoverageRules] = None, facilities: Optional[FacilityIndex] = None):
+        self.coverage_rules = coverage_rules or default_rules()
+        self.facilities = facilities or default_index()
+
+    def respond(self, message: str, urgency: Optional[str] = None, insurance_type: Optional[str] = None,
+                country: Optional[str] = None, city: Optional[str] = None, latitude: Optional[float] = None,
+                longitude: Optional[float] = None) -> RulesReply:
+        """Build the reply; `urgency` (severe, moderate or mild) is triaged from the message when not known"""
+        urgency = urgency or triage(message)
+        care_level = CARE_LEVELS.get(urgency, "walk-in clinic")
+        rule = self.coverage_rules.lookup(insurance_type or 'Unknown', country or 'Unknown', care_level)
+        link = map_link(care_level, city, latitude, longitude)
+
+        facilities = []
+        if latitude is not None and longitude is not None:
+            nearest = self.facilities.nearest(latitude, longitude, FACILITY_TYPES.get(care_level))
+            facilities = [facility.to_dict(distance) for distance, facility in nearest]
+
+        text = render_reply(care_level, insurance_type, rule.covered, rule.note, facilities, link, rule.checklist)
+        return RulesReply(text, urgency, care_level, rule.covered, rule.note, link, facilities, rule.checklist)
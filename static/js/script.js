@@ -79,17 +79,22 @@ document.addEventListener('DOMContentLoaded', function() {
         facilityAddress.textContent = `Address: ${facility.address}`;
         facilityCard.appendChild(facilityAddress);
         
-        const facilityPhone = document.createElement('p');
-        facilityPhone.textContent = `Phone: ${facility.phone}`;
-        facilityCard.appendChild(facilityPhone);
+        // Phone numbers and wait times are not known for every facility
+        if (facility.phone) {
+            const facilityPhone = document.createElement('p');
+            facilityPhone.textContent = `Phone: ${facility.phone}`;
+            facilityCard.appendChild(facilityPhone);
+        }
         
         const facilityDistance = document.createElement('p');
         facilityDistance.textContent = `Distance: ${facility.distance}`;
         facilityCard.appendChild(facilityDistance);
         
-        const facilityWaitTime = document.createElement('p');
-        facilityWaitTime.textContent = `Estimated wait time: ${facility.wait_time}`;
-        facilityCard.appendChild(facilityWaitTime);
+        if (facility.wait_time) {
+            const facilityWaitTime = document.createElement('p');
+            facilityWaitTime.textContent = `Estimated wait time: ${facility.wait_time}`;
+            facilityCard.appendChild(facilityWaitTime);
+        }
         
         // Add insurance acceptance information if available
         if (facility.accepts_insurance && facility.accepts_insurance.length > 0) {
@@ -113,7 +118,8 @@ document.addEventListener('DOMContentLoaded', function() {
         }
         
         const mapLink = document.createElement('a');
-        mapLink.href = `https://www.google.com/maps/search/?api=1&query=${encodeURIComponent(facility.name + ' ' + facility.address)}`;
+        mapLink.href = facility.google_maps_url ||
+            `https://www.google.com/maps/search/?api=1&query=${encodeURIComponent(facility.name + ' ' + facility.address)}`;
         mapLink.target = '_blank';
         mapLink.className = 'map-link';
         mapLink.textContent = 'View on Google Maps';
@@ -175,8 +181,81 @@ document.addEventListener('DOMContentLoaded', function() {
         addMessage(facilitiesContainer, false);
     }
 
+    // Function to read Server-Sent Events from a streamed fetch response
+    async function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) {
+                break;
+            }
+            buffer += decoder.decode(value, { stream: true });
+            
+            // Events are separated by a blank line
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                
+                let eventName = 'message';
+                let eventData = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) {
+                        eventName = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        eventData += line.slice(5).trim();
+                    }
+                });
+                onEvent(eventName, eventData ? JSON.parse(eventData) : {});
+            }
+        }
+    }
+
+    // Messages sent and not yet answered, so a double submit doesn't send one twice
+    const pendingMessages = new Set();
+    
+    // A key identifying one message; the server answers every retry that carries it once
+    function newIdempotencyKey() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return Date.now().toString(36) + Math.random().toString(36).slice(2);
+    }
+    
+    // Post a chat message, retrying network errors and gateway failures with the same key
+    async function postChat(message, idempotencyKey, attempts = 3) {
+        for (let attempt = 1; ; attempt++) {
+            try {
+                const response = await fetch('/api/chat', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                        'Accept': 'text/event-stream',
+                        'Idempotency-Key': idempotencyKey
+                    },
+                    body: JSON.stringify({ message: message, stream: true })
+                });
+                if (![502, 503, 504].includes(response.status) || attempt >= attempts) {
+                    return response;
+                }
+            } catch (error) {
+                if (attempt >= attempts) {
+                    throw error;
+                }
+            }
+            await new Promise(resolve => setTimeout(resolve, 500 * 2 ** (attempt - 1)));
+        }
+    }
+    
     // Function to send a message to the server
     async function sendMessage(message) {
+        if (pendingMessages.has(message)) {
+            return;
+        }
+        pendingMessages.add(message);
         try {
             // Display user message in the chat
             addMessage(message, true);
@@ -193,34 +272,69 @@ document.addEventListener('DOMContentLoaded', function() {
             loadingDiv.appendChild(loadingContent);
             chatMessages.appendChild(loadingDiv);
 
-            // Send message to server
-            const response = await fetch('/api/chat', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ message: message })
-            });
-
-            // Remove loading indicator
-            chatMessages.removeChild(loadingDiv);
+            // Send message to server, asking for the reply to be streamed
+            const response = await postChat(message, newIdempotencyKey());
 
             if (!response.ok) {
+                chatMessages.removeChild(loadingDiv);
                 throw new Error('Failed to get response');
             }
-
-            const data = await response.json();
             
-            // Display bot response
-            addMessage(data.reply, false);
+            const contentType = response.headers.get('Content-Type') || '';
+            if (!contentType.includes('text/event-stream') || !response.body) {
+                // Remove loading indicator
+                chatMessages.removeChild(loadingDiv);
+                
+                const data = await response.json();
+                
+                // Display bot response
+                addMessage(data.reply, false);
+                
+                // If facilities are included in the response, display them with analysis if available
+                if (data.facilities && data.facilities.length > 0) {
+                    displayFacilities(data.facilities, data.analysis);
+                }
+                return;
+            }
+            
+            // Render the reply incrementally, reusing the loading bubble for the text
+            let replyText = '';
+            let analysis = null;
+            let started = false;
+            
+            await readEventStream(response, (eventName, data) => {
+                if (eventName === 'token' || eventName === 'analysis') {
+                    if (!started) {
+                        started = true;
+                        loadingContent.textContent = '';
+                    }
+                    replyText += data.text;
+                    loadingContent.innerHTML = replyText.replace(/\n/g, '<br>');
+                    chatMessages.scrollTop = chatMessages.scrollHeight;
+                    if (eventName === 'analysis') {
+                        analysis = data.analysis;
+                    }
+                } else if (eventName === 'facilities') {
+                    if (data.facilities && data.facilities.length > 0) {
+                        displayFacilities(data.facilities, analysis);
+                    }
+                } else if (eventName === 'error') {
+                    if (!started) {
+                        started = true;
+                        chatMessages.removeChild(loadingDiv);
+                    }
+                    throw new Error(data.error);
+                }
+            });
             
-            // If facilities are included in the response, display them with analysis if available
-            if (data.facilities && data.facilities.length > 0) {
-                displayFacilities(data.facilities, data.analysis);
+            if (!started) {
+                chatMessages.removeChild(loadingDiv);
             }
         } catch (error) {
             console.error('Error:', error);
             addMessage('Sorry, there was an error processing your request.', false);
+        } finally {
+            pendingMessages.delete(message);
         }
     }
     
@@ -341,6 +455,11 @@ async function uploadInsuranceFile(file) {
         // Inform the user that their insurance file has been uploaded
         addMessage('I\'ve received your insurance information. This will help me find facilities that accept your insurance.', false);
         
+        // The document is read in the background; show what was found once it's done
+        if (data.job_id) {
+            pollInsuranceJob(data.job_id, data.filename);
+        }
+        
     } catch (error) {
             console.error('Error uploading insurance file:', error);
             insuranceStatus.textContent = 'Upload failed';
@@ -349,6 +468,36 @@ async function uploadInsuranceFile(file) {
         }
     }
     
+    // Function to poll the processing of an uploaded insurance document
+    async function pollInsuranceJob(jobId, filename) {
+        for (let attempt = 0; attempt < 60; attempt++) {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            try {
+                const response = await fetch(`/api/upload_insurance/${jobId}`);
+                if (!response.ok) {
+                    return;
+                }
+                const job = await response.json();
+                if (job.status === 'done') {
+                    const result = job.result || {};
+                    const details = [result.insurer, result.plan_type].filter(Boolean).join(', ');
+                    if (details) {
+                        insuranceStatus.textContent = `File processed: ${details}`;
+                    }
+                    return;
+                }
+                if (job.status === 'failed') {
+                    insuranceStatus.textContent = 'File uploaded: ' + filename + ' (could not be read)';
+                    insuranceStatus.style.color = '#666';
+                    return;
+                }
+            } catch (error) {
+                console.error('Error checking insurance file:', error);
+                return;
+            }
+        }
+    }
+    
     // Function to reset the conversation
     async function resetConversation() {
         try {
@@ -0,0 +1,174 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, Overloaded, TokenBucket
+
+
+def admit_and_record(controller, order, name, tenant=None):
+    with controller.admit(tenant):
+        order.append(name)
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(rate=2, burst=2, now=0)
+    for _ in range(2):
+        assert bucket.wait_time(0) == 0
+        bucket.take()
+    assert bucket.wait_time(0) == pytest.approx(0.5)
+    assert bucket.wait_time(0.5) == 0
+    # Idle time doesn't bank more than the burst
+    assert bucket.wait_time(100) == 0 and bucket.tokens == 2
+
+
+def test_burst_then_queue_timeout():
+    controller = AdmissionController(rate=1, burst=2, tenant_rate=0, queue_timeout=0.05)
+    for _ in range(2):
+        controller.acquire()
+        controller.release()
+    # The next token is a second away, longer than the call may wait
+    with pytest.raises(Overloaded):
+        controller.acquire()
+    assert controller.stats == {'admitted': 2, 'queued': 1, 'rejected': 0, 'timed_out': 1}
+    assert controller.waiting == 0
+
+
+def test_tenant_limit_doesnt_hold_up_other_tenants():
+    controller = AdmissionController(rate=0, tenant_rate=1, tenant_burst=1, queue_timeout=0.01)
+    with controller.admit('a'):
+        pass
+    with pytest.raises(Overloaded):
+        controller.acquire('a')
+    with controller.admit('b'):
+        pass
+
+
+def test_full_queue_rejects_straight_away():
+    controller = AdmissionController(rate=0, tenant_rate=0, max_concurrency=1, max_queue=0)
+    controller.acquire()
+    assert controller.saturated
+    with pytest.raises(Overloaded):
+        controller.acquire()
+    assert controller.stats['rejected'] == 1
+    controller.release()
+    assert controller.in_flight == 0
+
+
+def test_queued_call_is_admitted_when_a_slot_frees():
+    controller = AdmissionController(rate=0, tenant_rate=0, max_concurrency=1, queue_timeout=5)
+    controller.acquire()
+    admitted = threading.Event()
+
+    def wait():
+        with controller.admit():
+            admitted.set()
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    while controller.waiting == 0:
+        time.sleep(0.001)
+    assert not admitted.is_set()
+    controller.release()
+    waiter.join(5)
+    assert admitted.is_set()
+    assert controller.stats['queued'] == 1 and controller.stats['timed_out'] == 0
+
+
+def test_async_waiter_is_woken_by_release():
+    controller = AdmissionController(rate=0, tenant_rate=0, max_concurrency=1, queue_timeout=5)
+
+    async def main():
+        await controller.aacquire()
+        started = time.monotonic()
+        waiter = asyncio.ensure_future(controller.aacquire())
+        await asyncio.sleep(0.01)
+        assert not waiter.done() and controller.waiting == 1
+        controller.release()
+        await waiter
+        controller.release()
+        return time.monotonic() - started
+
+    assert asyncio.run(main()) < 1
+    assert controller.in_flight == 0 and controller.waiting == 0
+
+
+def test_async_queue_timeout():
+    controller = AdmissionController(rate=0, tenant_rate=0, max_concurrency=1, queue_timeout=0.02)
+
+    async def main():
+        await controller.aacquire()
+        with pytest.raises(Overloaded):
+            async with controller.aadmit():
+                pass
+
+    asyncio.run(main())
+    assert controller.stats['timed_out'] == 1 and controller.waiting == 0
+
+
+def test_waiting_calls_are_admitted_before_newcomers():
+    controller = AdmissionController(rate=0, tenant_rate=0, max_concurrency=1, queue_timeout=5)
+    controller.acquire()
+    order = []
+
+    def wait(name):
+        with controller.admit():
+            order.append(name)
+
+    first = threading.Thread(target=wait, args=('first',))
+    first.start()
+    while controller.waiting == 0:
+        time.sleep(0.001)
+    # The freed slot goes to the call already waiting, not to one arriving now
+    controller.release()
+    wait('newcomer')
+    first.join(5)
+    assert order == ['first', 'newcomer']
+    assert controller.stats['queued'] == 2
+
+
+def test_queued_calls_keep_their_order():
+    controller = AdmissionController(rate=0, tenant_rate=0, max_concurrency=1, queue_timeout=5)
+    controller.acquire()
+    order = []
+    threads = []
+    for i in range(4):
+        thread = threading.Thread(target=admit_and_record, args=(controller, order, i))
+        thread.start()
+        threads.append(thread)
+        while controller.waiting <= i:
+            time.sleep(0.001)
+    controller.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == [0, 1, 2, 3]
+    assert controller.in_flight == 0 and controller.waiting == 0
+
+
+def test_a_tenant_waiting_on_its_bucket_doesnt_hold_up_others():
+    controller = AdmissionController(rate=0, tenant_rate=10, tenant_burst=1, queue_timeout=5)
+    with controller.admit('a'):
+        pass
+    order = []
+    waiter = threading.Thread(target=admit_and_record, args=(controller, order, 'a', 'a'))
+    waiter.start()
+    while controller.waiting == 0:
+        time.sleep(0.001)
+    started = time.monotonic()
+    admit_and_record(controller, order, 'b', 'b')
+    assert time.monotonic() - started < 0.05
+    waiter.join(5)
+    assert order == ['b', 'a']
+    assert controller.stats['admitted'] == 3 and controller.stats['timed_out'] == 0
+
+
+def test_timed_out_tenant_call_gets_its_token_back():
+    controller = AdmissionController(rate=0, tenant_rate=1, tenant_burst=1, max_concurrency=1, queue_timeout=0.02)
+    controller.acquire('a')
+    with pytest.raises(Overloaded):
+        controller.acquire('b')
+    controller.release()
+    with controller.admit('b'):
+        pass
+
@@ -0,0 +1,114 @@
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def breaker(**kwargs):
+    options = dict(window=30, min_calls=4, failure_rate=0.5, slow_call=10, slow_rate=0.8, open_seconds=30,
+                   half_open_probes=1)
+    options.update(kwargs)
+    return CircuitBreaker(**options)
+
+
+def open_breaker(b):
+    for _ in range(b.min_calls):
+        b.allow()
+        b.record_failure()
+    assert b.state == OPEN
+
+
+def test_stays_closed_until_enough_calls(clock):
+    b = breaker()
+    for _ in range(3):
+        b.record_failure()
+    assert b.state == CLOSED
+    b.record_success(0.1)
+    # 3 failures out of 4
+    assert b.state == OPEN
+
+
+def test_old_calls_leave_the_window(clock):
+    b = breaker()
+    for _ in range(3):
+        b.record_failure()
+    clock[0] += 31
+    for _ in range(3):
+        b.record_success(0.1)
+    b.record_failure()
+    assert b.state == CLOSED
+
+
+def test_open_half_open_closed(clock):
+    b = breaker()
+    open_breaker(b)
+    with pytest.raises(CircuitOpen):
+        b.allow()
+    assert b.stats == {'opened': 1, 'refused': 1}
+
+    clock[0] += 30
+    assert b.state == HALF_OPEN
+    b.allow()
+    # Only one probe at a time
+    with pytest.raises(CircuitOpen):
+        b.allow()
+    b.record_success(0.1)
+    assert b.state == CLOSED
+    b.allow()
+
+
+def test_failed_probe_reopens(clock):
+    b = breaker()
+    open_breaker(b)
+    clock[0] += 30
+    b.allow()
+    b.record_failure()
+    assert b.state == OPEN
+    assert b.stats['opened'] == 2
+    clock[0] += 29
+    assert b.is_open
+
+
+def test_slow_probe_reopens(clock):
+    b = breaker()
+    open_breaker(b)
+    clock[0] += 30
+    b.allow()
+    b.record_success(12)
+    assert b.state == OPEN
+
+
+def test_slow_calls_open_the_circuit(clock):
+    b = breaker()
+    for _ in range(4):
+        b.record_success(11)
+    assert b.state == OPEN
+
+
+def test_lost_probe_frees_its_place(clock):
+    b = breaker()
+    open_breaker(b)
+    clock[0] += 30
+    b.allow()
+    clock[0] += 30
+    b.allow()
+
+
+def test_calls_finishing_while_open_are_ignored(clock):
+    b = breaker(half_open_probes=2)
+    open_breaker(b)
+    b.record_success(0.1)
+    clock[0] += 30
+    b.allow()
+    b.record_success(0.1)
+    assert b.state == HALF_OPEN
+    b.allow()
+    b.record_success(0.1)
+    assert b.state == CLOSED
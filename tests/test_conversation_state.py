@@ -0,0 +1,141 @@
+import copy
+import json
+
+from conversation_state import (CareLevel, Conversation, NurseAllyContext, Urgency, decode, encode, encode_changes,
+                                snapshot)
+
+
+def conversation(turns=2):
+    state = Conversation.new()
+    for i in range(turns):
+        state['messages'].append({'role': 'user', 'content': f'question {i}'})
+        state['messages'].append({'role': 'assistant', 'content': f'answer {i}'})
+    state['urgency_level'] = Urgency.URGENT
+    state['symptom_data'] = {'fever': True, 'days': 3}
+    state['current_agent'] = 'symptom'
+    state['version'] = 4
+    state['note'] = 'kept on the side'
+    return state
+
+
+def test_round_trip_is_equal():
+    state = conversation()
+    decoded = decode(encode(state))
+    assert type(decoded) is Conversation
+    assert decoded == state
+    assert decoded.to_dict() == state.to_dict()
+    assert decoded['urgency_level'] is Urgency.URGENT
+    assert decoded['note'] == 'kept on the side'
+
+
+def test_round_trip_keeps_missing_fields_missing():
+    state = Conversation(messages=[], version=1)
+    decoded = decode(encode(state))
+    assert 'symptom_data' not in decoded
+    assert dict(decoded) == {'messages': [], 'version': 1}
+
+
+def test_nurse_ally_context_round_trip():
+    context = NurseAllyContext.new()
+    context['conversation_history'].append({'role': 'user', 'content': 'hi'})
+    context['urgency_level'] = Urgency.ROUTINE
+    context['symptoms'] = {'care_level': CareLevel.PHARMACY}
+    decoded = decode(encode(context))
+    assert type(decoded) is NurseAllyContext
+    assert decoded == context
+
+
+def test_unknown_enum_values_are_kept_as_strings():
+    state = Conversation(messages=[], urgency_level='unheard of')
+    assert decode(encode(state))['urgency_level'] == 'unheard of'
+
+
+def test_unread_messages_are_written_back_unchanged():
+    data = encode(conversation())
+    decoded = decode(data)
+    decoded['location_data'] = {'detected': True}
+    again = encode(decoded)
+    assert again[-40:] == data[-40:]
+    assert decode(again)['messages'] == conversation()['messages']
+
+
+def test_legacy_json_is_read():
+    legacy = dict(conversation().to_dict(), urgency_level='urgent')
+    decoded = decode(json.dumps(legacy))
+    assert type(decoded) is Conversation
+    assert decoded['urgency_level'] == 'urgent'
+    assert decoded['messages'] == legacy['messages']
+    assert type(decode(json.dumps({'conversation_history': []}))) is NurseAllyContext
+
+
+def test_changes_append_only_new_messages():
+    header, chunks, replace = encode_changes(conversation())
+    assert replace and len(chunks) == 1
+    stored = decode(header, chunks)
+    assert stored == conversation()
+
+    stored['messages'].append({'role': 'user', 'content': 'new'})
+    header, added, replace = encode_changes(stored)
+    assert not replace and len(added) == 1
+    log = chunks + added
+    reloaded = decode(header, log)
+    assert reloaded['messages'] == conversation()['messages'] + [{'role': 'user', 'content': 'new'}]
+
+    # Unread messages add nothing
+    reloaded = decode(header, log)
+    reloaded['version'] = 5
+    header, added, replace = encode_changes(reloaded)
+    assert added == [] and not replace
+    assert decode(header, log)['version'] == 5
+
+
+def test_log_is_compacted_at_max_chunks():
+    header, log, _ = encode_changes(Conversation.new(), max_chunks=3)
+    for i in range(2):
+        state = decode(header, log)
+        state['messages'].append({'role': 'user', 'content': str(i)})
+        header, added, replace = encode_changes(state, max_chunks=3)
+        assert not replace
+        log = log + added
+    assert len(log) == 3
+
+    state = decode(header, log)
+    state['messages'].append({'role': 'user', 'content': '2'})
+    header, chunks, replace = encode_changes(state, max_chunks=3)
+    assert replace and len(chunks) == 1
+    assert [m['content'] for m in decode(header, chunks)['messages']] == ['0', '1', '2']
+
+
+def test_shortened_or_replaced_history_is_rewritten():
+    header, log, _ = encode_changes(conversation())
+    state = decode(header, log)
+    state['messages'] = state['messages'][-1:]
+    header, chunks, replace = encode_changes(state)
+    assert replace
+    assert decode(header, chunks)['messages'] == [{'role': 'assistant', 'content': 'answer 1'}]
+
+
+def test_concurrent_save_rewrites_the_log():
+    header, log, _ = encode_changes(conversation())
+    state = decode(header, log)
+    state['messages'].append({'role': 'user', 'content': 'new'})
+    _, chunks, replace = encode_changes(state, append=False)
+    assert replace and len(chunks) == 1
+
+
+def test_legacy_envelope_is_rewritten_as_a_log():
+    state = decode(encode(conversation()))
+    state['messages'].append({'role': 'user', 'content': 'new'})
+    header, chunks, replace = encode_changes(state)
+    assert replace
+    assert len(decode(header, chunks)['messages']) == 5
+
+
+def test_snapshot_is_independent():
+    state = decode(encode(conversation()))
+    base = snapshot(state)
+    state['messages'].append({'role': 'user', 'content': 'new'})
+    state['symptom_data']['days'] = 4
+    assert len(base['messages']) == 4
+    assert base['symptom_data']['days'] == 3
+    assert copy.deepcopy(state) == state
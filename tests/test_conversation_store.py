@@ -0,0 +1,131 @@
+import json
+import sqlite3
+
+import pytest
+
+from conversation_state import Conversation, snapshot
+from conversation_store import MemoryStore, RedisStore, SQLiteStore, VersionConflict
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryStore()
+    return SQLiteStore(str(tmp_path / 'conversations.db'))
+
+
+def add_turn(store, session_id, content):
+    conversation = store.get(session_id)
+    base = snapshot(conversation)
+    conversation['messages'].append({'role': 'user', 'content': content})
+    return store.save(session_id, conversation, base=base)
+
+
+def contents(conversation):
+    return [message['content'] for message in conversation['messages']]
+
+
+def test_turns_are_appended(store):
+    store.save('s', Conversation.new())
+    for i in range(3):
+        add_turn(store, 's', str(i))
+    assert contents(store.get('s')) == ['0', '1', '2']
+    assert store.get('s')['version'] == 4
+    assert store.stats['rewrite'] == 1 and store.stats['append'] == 3
+
+
+def test_header_only_write(store):
+    store.save('s', Conversation.new())
+    add_turn(store, 's', 'hi')
+    conversation = store.get('s')
+    base = snapshot(conversation)
+    conversation['urgency_level'] = 'urgent'
+    store.save('s', conversation, base=base)
+    assert store.stats['header'] == 1
+    assert store.get('s')['urgency_level'] == 'urgent'
+    assert contents(store.get('s')) == ['hi']
+
+
+def test_log_is_compacted(store):
+    store.compact_chunks = 3
+    store.save('s', Conversation.new())
+    for i in range(5):
+        add_turn(store, 's', str(i))
+    assert contents(store.get('s')) == ['0', '1', '2', '3', '4']
+    # The first save, then a compaction every third turn
+    assert store.stats['rewrite'] == 2 and store.stats['append'] == 4
+
+
+def test_concurrent_appends_are_merged(store):
+    store.save('s', Conversation.new())
+    add_turn(store, 's', 'hi')
+    ours, theirs = store.get('s'), store.get('s')
+    base = snapshot(ours)
+    their_base = snapshot(theirs)
+    theirs['messages'].append({'role': 'user', 'content': 'theirs'})
+    store.save('s', theirs, base=their_base)
+    ours['messages'].append({'role': 'user', 'content': 'ours'})
+    store.save('s', ours, base=base)
+    assert contents(store.get('s')) == ['hi', 'theirs', 'ours']
+    # The merged history replaced the log
+    add_turn(store, 's', 'next')
+    assert contents(store.get('s')) == ['hi', 'theirs', 'ours', 'next']
+
+
+def test_stale_version_is_refused(store):
+    store.save('s', Conversation.new())
+    stale = store.get('s')
+    add_turn(store, 's', 'hi')
+    with pytest.raises(VersionConflict):
+        store.set('s', stale, expected_version=stale['version'])
+
+
+def test_delete_drops_the_log(store):
+    store.save('s', Conversation.new())
+    add_turn(store, 's', 'hi')
+    store.delete('s')
+    assert store.get('s') is None
+    store.save('s', Conversation.new())
+    assert store.get('s')['messages'] == []
+
+
+def test_sqlite_reads_rows_stored_as_json(tmp_path):
+    path = str(tmp_path / 'conversations.db')
+    store = SQLiteStore(path)
+    legacy = dict(Conversation.new().to_dict(), messages=[{'role': 'user', 'content': 'old'}], urgency_level='urgent')
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO conversations (session_id, data, expires_at, version) VALUES (?, ?, ?, ?)",
+                 ('s', json.dumps(legacy), 2e9, 3))
+    conn.commit()
+    conn.close()
+    conversation = store.get('s')
+    assert conversation['version'] == 3 and contents(conversation) == ['old']
+    add_turn(store, 's', 'new')
+    assert contents(store.get('s')) == ['old', 'new']
+    rows = sqlite3.connect(path).execute("SELECT COUNT(*) FROM conversation_log WHERE session_id = 's'").fetchone()
+    assert rows == (1,)
+
+
+class DictClient:
+    """A stand-in for redis-py without pipelines"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+def test_redis_stand_in_stores_whole_conversations():
+    store = RedisStore(DictClient())
+    store.save('s', Conversation.new())
+    add_turn(store, 's', 'hi')
+    add_turn(store, 's', 'again')
+    assert contents(store.get('s')) == ['hi', 'again']
+    assert store.get('s')['version'] == 3
@@ -0,0 +1,65 @@
+import gc
+import weakref
+
+import pytest
+
+from emergency import EmergencyDetector, default_detector
+
+
+@pytest.fixture(scope='module')
+def detector():
+    return default_detector()
+
+
+@pytest.mark.parametrize('message', [
+    "My chest pain started an hour ago",
+    "he is not breathing",
+    "She isn't breathing!",
+    "sudden severe headache",
+    # A word playing a sign down doesn't cancel a red flag elsewhere in the message
+    "my kid has a minor cut and is unconscious",
+    "slight cough, also chest pain",
+    "I have a mild headache and chest pain",
+    "mild chest pain",
+    # Nor does a negation that doesn't deny the sign itself
+    "I never had chest pain like this before",
+    "I didn't expect this chest pain",
+    "not sure whether chest pain is serious",
+    "no fever but I’m bleeding a lot",
+    "denies chest pain, but collapsed",
+])
+def test_emergencies(detector, message):
+    assert detector.assess(message).is_emergency
+
+
+@pytest.mark.parametrize('message', [
+    "no chest pain",
+    "I'm not bleeding anymore",
+    "doesn't have any chest pain",
+    "no longer bleeding",
+    "I have a slight headache",
+    "mild sudden severe headache",
+    "I need a refill of my allergy medication",
+])
+def test_not_emergencies(detector, message):
+    assert not detector.assess(message).is_emergency
+
+
+def test_signals_are_reported(detector):
+    assessment = detector.assess("Sudden severe headache and chest pain")
+    assert assessment.signals == ('sudden', 'severe', 'headache', 'chest pain')
+    assert assessment.score == 6
+
+
+def test_response_uses_the_countrys_number(detector):
+    assert detector.response_for('U.K.').startswith("This may be a medical emergency. Call 999 (112 also works)")
+    assert detector.response_for('Atlantis') == detector.response_for(None)
+
+
+def test_cache_doesnt_keep_the_detector_alive():
+    detector = EmergencyDetector({})
+    detector.assess("chest pain")
+    ref = weakref.ref(detector)
+    del detector
+    gc.collect()
+    assert ref() is None
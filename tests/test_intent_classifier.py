@@ -0,0 +1,28 @@
+import gc
+import weakref
+
+from intent_classifier import IntentClassifier, default_classifier
+from keywords import SCAN_CACHE_MAX_LENGTH
+
+
+def test_classifies_the_agents_intents():
+    classifier = default_classifier()
+    assert classifier.classify("I have a bad cough and fever").label == 'symptom_assessment'
+    assert classifier.classify("Does my  insurance cover this?").label == 'insurance_verification'
+
+
+def test_only_short_messages_are_cached():
+    classifier = IntentClassifier.train([('a', 'apple pie'), ('b', 'banana bread')], epochs=2)
+    classifier.classify("apple pie")
+    classifier.classify("apple  pie")
+    classifier.classify("apple " * SCAN_CACHE_MAX_LENGTH)
+    assert classifier._cached_classify.cache_info().currsize == 1
+
+
+def test_cache_doesnt_keep_the_classifier_alive():
+    classifier = IntentClassifier.train([('a', 'apple pie'), ('b', 'banana bread')], epochs=2)
+    classifier.classify("apple pie")
+    ref = weakref.ref(classifier)
+    del classifier
+    gc.collect()
+    assert ref() is None
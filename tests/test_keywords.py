@@ -0,0 +1,31 @@
+import gc
+import weakref
+
+from keywords import SCAN_CACHE_MAX_LENGTH, KeywordMatcher, detect_urgency, scan_message
+
+
+def test_scan_finds_every_category():
+    hits = scan_message("Severe   CHEST pain, is my Aetna plan OK near me?")
+    assert hits['triage_severe'] == ('chest pain',)
+    assert hits['symptom'] == ('pain',)
+    assert hits['insurance'] == ('aetna', 'plan')
+    assert hits['location'] == ('near me',)
+    assert 'facility' not in scan_message("I drink water when I have a fever")
+
+
+def test_long_texts_are_not_cached():
+    matcher = KeywordMatcher({'urgent': ['urgent']})
+    reply = "This is urgent. " + "x" * SCAN_CACHE_MAX_LENGTH
+    assert matcher.scan(reply) == {'urgent': ('urgent',)}
+    assert matcher.scan("Urgent  care") == matcher.scan("urgent care")
+    assert matcher._cached_scan.cache_info().currsize == 1
+    assert detect_urgency(reply) == 'urgent'
+
+
+def test_cache_doesnt_keep_the_matcher_alive():
+    matcher = KeywordMatcher({'a': ['a']})
+    matcher.scan("a")
+    ref = weakref.ref(matcher)
+    del matcher
+    gc.collect()
+    assert ref() is None
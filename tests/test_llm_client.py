@@ -0,0 +1,63 @@
+import asyncio
+
+import openai
+import pytest
+from openai.openai_object import OpenAIObject
+
+from circuit_breaker import CLOSED, OPEN, CircuitBreaker
+from llm_client import LLMClient
+
+
+def chunk(content):
+    return OpenAIObject.construct_from({'choices': [{'delta': {'content': content}}]})
+
+
+def cut_off_stream():
+    yield chunk('Go to ')
+    raise openai.error.APIConnectionError("connection reset mid-stream")
+
+
+async def acut_off_stream():
+    yield chunk('Go to ')
+    raise openai.error.Timeout("no chunk in time")
+
+
+def client_with_breaker():
+    # One failed call in the window opens the circuit
+    breaker = CircuitBreaker(min_calls=1, failure_rate=0.5, open_seconds=60)
+    return LLMClient(max_retries=0, breaker=breaker), breaker
+
+
+def test_stream_failure_midway_is_recorded(monkeypatch):
+    client, breaker = client_with_breaker()
+    monkeypatch.setattr(openai.ChatCompletion, 'create', lambda **kwargs: cut_off_stream())
+    with pytest.raises(openai.error.APIConnectionError):
+        list(client.stream([{'role': 'user', 'content': 'hi'}]))
+    assert breaker.state == OPEN
+
+
+def test_stream_success_is_recorded_when_it_ends(monkeypatch):
+    client, breaker = client_with_breaker()
+    monkeypatch.setattr(openai.ChatCompletion, 'create', lambda **kwargs: iter([chunk('Go '), chunk('now')]))
+    stream = client.stream([{'role': 'user', 'content': 'hi'}])
+    assert next(stream) == 'Go '
+    assert not breaker._calls
+    assert list(stream) == ['now']
+    assert breaker.state == CLOSED and len(breaker._calls) == 1
+
+
+def test_astream_failure_midway_is_recorded(monkeypatch):
+    client, breaker = client_with_breaker()
+
+    async def acreate(**kwargs):
+        return acut_off_stream()
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+
+    async def read():
+        try:
+            return [token async for token in client.astream([{'role': 'user', 'content': 'hi'}])]
+        finally:
+            await client.aclose()
+    with pytest.raises(openai.error.Timeout):
+        asyncio.run(read())
+    assert breaker.state == OPEN
@@ -0,0 +1,87 @@
+from conversation_state import Conversation, snapshot
+from conversation_store import MemoryStore, merge_changes
+
+
+def message(content, role='user'):
+    return {'role': role, 'content': content}
+
+
+def stored_conversation(store, session_id='s'):
+    conversation = Conversation.new()
+    conversation['messages'].append(message('I have a fever'))
+    conversation['symptom_data'] = {'fever': True}
+    conversation['location_data'] = {'latitude': 48.85, 'longitude': 2.35, 'detected': True}
+    store.save(session_id, conversation)
+    return store.get(session_id)
+
+
+def test_keys_changed_on_each_side_are_kept():
+    base = {'urgency_level': None, 'location_data': {}, 'version': 1}
+    ours = dict(base, urgency_level='urgent')
+    theirs = dict(base, location_data={'detected': True}, version=2)
+    assert merge_changes(base, ours, theirs) == {'urgency_level': 'urgent', 'location_data': {'detected': True},
+                                                 'version': 2}
+
+
+def test_concurrent_appends_keep_both_theirs_first():
+    base = {'messages': [message('hi')]}
+    ours = {'messages': [message('hi'), message('ours')]}
+    theirs = {'messages': [message('hi'), message('theirs')]}
+    assert merge_changes(base, ours, theirs)['messages'] == [message('hi'), message('theirs'), message('ours')]
+
+
+def test_keys_missing_from_theirs_are_deleted_not_none():
+    base = {'messages': [message('hi')], 'symptom_data': {'fever': True}, 'location_data': {}, 'version': 3}
+    ours = dict(base, messages=[message('hi'), message('more')])
+    merged = merge_changes(base, ours, {})
+    assert merged == {'messages': [message('more')]}
+    assert None not in merged.values()
+
+
+def test_key_we_changed_survives_its_deletion():
+    base = {'urgency_level': None, 'symptom_data': {'fever': True}}
+    ours = {'urgency_level': 'urgent', 'symptom_data': {'fever': True, 'cough': True}}
+    assert merge_changes(base, ours, {}) == {'urgency_level': 'urgent', 'symptom_data': {'cough': True}}
+
+
+def test_save_merges_a_concurrent_save():
+    store = MemoryStore()
+    turn = stored_conversation(store)
+    base = snapshot(turn)
+    # A location update lands while the turn runs
+    location = store.get('s')
+    location['location_data'] = {'latitude': 52.52, 'longitude': 13.40, 'detected': True}
+    store.save('s', location, snapshot(location))
+
+    turn['messages'].append(message('That sounds urgent', role='assistant'))
+    store.save('s', turn, base)
+    stored = store.get('s')
+    assert [m['content'] for m in stored['messages']] == ['I have a fever', 'That sounds urgent']
+    assert stored['location_data']['latitude'] == 52.52
+
+
+def test_reset_during_a_turn_keeps_only_the_turn_on_a_new_conversation():
+    store = MemoryStore()
+    turn = stored_conversation(store)
+    base = snapshot(turn)
+    # /api/reset while the turn runs
+    store.delete('s')
+
+    turn['messages'].append(message('Where should I go?'))
+    turn['urgency_level'] = 'urgent'
+    store.save('s', turn, base)
+    stored = store.get('s')
+    assert stored['messages'] == [message('Where should I go?')]
+    assert stored['urgency_level'] == 'urgent'
+    # Everything the turn didn't change is as in a new conversation, not None
+    fresh = Conversation.new()
+    for key in ('symptom_data', 'insurance_data', 'location_data', 'current_agent'):
+        assert stored[key] == fresh[key]
+    assert stored['location_data'].get('detected') is None
+    assert stored['version'] == 1
+
+    # The rest of the turn saves on top of it as usual
+    base = snapshot(stored)
+    stored['messages'].append(message('The nearest clinic is open', role='assistant'))
+    store.save('s', stored, base)
+    assert len(store.get('s')['messages']) == 2
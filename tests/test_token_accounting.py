@@ -0,0 +1,25 @@
+from history_manager import FACTS_HEADER, SUMMARY_HEADER
+from token_accounting import _count_system_prompt, prompt_sections
+
+
+def test_prompt_sections():
+    messages = [
+        {'role': 'system', 'content': "You are a symptom assessment agent."},
+        {'role': 'system', 'content': FACTS_HEADER + "\nSymptoms: fever"},
+        {'role': 'system', 'content': SUMMARY_HEADER + "\nThe user has a fever."},
+        {'role': 'user', 'content': "I have a fever"},
+        {'role': 'assistant', 'content': "How long have you had it?"},
+        {'role': 'user', 'content': "Three days"},
+        {'role': 'system', 'content': "Answer only the symptom part."},
+    ]
+    sections = prompt_sections(messages)
+    assert set(sections) == {'system_prompt', 'facts', 'summary', 'history', 'user_message', 'instructions'}
+    assert all(tokens > 0 for tokens in sections.values())
+
+
+def test_only_system_prompts_are_cached():
+    _count_system_prompt.cache_clear()
+    prompt_sections([{'role': 'system', 'content': "You are an insurance agent."},
+                     {'role': 'user', 'content': "My Aetna policy number is 12345"},
+                     {'role': 'assistant', 'content': "Thanks, let me check your coverage."}])
+    assert _count_system_prompt.cache_info().currsize == 1
@@ -0,0 +1,150 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from turn_coordinator import AsyncTurnCoordinator, TurnCoordinator
+
+
+def run_turn(coordinator, session_id, message, key, reply, results, started=None, release=None):
+    with coordinator.turn(session_id, message, key) as turn:
+        if turn.result is None:
+            if started is not None:
+                started.set()
+            if release is not None:
+                release.wait(5)
+            turn.result = {'response': reply}
+    results.append((key, turn.result, turn.coalesced))
+
+
+def test_duplicate_in_flight_is_coalesced():
+    coordinator = TurnCoordinator()
+    started, release, results = threading.Event(), threading.Event(), []
+    leader = threading.Thread(target=run_turn, args=(coordinator, 's', 'I have a fever', 'a', 'first', results,
+                                                     started, release))
+    leader.start()
+    assert started.wait(5)
+    follower = threading.Thread(target=run_turn, args=(coordinator, 's', ' I have  a fever', 'b', 'second', results))
+    follower.start()
+    while coordinator.stats['coalesced'] == 0:
+        time.sleep(0.001)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert sorted(results) == [('a', {'response': 'first'}, False), ('b', {'response': 'first'}, True)]
+    assert coordinator.stats == {'turns': 1, 'coalesced': 1, 'replayed': 0}
+
+
+def test_turns_of_a_session_run_one_at_a_time():
+    coordinator = TurnCoordinator()
+    started, release, results = threading.Event(), threading.Event(), []
+    first = threading.Thread(target=run_turn, args=(coordinator, 's', 'one', 'a', 'one', results, started, release))
+    first.start()
+    assert started.wait(5)
+    second_started = threading.Event()
+    second = threading.Thread(target=run_turn, args=(coordinator, 's', 'two', 'b', 'two', results, second_started))
+    second.start()
+    assert not second_started.wait(0.05)
+    # Another session isn't held up
+    run_turn(coordinator, 'other', 'one', 'c', 'other', results)
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert [key for key, _, _ in results] == ['c', 'a', 'b']
+    assert coordinator._sessions == {}
+
+
+def test_retry_with_same_key_is_replayed():
+    coordinator = TurnCoordinator()
+    results = []
+    run_turn(coordinator, 's', 'hello', 'a', 'first', results)
+    with coordinator.turn('s', 'hello again', 'a') as turn:
+        assert turn.replayed and turn.result == {'response': 'first'}
+    # The key belongs to its session
+    with coordinator.turn('other', 'hello', 'a') as turn:
+        assert turn.result is None
+        turn.result = {'response': 'other'}
+    assert coordinator.stats['replayed'] == 1
+
+
+def test_expired_replay_starts_a_new_turn():
+    coordinator = TurnCoordinator(replay_ttl=0)
+    run_turn(coordinator, 's', 'hello', 'a', 'first', [])
+    with coordinator.turn('s', 'hello', 'a') as turn:
+        assert turn.result is None
+        turn.result = {'response': 'second'}
+
+
+def test_followers_get_the_leaders_error():
+    coordinator = TurnCoordinator()
+    started, release, errors = threading.Event(), threading.Event(), []
+
+    def fail():
+        with pytest.raises(ValueError):
+            with coordinator.turn('s', 'hi', 'a') as turn:
+                started.set()
+                release.wait(5)
+                raise ValueError("upstream")
+
+    def follow():
+        try:
+            with coordinator.turn('s', 'hi', 'b'):
+                pass
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=fail)
+    leader.start()
+    assert started.wait(5)
+    follower = threading.Thread(target=follow)
+    follower.start()
+    while coordinator.stats['coalesced'] == 0:
+        time.sleep(0.001)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert len(errors) == 1
+    # Nothing was remembered, so a retry runs the turn again
+    with coordinator.turn('s', 'hi', 'a') as turn:
+        assert turn.result is None
+        turn.result = {'response': 'ok'}
+
+
+def test_async_coalescing_and_ordering():
+    coordinator = AsyncTurnCoordinator()
+    order = []
+
+    async def run(message, key, delay):
+        async with coordinator.turn('s', message, key) as turn:
+            if turn.result is None:
+                order.append(('start', key))
+                await asyncio.sleep(delay)
+                order.append(('end', key))
+                turn.result = {'response': key}
+            return turn.result, turn.coalesced
+
+    async def main():
+        return await asyncio.gather(run('one', 'a', 0.02), run('one', 'b', 0), run('two', 'c', 0))
+
+    first, duplicate, second = asyncio.run(main())
+    assert first == ({'response': 'a'}, False)
+    assert duplicate == ({'response': 'a'}, True)
+    assert second == ({'response': 'c'}, False)
+    assert order == [('start', 'a'), ('end', 'a'), ('start', 'c'), ('end', 'c')]
+    assert coordinator._sessions == {} and coordinator._flights == {}
+
+
+def test_async_replay():
+    coordinator = AsyncTurnCoordinator()
+
+    async def main():
+        async with coordinator.turn('s', 'hi', 'a') as turn:
+            turn.result = {'response': 'first'}
+        async with coordinator.turn('s', 'hi', 'a') as turn:
+            return turn.result, turn.replayed
+
+    assert asyncio.run(main()) == ({'response': 'first'}, True)
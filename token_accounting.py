@@ -0,0 +1,279 @@
+"""Token accounting per session, agent and prompt section
+
+Counts the tokens of every model call with a local tokenizer and attributes the
+prompt's tokens to the sections HistoryManager builds it from: the agent's system
+prompt, the facts block, the rolling summary, the recent history, the user's new
+message and any extra instructions appended after them. The totals are kept per
+session (in memory, for the most recently active sessions) so the heaviest
+sessions and sections can be reported.
+
+Run it to print the report of a running app:
+
+    python token_accounting.py [--url http://127.0.0.1:5000] [--limit 10]
+"""
+import os
+import re
+import time
+import hashlib
+import argparse
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence
+
+import metrics
+from history_manager import FACTS_HEADER, MESSAGE_OVERHEAD_TOKENS, SUMMARY_HEADER
+
+# Sessions whose usage is kept; the least recently active are forgotten beyond this
+DEFAULT_MAX_SESSIONS = int(os.getenv("TOKEN_ACCOUNTING_SESSIONS", "5000"))
+
+SECTIONS = ('system_prompt', 'facts', 'summary', 'history', 'user_message', 'instructions')
+
+# Pieces the GPT tokenizers split text into before merging: contractions, words
+# with their leading space, digit groups of up to three, punctuation runs and
+# whitespace. A piece is one token unless it is long.
+_PIECES = re.compile(r"'(?:s|t|re|ve|m|ll|d)|[ ]?[^\W\d_]+|\d{1,3}|[ ]?[^\s\w]+|_+|\s+", re.IGNORECASE)
+
+# The session the model calls of the current request are charged to
+current_session: contextvars.ContextVar = contextvars.ContextVar('token_accounting_session', default=None)
+
+PROMPT_TOKENS = metrics.counter('nurse_ally_prompt_tokens_total', "Prompt tokens sent to the model, by agent and "
+                                "prompt section, as counted by the local tokenizer", ['agent', 'section'])
+
+
+def _load_tiktoken():
+    # tiktoken gives exact counts when it is installed and its encoding is cached
+    # locally; otherwise the approximation below is used
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(os.getenv("TOKENIZER_ENCODING", "o200k_base"))
+    except Exception:
+        return None
+
+
+_encoding = _load_tiktoken() if os.getenv("TOKENIZER", "auto") != "approximate" else None
+
+
+def count_tokens(text: str) -> int:
+    """Tokens in the text"""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    tokens = 0
+    for piece in _PIECES.findall(text):
+        if piece.isspace():
+            tokens += 1 if len(piece) < 8 else len(piece) // 8 + 1
+        elif piece.lstrip()[:1].isalpha():
+            # Common words are one token; longer or rarer ones split every few letters
+            tokens += 1 + max(0, len(piece.lstrip()) - 7) // 4
+        else:
+            tokens += (len(piece) + 1) // 2
+    return tokens
+
+
+# The agents' system prompts repeat on every call, so their counts are cached. The
+# other sections hold users' messages and the replies to them, which are counted
+# every time rather than kept in memory
+_count_system_prompt = lru_cache(maxsize=64)(count_tokens)
+
+
+def message_tokens(message: Dict[str, str]) -> int:
+    return count_tokens(message.get('content') or '') + MESSAGE_OVERHEAD_TOKENS
+
+
+def prompt_sections(messages: Sequence[Dict[str, str]]) -> Dict[str, int]:
+    """Tokens of a prompt by section
+
+    The first system message is the agent's system prompt and the facts and
+    summary blocks are recognised by their headers. Other system messages are
+    instructions appended to the prompt (the fan-out focus, say). The last user
+    message is the user's new message and the turns before it are history.
+    """
+    sections = dict.fromkeys(SECTIONS, 0)
+    last_user = max((i for i, message in enumerate(messages) if message.get('role') == 'user'), default=None)
+    for i, message in enumerate(messages):
+        content = message.get('content') or ''
+        if message.get('role') == 'system':
+            if i == 0:
+                section = 'system_prompt'
+            elif content.startswith(FACTS_HEADER):
+                section = 'facts'
+            elif content.startswith(SUMMARY_HEADER):
+                section = 'summary'
+            else:
+                section = 'instructions'
+        else:
+            section = 'user_message' if i == last_user else 'history'
+        if section == 'system_prompt':
+            sections[section] += _count_system_prompt(content) + MESSAGE_OVERHEAD_TOKENS
+        else:
+            sections[section] += message_tokens(message)
+    return {section: tokens for section, tokens in sections.items() if tokens}
+
+
+@contextmanager
+def session_scope(session_id: Optional[str]):
+    """Charge the tokens of the model calls made inside the block to a session"""
+    token = current_session.set(session_id)
+    try:
+        yield
+    finally:
+        current_session.reset(token)
+
+
+def session_key(session_id: str) -> str:
+    """A short, stable name for a session in reports, which never show session ids"""
+    return hashlib.sha256(session_id.encode('utf-8')).hexdigest()[:12]
+
+
+def _new_usage():
+    return {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'largest_prompt': 0, 'sections': {}}
+
+
+def _add(usage, prompt_tokens, completion_tokens, sections):
+    usage['calls'] += 1
+    usage['prompt_tokens'] += prompt_tokens
+    usage['completion_tokens'] += completion_tokens
+    usage['largest_prompt'] = max(usage['largest_prompt'], prompt_tokens)
+    for section, tokens in sections.items():
+        usage['sections'][section] = usage['sections'].get(section, 0) + tokens
+
+
+class TokenLedger:
+    """Prompt and completion tokens per session, broken down by agent and prompt section
+
+    Usage of model calls made outside a session (summaries written in the
+    background, say) only counts towards the process totals.
+    """
+
+    def __init__(self, max_sessions: int = DEFAULT_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict = OrderedDict()
+        self._agents: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, agent: Optional[str], messages: List[Dict[str, str]], completion_tokens: int,
+               prompt_tokens: Optional[int] = None) -> Dict[str, int]:
+        """Account for a model call; `prompt_tokens` is the upstream's count when it
+        reported one. Returns the prompt's tokens by section."""
+        agent = agent or 'none'
+        sections = prompt_sections(messages)
+        if prompt_tokens is None:
+            prompt_tokens = sum(sections.values())
+        for section, tokens in sections.items():
+            PROMPT_TOKENS.inc(tokens, agent=agent, section=section)
+
+        session_id = current_session.get()
+        with self._lock:
+            _add(self._agents.setdefault(agent, _new_usage()), prompt_tokens, completion_tokens, sections)
+            if session_id is not None:
+                session = self._sessions.get(session_id)
+                if session is None:
+                    session = self._sessions[session_id] = {'agents': {}, 'started_at': time.time()}
+                else:
+                    self._sessions.move_to_end(session_id)
+                session['updated_at'] = time.time()
+                _add(session['agents'].setdefault(agent, _new_usage()), prompt_tokens, completion_tokens, sections)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+        return sections
+
+    def session_usage(self, session_id: str) -> Dict[str, Any]:
+        """A session's usage per agent, with its totals; all zero before its first model call"""
+        with self._lock:
+            session = self._sessions.get(session_id) or {'agents': {}, 'started_at': None, 'updated_at': None}
+            agents = {agent: _copy(usage) for agent, usage in session['agents'].items()}
+            started_at, updated_at = session['started_at'], session['updated_at']
+        return dict(_total(agents.values()), agents=agents, started_at=started_at, updated_at=updated_at)
+
+    def report(self, limit: int = 10) -> Dict[str, Any]:
+        """The heaviest sessions, and the process's tokens per agent and section"""
+        with self._lock:
+            sessions = [(session_id, _total(session['agents'].values()), session['updated_at'])
+                        for session_id, session in self._sessions.items()]
+            agents = {agent: _copy(usage) for agent, usage in self._agents.items()}
+        sessions.sort(key=lambda item: item[1]['prompt_tokens'] + item[1]['completion_tokens'], reverse=True)
+        for usage in agents.values():
+            usage['mean_prompt'] = round(usage['prompt_tokens'] / usage['calls'], 1) if usage['calls'] else 0
+        totals = _total(agents.values())
+        return {
+            'sessions': [dict(usage, session=session_key(session_id), updated_at=updated_at)
+                         for session_id, usage, updated_at in sessions[:limit]],
+            'sessions_tracked': len(sessions),
+            'agents': agents,
+            'sections': dict(sorted(totals['sections'].items(), key=lambda item: -item[1])),
+            'totals': {key: value for key, value in totals.items() if key != 'sections'},
+        }
+
+
+def _copy(usage):
+    return dict(usage, sections=dict(usage['sections']))
+
+
+def _total(usages):
+    total = _new_usage()
+    for usage in usages:
+        total['calls'] += usage['calls']
+        total['prompt_tokens'] += usage['prompt_tokens']
+        total['completion_tokens'] += usage['completion_tokens']
+        total['largest_prompt'] = max(total['largest_prompt'], usage['largest_prompt'])
+        for section, tokens in usage['sections'].items():
+            total['sections'][section] = total['sections'].get(section, 0) + tokens
+    return total
+
+
+def create_token_ledger() -> Optional[TokenLedger]:
+    """The token ledger configured by the environment; TOKEN_ACCOUNTING=off disables it"""
+    if os.getenv("TOKEN_ACCOUNTING", "on") == "off":
+        return None
+    return TokenLedger()
+
+
+def print_report(report: Dict[str, Any]):
+    totals = report['totals']
+    print(f"{totals['calls']} model calls: {totals['prompt_tokens']} prompt and "
+          f"{totals['completion_tokens']} completion tokens, largest prompt {totals['largest_prompt']}\n")
+
+    # Shares are of the locally counted tokens, which the sections add up to
+    counted = max(sum(report['sections'].values()), 1)
+    print(f"{'section':<16}{'tokens':>10}{'share':>8}")
+    for section, tokens in report['sections'].items():
+        print(f"{section:<16}{tokens:>10}{tokens / counted:>8.0%}")
+
+    print(f"\n{'agent':<26}{'calls':>7}{'mean prompt':>13}{'largest':>9}{'completion':>12}  heaviest sections")
+    for agent, usage in sorted(report['agents'].items(), key=lambda item: -item[1]['prompt_tokens']):
+        heaviest = sorted(usage['sections'].items(), key=lambda item: -item[1])[:3]
+        counted = max(sum(usage['sections'].values()), 1)
+        shares = ', '.join(f"{section} {tokens / counted:.0%}" for section, tokens in heaviest)
+        print(f"{agent:<26}{usage['calls']:>7}{usage['mean_prompt']:>13}{usage['largest_prompt']:>9}"
+              f"{usage['completion_tokens']:>12}  {shares}")
+
+    print(f"\nheaviest of {report['sessions_tracked']} sessions")
+    print(f"{'session':<14}{'calls':>7}{'prompt':>9}{'completion':>12}{'largest':>9}  heaviest section")
+    for usage in report['sessions']:
+        section = max(usage['sections'].items(), key=lambda item: item[1], default=('-', 0))[0]
+        print(f"{usage['session']:<14}{usage['calls']:>7}{usage['prompt_tokens']:>9}{usage['completion_tokens']:>12}"
+              f"{usage['largest_prompt']:>9}  {section}")
+
+
+def main():
+    import requests
+
+    parser = argparse.ArgumentParser(description="Report the heaviest sessions and prompt sections of a running app")
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--limit', type=int, default=10, help='sessions to list')
+    parser.add_argument('--token', default=os.getenv("OPERATOR_TOKEN", ""),
+                        help="the app's OPERATOR_TOKEN (default: the environment's)")
+    args = parser.parse_args()
+
+    response = requests.get(f"{args.url.rstrip('/')}/api/token_usage/report", params={'limit': args.limit},
+                            headers={'Authorization': f"Bearer {args.token}"}, timeout=10)
+    response.raise_for_status()
+    print_report(response.json())
+
+
+if __name__ == '__main__':
+    main()
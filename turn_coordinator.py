@@ -0,0 +1,211 @@
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Dict, Optional, Tuple
+
+import metrics
+
+# Results of finished turns are kept this long, so a retry with the same
+# idempotency key gets the original reply instead of starting a new turn
+DEFAULT_REPLAY_TTL = int(os.getenv("TURN_REPLAY_TTL", "600"))
+DEFAULT_MAX_REPLAYS = int(os.getenv("TURN_MAX_REPLAYS", "10000"))
+
+
+def new_idempotency_key() -> str:
+    return uuid.uuid4().hex
+
+
+def _message_digest(message):
+    return hashlib.sha256(' '.join(message.split()).encode('utf-8')).hexdigest()
+
+
+class Turn:
+    """A chat request's place in its session's turns
+
+    `result` is already set on entry when the request was coalesced onto an
+    identical one in flight (`coalesced`) or repeats a finished one (`replayed`).
+    Otherwise the request leads: it runs the turn and sets `result` before leaving
+    the block, and every request waiting on it gets the same result.
+    """
+
+    __slots__ = ('key', 'result', 'coalesced', 'replayed')
+
+    def __init__(self, key: str):
+        self.key = key
+        self.result: Optional[Dict[str, Any]] = None
+        self.coalesced = False
+        self.replayed = False
+
+    @property
+    def shared(self) -> bool:
+        return self.coalesced or self.replayed
+
+
+class _Flight:
+    """A turn being run, which identical requests wait on"""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self, done):
+        self.done = done
+        self.result = None
+        self.error = None
+
+
+class _TurnRegistry:
+    """Bookkeeping shared by the threaded and asyncio coordinators"""
+
+    def __init__(self, replay_ttl: int = DEFAULT_REPLAY_TTL, max_replays: int = DEFAULT_MAX_REPLAYS):
+        self.replay_ttl = replay_ttl
+        self.max_replays = max_replays
+        self._replays: "OrderedDict[Tuple[str, str], tuple]" = OrderedDict()
+        self._flights: Dict[Tuple[str, str], _Flight] = {}
+        self._sessions: Dict[str, list] = {}  # session id -> [lock, requests holding or waiting]
+        self.stats = {'turns': 0, 'coalesced': 0, 'replayed': 0}
+
+    def _replay(self, session_id, key):
+        entry = self._replays.get((session_id, key))
+        if entry is None:
+            return None
+        result, expires_at = entry
+        if expires_at <= time.time():
+            del self._replays[(session_id, key)]
+            return None
+        return result
+
+    def _remember(self, session_id, key, result):
+        self._replays[(session_id, key)] = (result, time.time() + self.replay_ttl)
+        self._replays.move_to_end((session_id, key))
+        while len(self._replays) > self.max_replays:
+            self._replays.popitem(last=False)
+
+    def _join(self, session_id, message, turn, new_event):
+        """Return (flight, leads) for the request, or (None, False) for a replay"""
+        result = self._replay(session_id, turn.key)
+        if result is not None:
+            turn.result, turn.replayed = result, True
+            self.stats['replayed'] += 1
+            return None, False
+        flight_key = (session_id, _message_digest(message))
+        flight = self._flights.get(flight_key)
+        if flight is not None:
+            self.stats['coalesced'] += 1
+            return flight, False
+        flight = self._flights[flight_key] = _Flight(new_event())
+        self.stats['turns'] += 1
+        return flight, True
+
+    def _session_lock(self, session_id, new_lock):
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            entry = self._sessions[session_id] = [new_lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release_session(self, session_id):
+        entry = self._sessions[session_id]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._sessions[session_id]
+
+    def _land(self, session_id, message, turn, flight, error):
+        """Publish the leader's outcome to the requests waiting on it"""
+        self._flights.pop((session_id, _message_digest(message)), None)
+        if turn.result is not None:
+            # Keep the result even if the client went away after it was produced
+            flight.result = turn.result
+            self._remember(session_id, turn.key, turn.result)
+        else:
+            flight.error = error if isinstance(error, Exception) else RuntimeError("The original request was cancelled")
+
+    def _follow(self, session_id, turn, flight):
+        if flight.error is not None:
+            raise flight.error
+        turn.result, turn.coalesced = flight.result, True
+        self._remember(session_id, turn.key, turn.result)
+
+
+def register_metrics(coordinator: _TurnRegistry):
+    """Export the coordinator's turn counts on /metrics"""
+    metrics.callback('nurse_ally_turn_requests_total', "Chat requests by how they were answered: as a new turn, "
+                     "coalesced onto an identical one in flight, or replayed from a finished one",
+                     lambda: {(kind,): n for kind, n in coordinator.stats.items()}, ['kind'], kind='counter')
+
+
+class TurnCoordinator(_TurnRegistry):
+    """Runs the chat turns of each session one at a time and coalesces duplicates
+
+    A request identical to one still in flight for the same session (a double
+    click, or a retry of a turn that hasn't finished) waits for that turn and gets
+    its result instead of calling the model again. Different turns of a session run
+    one after another, so each sees the reply to the one before. Results are kept
+    by idempotency key for `replay_ttl` seconds to answer later retries.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def turn(self, session_id: str, message: str, idempotency_key: str):
+        turn = Turn(idempotency_key)
+        with self._lock:
+            flight, leads = self._join(session_id, message, turn, threading.Event)
+            session_lock = self._session_lock(session_id, threading.Lock) if leads else None
+        if flight is None:
+            yield turn
+            return
+        if not leads:
+            flight.done.wait()
+            with self._lock:
+                self._follow(session_id, turn, flight)
+            yield turn
+            return
+
+        error = None
+        try:
+            with session_lock:
+                yield turn
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            with self._lock:
+                self._release_session(session_id)
+                self._land(session_id, message, turn, flight, error)
+            flight.done.set()
+
+
+class AsyncTurnCoordinator(_TurnRegistry):
+    """TurnCoordinator for the async server; all of its state lives on the event loop"""
+
+    @asynccontextmanager
+    async def turn(self, session_id: str, message: str, idempotency_key: str):
+        turn = Turn(idempotency_key)
+        flight, leads = self._join(session_id, message, turn, asyncio.Event)
+        if flight is None:
+            yield turn
+            return
+        if not leads:
+            await flight.done.wait()
+            self._follow(session_id, turn, flight)
+            yield turn
+            return
+
+        session_lock = self._session_lock(session_id, asyncio.Lock)
+        error = None
+        try:
+            async with session_lock:
+                yield turn
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._release_session(session_id)
+            self._land(session_id, message, turn, flight, error)
+            flight.done.set()
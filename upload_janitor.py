@@ -0,0 +1,210 @@
+"""Retention and disk quotas for the upload store
+
+A background thread in every worker sweeps the store every few minutes:
+references held by conversations that no longer exist are dropped, files no
+session references are deleted once they have gone unused for a while (with
+their extracted text, index and ingestion result), the least recently used of
+them go first while the store is over its quota, and temporary files left by
+interrupted uploads are removed. Uploads are refused while they would take a
+session or the store over its quota.
+"""
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import metrics
+from conversation_store import DEFAULT_TTL as CONVERSATION_TTL
+from upload_store import HashingFile, UploadStore
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Seconds between sweeps
+DEFAULT_INTERVAL = float(os.getenv("UPLOAD_SWEEP_INTERVAL", "300"))
+# Seconds an unreferenced file is kept, so one uploaded again soon is still deduplicated
+DEFAULT_ORPHAN_TTL = float(os.getenv("UPLOAD_ORPHAN_TTL", "3600"))
+# Seconds a reference is kept before its conversation is checked for; at least the
+# conversations' TTL, since with the memory store a worker only sees its own sessions
+DEFAULT_REF_GRACE = float(os.getenv("UPLOAD_REF_GRACE", str(CONVERSATION_TTL)))
+# Bytes of uploads the store may hold, and one session may reference; 0 turns a quota off
+DEFAULT_QUOTA = int(float(os.getenv("UPLOAD_QUOTA_MB", "1024")) * MB)
+DEFAULT_SESSION_QUOTA = int(float(os.getenv("UPLOAD_SESSION_QUOTA_MB", "32")) * MB)
+# Temporary files older than this are left over from uploads that never finished
+TMP_TTL = 3600
+# Unreferenced files used more recently than this are never evicted for the quota,
+# so an upload isn't deleted between being stored and being referenced
+EVICTION_GRACE = 60
+
+
+class QuotaExceeded(Exception):
+    """An upload would take its session (quota='session') or the store (quota='global') over quota"""
+
+    def __init__(self, quota: str, message: str):
+        super().__init__(message)
+        self.quota = quota
+
+
+class UploadJanitor:
+    """Keeps the upload store within its retention and disk quotas
+
+    `is_live(session_id)` says whether a session's conversation still exists; a
+    session's references are dropped once it doesn't.
+    """
+
+    def __init__(self, store: UploadStore, is_live: Callable[[str], bool], interval: float = DEFAULT_INTERVAL,
+                 orphan_ttl: float = DEFAULT_ORPHAN_TTL, ref_grace: float = DEFAULT_REF_GRACE,
+                 quota: int = DEFAULT_QUOTA, session_quota: int = DEFAULT_SESSION_QUOTA):
+        self.store = store
+        self.is_live = is_live
+        self.interval = interval
+        self.orphan_ttl = orphan_ttl
+        self.ref_grace = ref_grace
+        self.quota = quota
+        self.session_quota = session_quota
+        self.last_sweep: Optional[Dict[str, Any]] = None
+        # What this process has deleted, by reason, and the uploads it refused, by quota
+        self.reclaimed = {reason: {'files': 0, 'bytes': 0} for reason in ('expired', 'quota', 'tmp')}
+        self.refused = {'session': 0, 'global': 0}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def admit(self, session_id: str, stream) -> None:
+        """Raise QuotaExceeded if storing the upload would go over a quota
+
+        `stream` is the file the upload was streamed into; content the store
+        already holds takes no more space.
+        """
+        if not isinstance(stream, HashingFile):
+            return
+        if self.session_quota and self.store.session_bytes(session_id) + stream.size > self.session_quota:
+            self._refuse('session')
+            raise QuotaExceeded('session', f"Uploads are limited to {self.session_quota / MB:g} MB per conversation")
+        if self.quota and not self.store.contains(stream.hexdigest()) \
+                and self.store.usage()['bytes'] + stream.size > self.quota:
+            self._refuse('global')
+            raise QuotaExceeded('global', "Upload storage is full, please try again later")
+
+    def _refuse(self, quota):
+        with self._lock:
+            self.refused[quota] += 1
+
+    def _reclaim(self, reason, files, size):
+        with self._lock:
+            self.reclaimed[reason]['files'] += files
+            self.reclaimed[reason]['bytes'] += size
+
+    def sweep(self) -> Dict[str, Any]:
+        """One pass over the store; returns what was released and deleted"""
+        started = time.time()
+        result = {'sessions_released': 0, 'expired': 0, 'evicted': 0, 'tmp': 0, 'bytes': 0}
+
+        # References of conversations that expired or were deleted elsewhere
+        for session_id in self.store.referencing_sessions(before=started - self.ref_grace):
+            if not self.is_live(session_id):
+                self.store.release(session_id)
+                result['sessions_released'] += 1
+
+        # Unreferenced files unused for longer than the TTL, then the least recently
+        # used others while the store is over its quota
+        held = self.store.usage()['bytes']
+        for blob in self.store.unreferenced():
+            if blob['last_used'] < started - self.orphan_ttl:
+                reason = 'expired'
+            elif self.quota and held > self.quota:
+                reason = 'evicted'
+            else:
+                continue
+            # Checked again as it is removed, in case it was uploaded again meanwhile
+            cutoff = started - (self.orphan_ttl if reason == 'expired' else EVICTION_GRACE)
+            removed = self.store.remove(blob['sha256'], unused_since=cutoff)
+            if removed is None:
+                continue
+            held -= blob['size']
+            result[reason] += 1
+            result['bytes'] += removed['bytes']
+            self._reclaim('quota' if reason == 'evicted' else reason, removed['files'], removed['bytes'])
+
+        result['tmp'], tmp_bytes = self._sweep_tmp(started - TMP_TTL)
+        result['bytes'] += tmp_bytes
+        self._reclaim('tmp', result['tmp'], tmp_bytes)
+
+        result.update(started_at=started, seconds=round(time.time() - started, 3))
+        self.last_sweep = result
+        if any(result[key] for key in ('sessions_released', 'expired', 'evicted', 'tmp')):
+            logger.info("Upload janitor reclaimed space", extra=result)
+        return result
+
+    def _sweep_tmp(self, before):
+        files = removed = 0
+        with os.scandir(self.store.tmp_dir) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                    if entry.is_file() and stat.st_mtime < before:
+                        os.unlink(entry.path)
+                        files += 1
+                        removed += stat.st_size
+                except FileNotFoundError:
+                    pass
+        return files, removed
+
+    def stats(self) -> Dict[str, Any]:
+        """Bytes held by the store, and what this process has reclaimed"""
+        with self._lock:
+            reclaimed = {reason: dict(counts) for reason, counts in self.reclaimed.items()}
+            refused = dict(self.refused)
+        return {
+            'store': self.store.usage(),
+            'quota_bytes': self.quota,
+            'session_quota_bytes': self.session_quota,
+            'reclaimed': reclaimed,
+            'refused': refused,
+            'last_sweep': self.last_sweep,
+        }
+
+    def start(self):
+        """Sweep in a background thread until stopped"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='upload-janitor', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error("Upload janitor sweep failed: %s", e)
+
+
+def create_upload_janitor(store: UploadStore, is_live: Callable[[str], bool]) -> Optional[UploadJanitor]:
+    """The upload janitor configured by the environment, started; UPLOAD_JANITOR=off disables it"""
+    if os.getenv("UPLOAD_JANITOR", "on") == "off":
+        return None
+    janitor = UploadJanitor(store, is_live)
+    register_metrics(janitor)
+    janitor.start()
+    return janitor
+
+
+def register_metrics(janitor: UploadJanitor):
+    """Export the bytes the store holds and what the janitor reclaimed on /metrics"""
+    metrics.callback('nurse_ally_upload_bytes', "Bytes of uploads stored, by whether a session references them",
+                     lambda: _held_bytes(janitor.store), ['state'])
+    metrics.callback('nurse_ally_upload_reclaimed_bytes_total', "Bytes of uploads and their derived files deleted "
+                     "by the janitor, by reason: expired, quota or tmp",
+                     lambda: {(reason,): counts['bytes'] for reason, counts in janitor.reclaimed.items()},
+                     ['reason'], kind='counter')
+    metrics.callback('nurse_ally_upload_refused_total', "Uploads refused by quota: session or global",
+                     lambda: {(quota,): n for quota, n in janitor.refused.items()}, ['quota'], kind='counter')
+
+
+def _held_bytes(store):
+    usage = store.usage()
+    return {('referenced',): usage['referenced_bytes'], ('unreferenced',): usage['bytes'] - usage['referenced_bytes']}
@@ -0,0 +1,252 @@
+import os
+import glob
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+# Uploads are hashed and written in chunks of this size when they are copied
+CHUNK_SIZE = 64 * 1024
+
+
+class HashingFile:
+    """A temporary file in the store that hashes what is written to it
+
+    Handed to the request's form parser as the stream for an uploaded file, so the
+    upload goes to disk chunk by chunk as it arrives and is hashed on the way,
+    instead of being buffered and copied afterwards.
+    """
+
+    def __init__(self, directory: str):
+        self._file = tempfile.NamedTemporaryFile(dir=directory, prefix='upload-', delete=False)
+        self.name = self._file.name
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.stored = False
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def __getattr__(self, name):
+        # read, readline, seek, tell, flush... go to the temporary file
+        return getattr(self._file, name)
+
+    def finish(self):
+        """Close the file once the upload is complete, keeping it on disk"""
+        self._file.close()
+
+    def close(self):
+        # Called when the request ends; an upload that wasn't stored (rejected, or
+        # the request failed) is deleted
+        self._file.close()
+        if not self.stored:
+            self.discard()
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.unlink(self.name)
+        except FileNotFoundError:
+            pass
+
+
+class UploadStore:
+    """Uploaded files stored once per content, under their SHA-256
+
+    Files live at blobs/<2 hex>/<2 hex>/<sha256>.<ext>, so the same policy uploaded
+    by many users is stored once, and anything derived from it and saved next to
+    it (extracted text, retrieval index, ingestion result) is reused. Sessions
+    hold references to the files they uploaded, kept in a SQLite table shared by
+    worker processes. Files no session references are removed by the upload
+    janitor (upload_janitor.py).
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        for directory in (self.blob_dir, self.tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root, 'uploads.db'), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            "digest TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS refs ("
+            "session_id TEXT NOT NULL, digest TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (session_id, digest))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS refs_digest ON refs (digest)")
+
+    def temp_file(self) -> HashingFile:
+        """A new temporary file to stream an upload into"""
+        return HashingFile(self.tmp_dir)
+
+    def path_for(self, digest: str, filename: str) -> str:
+        ext = os.path.splitext(filename)[1].lower()
+        return os.path.join(self.blob_dir, digest[:2], digest[2:4], digest + ext)
+
+    def put(self, stream, filename: str) -> Dict[str, Any]:
+        """Store an uploaded file's content; returns its digest, path, size and
+        whether the same content was already stored
+
+        `stream` is the HashingFile the upload was streamed into, or any file
+        object, which is then copied into the store in chunks.
+        """
+        if isinstance(stream, HashingFile):
+            temp = stream
+        else:
+            temp = self.temp_file()
+            try:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    temp.write(chunk)
+            except BaseException:
+                temp.discard()
+                raise
+        temp.finish()
+
+        digest = temp.hexdigest()
+        now = time.time()
+        # In one write transaction, so the janitor can't remove the file between
+        # finding it here and recording that it was used
+        with self._transaction() as conn:
+            row = conn.execute("SELECT path FROM blobs WHERE digest = ?", (digest,)).fetchone()
+            # The same content under another extension is still the same file
+            path = row[0] if row and os.path.exists(row[0]) else self.path_for(digest, filename)
+            existed = os.path.exists(path)
+            if existed:
+                temp.discard()
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Atomic, so a concurrent upload of the same content finds a whole file
+                os.replace(temp.name, path)
+            temp.stored = True
+            conn.execute(
+                "INSERT INTO blobs (digest, path, size, created_at, last_used) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (digest) DO UPDATE SET path = excluded.path, last_used = excluded.last_used",
+                (digest, path, temp.size, now, now)
+            )
+        return {'sha256': digest, 'path': path, 'size': temp.size, 'deduplicated': existed}
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes SQLite's write lock, which other processes wait on
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def contains(self, digest: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone() is not None
+
+    def add_ref(self, session_id: str, digest: str):
+        # Uploading the same file again renews the reference
+        with self._lock:
+            self._conn.execute("INSERT INTO refs (session_id, digest, created_at) VALUES (?, ?, ?) "
+                               "ON CONFLICT (session_id, digest) DO UPDATE SET created_at = excluded.created_at",
+                               (session_id, digest, time.time()))
+
+    def release(self, session_id: str, digest: Optional[str] = None):
+        """Drop a session's reference to a file, or to all its files"""
+        with self._lock:
+            if digest is None:
+                self._conn.execute("DELETE FROM refs WHERE session_id = ?", (session_id,))
+            else:
+                self._conn.execute("DELETE FROM refs WHERE session_id = ? AND digest = ?", (session_id, digest))
+
+    def refcount(self, digest: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM refs WHERE digest = ?", (digest,)).fetchone()[0]
+
+    def unreferenced(self) -> List[Dict[str, Any]]:
+        """Stored files no session references, least recently used first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT digest, path, size, last_used FROM blobs "
+                "WHERE NOT EXISTS (SELECT 1 FROM refs WHERE refs.digest = blobs.digest) ORDER BY last_used"
+            ).fetchall()
+        return [{'sha256': digest, 'path': path, 'size': size, 'last_used': last_used}
+                for digest, path, size, last_used in rows]
+
+    def session_bytes(self, session_id: str) -> int:
+        """Bytes of the files a session references"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM blobs JOIN refs USING (digest) WHERE session_id = ?",
+                (session_id,)
+            ).fetchone()[0]
+
+    def referencing_sessions(self, before: float) -> List[str]:
+        """Sessions holding a reference taken before the given time"""
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT session_id FROM refs WHERE created_at < ?", (before,)).fetchall()
+        return [session_id for session_id, in rows]
+
+    def remove(self, digest: str, unused_since: float) -> Optional[Dict[str, int]]:
+        """Delete a stored file and everything saved next to it, if no session
+        references it and it hasn't been used since the given time
+
+        Returns the files and bytes deleted, or None if the file was kept.
+        """
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT path FROM blobs WHERE digest = ? AND last_used < ? "
+                "AND NOT EXISTS (SELECT 1 FROM refs WHERE refs.digest = blobs.digest)", (digest, unused_since)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            files = removed = 0
+            # The upload, and its extracted text, index and ingestion result
+            for path in [row[0]] + glob.glob(glob.escape(row[0]) + '.*'):
+                try:
+                    size = os.path.getsize(path)
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                files += 1
+                removed += size
+            # Its shard directories, once empty
+            for directory in (os.path.dirname(row[0]), os.path.dirname(os.path.dirname(row[0]))):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+        return {'files': files, 'bytes': removed}
+
+    def usage(self) -> Dict[str, int]:
+        """Stored files and bytes, and how many of them sessions reference"""
+        with self._lock:
+            files, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            referenced_files, referenced_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs "
+                "WHERE EXISTS (SELECT 1 FROM refs WHERE refs.digest = blobs.digest)"
+            ).fetchone()
+            sessions = self._conn.execute("SELECT COUNT(DISTINCT session_id) FROM refs").fetchone()[0]
+        return {'files': files, 'bytes': size, 'referenced_files': referenced_files,
+                'referenced_bytes': referenced_bytes, 'sessions': sessions}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()